@@ -0,0 +1,271 @@
+import asyncio
+import inspect
+import traceback
+import globals
+from utils import *
+from RateLimiter import RateLimiter
+from TickQueue import TickQueue
+from storage import get_kline_cache
+from binance.helpers import date_to_milliseconds
+from binance import BinanceSocketManager
+
+
+# Binance spot REST limits: request weight per rolling minute, and streams per combined socket
+BINANCE_WEIGHT_PER_MINUTE = 1200
+BINANCE_MAX_STREAMS_PER_SOCKET = 1024
+
+# Request weights of the REST calls bots make. Anything else counts as DEFAULT_REQUEST_WEIGHT.
+# https://binance-docs.github.io/apidocs/spot/en/#limits
+request_weights = {
+    'get_exchange_info': 20,
+    'get_historical_klines': 2,
+    'get_klines': 2,
+    'get_order_book': 5,
+    'get_order': 4,
+    'get_open_orders': 6,
+    'get_account': 20,
+    'create_order': 1,
+    'create_test_order': 1,
+    'cancel_order': 1,
+}
+
+DEFAULT_REQUEST_WEIGHT = 1
+
+RECONNECT_INTERVAL = 10
+
+
+# Gets the exchange's name for a pair, e.g. BTCUSDT for BTC_USDT
+def get_api_symbol(symbol):
+    source, target = globals.currencies.parse_pair(symbol)
+    return source.symbol + target.symbol
+
+
+#
+# REST client shared by every bot in a runtime.
+#
+# Calls are proxied to one AsyncClient (one connection pool), and each waits on a request weight
+# budget shared by all bots before it is sent. The budget is reconciled with the used weight the
+# exchange reports on every response, so it stays correct when other processes use the same key.
+# Exchange info, which every bot asks for at startup and is one of the heaviest requests, is
+# fetched once.
+#
+class SharedClient:
+    def __init__(self, client, weight_per_minute = BINANCE_WEIGHT_PER_MINUTE):
+        self.client = client
+        self.limiter = RateLimiter(weight_per_minute / 60, weight_per_minute)
+        self.exchange_info = None
+        self.exchange_info_lock = asyncio.Lock()
+        self.num_requests = 0
+        self.weight_used = 0
+
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self.call(name, attr, *args, **kwargs)
+
+        return call
+
+
+    async def call(self, name, fn, *args, **kwargs):
+        weight = request_weights.get(name, DEFAULT_REQUEST_WEIGHT)
+        await self.limiter.acquire_async(weight)
+        self.num_requests += 1
+        self.weight_used += weight
+
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            self.observe_response()
+
+
+    def observe_response(self):
+        response = getattr(self.client, 'response', None)
+        if response is None:
+            return
+
+        used = response.headers.get('x-mbx-used-weight-1m')
+        if used is not None:
+            self.limiter.observe_used(int(used))
+
+
+    async def get_exchange_info(self):
+        async with self.exchange_info_lock:
+            if self.exchange_info is None:
+                self.exchange_info = await self.call('get_exchange_info', self.client.get_exchange_info)
+
+        return self.exchange_info
+
+
+    async def get_symbol_info(self, symbol):
+        exchange_info = await self.get_exchange_info()
+        for info in exchange_info['symbols']:
+            if info['symbol'] == symbol.upper():
+                return info
+
+        return None
+
+
+#
+# Hosts many bots in one event loop.
+#
+# Klines for every symbol traded arrive over one combined-stream socket (more past the exchange's
+# per-socket stream limit) and are routed to the bots trading that symbol. All REST calls go
+# through one SharedClient. Bots are isolated from each other: each has its own TickQueue and
+# consumer task, so a slow bot only falls behind (and coalesces) on its own ticks, and an error in
+# one bot's handler is logged while the others keep running.
+#
+# When any bot trades live, the account's user data stream is listened to as well, and order
+# reports are queued to the bots trading the order's symbol. Each bot picks out its own orders by
+# client order id.
+#
+class BotRuntime:
+    def __init__(self, client, weight_per_minute = BINANCE_WEIGHT_PER_MINUTE):
+        self.client = SharedClient(client, weight_per_minute)
+        self.bots = []
+        self.queues = {}
+        self.consumers = []
+
+        # Exchange symbol -> bots trading it
+        self.routes = {}
+        self.num_messages = 0
+        self.num_errors = 0
+
+
+    def add_bot(self, bot):
+        self.bots.append(bot)
+        self.queues[bot] = TickQueue(tag=bot.tag)
+        self.routes.setdefault(get_api_symbol(bot.symbol), []).append(bot)
+
+
+    # Primes every bot. Run-in history is loaded once per symbol, however many bots trade it,
+    # and only what the kline cache is missing is fetched.
+    async def initialize(self, runin = "10 hours ago PST"):
+        start = date_to_milliseconds(runin)
+        for api_symbol, bots in self.routes.items():
+            data = await get_kline_cache(api_symbol).load(self.client, start)
+            symbol_info = await self.client.get_symbol_info(api_symbol)
+
+            for bot in bots:
+                bot.symbol_info = symbol_info
+                await bot.initialize(self.client, data)
+
+        log(f"Initialized {len(self.bots)} bot(s) over {len(self.routes)} symbol(s)", 'runtime')
+
+
+    def get_streams(self):
+        return [f"{api_symbol.lower()}@kline_1m" for api_symbol in self.routes]
+
+
+    # Routes a combined-stream message to the bots trading its symbol
+    async def dispatch(self, msg):
+        if msg is None:
+            return
+
+        if msg.get('e') == 'error':
+            raise Exception(f"Stream error: {msg.get('m')}")
+
+        data = msg.get('data', msg)
+        event_name = data['e']
+        event_time = data['E']
+        event_symbol = data.get('s')
+        self.num_messages += 1
+
+        if event_name == 'executionReport':
+            for bot in self.routes.get(event_symbol, []):
+                await self.queues[bot].put(event_name, event_time, event_symbol, data)
+            return
+
+        if event_name != 'kline':
+            return
+
+        for bot in self.routes.get(event_symbol, []):
+
+            # Each bot gets its own copy, since they annotate and keep payloads
+            payload = dict(data['k'])
+            payload['e'] = event_name
+            payload['E'] = event_time
+            payload['s'] = event_symbol
+            await self.queues[bot].put(event_name, event_time, event_symbol, payload)
+
+
+    # Runs one bot's ticks from its queue
+    async def consume(self, bot):
+        async def handle_tick(event_name, event_time, event_symbol, payload):
+            try:
+                if event_name == 'kline':
+                    await bot.handle_symbol_tick(event_name, event_time, event_symbol, payload)
+                elif event_name == 'executionReport':
+                    await bot.handle_exec_report(event_time, payload)
+            except Exception as e:
+                self.num_errors += 1
+                log(f"Error handling {event_symbol} tick: {e}\n{traceback.format_exc()}", bot.tag)
+
+        await self.queues[bot].consume(handle_tick)
+
+
+    async def listen(self, streams):
+        bm = BinanceSocketManager(self.client.client)
+        async with bm.multiplex_socket(streams) as stream:
+            while True:
+                msg = await stream.recv()
+                await self.dispatch(msg)
+
+
+    async def listen_user(self):
+        bm = BinanceSocketManager(self.client.client)
+        async with bm.user_socket() as stream:
+            while True:
+                msg = await stream.recv()
+                await self.dispatch(msg)
+
+
+    # Listens to every symbol until cancelled, reconnecting on errors
+    async def run(self):
+        streams = self.get_streams()
+        chunks = [streams[i:i + BINANCE_MAX_STREAMS_PER_SOCKET] for i in range(0, len(streams), BINANCE_MAX_STREAMS_PER_SOCKET)]
+
+        # Consumers outlive reconnects, so ticks queued before a drop are still handled
+        if len(self.consumers) == 0:
+            self.consumers = [asyncio.create_task(self.consume(bot)) for bot in self.bots]
+
+        is_live = any([bot.is_live_trading for bot in self.bots])
+
+        while True:
+            log(f"Listening to {len(streams)} stream(s) over {len(chunks)} socket(s) for {len(self.bots)} bot(s)...", 'runtime')
+            listeners = [asyncio.create_task(self.listen(chunk)) for chunk in chunks]
+            if is_live:
+                listeners.append(asyncio.create_task(self.listen_user()))
+
+            try:
+                done, pending = await asyncio.wait(listeners, return_when=asyncio.FIRST_COMPLETED)
+                for listener in done:
+                    listener.result()
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(f"Listener stopped: {e}. Reconnecting in {RECONNECT_INTERVAL} seconds...", 'runtime')
+
+            finally:
+                # One listener stopping takes down the others, so every socket is closed before any
+                # is reopened and no stream is listened to twice
+                for listener in listeners:
+                    listener.cancel()
+
+                await asyncio.gather(*listeners, return_exceptions=True)
+
+            log(f"{self.num_messages} message(s), {self.num_errors} bot error(s), {self.client.num_requests} request(s) weighing {self.client.weight_used}", 'runtime')
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+
+    def disconnect(self):
+        for consumer in self.consumers:
+            consumer.cancel()
+
+        for bot in self.bots:
+            self.queues[bot].log_stats()
+            bot.disconnect()
@@ -0,0 +1,274 @@
+import os
+import queue
+import multiprocessing
+import traceback
+import datetime as dt
+import time as systime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+
+from utils import *
+from RateLimiter import RateLimiter
+
+
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_TIMEOUT = 'timeout'
+
+
+#
+# Outcome of a job, as delivered on JobScheduler.results
+#
+class JobResult:
+    def __init__(self, job, status, result = None, error = None, fetch_elapsed = 0, run_elapsed = 0):
+        self.job = job
+        self.status = status
+        self.result = result
+        self.error = error
+        self.fetch_elapsed = fetch_elapsed
+        self.run_elapsed = run_elapsed
+
+
+# Runs `fn` in a worker process and times it. Exceptions are returned as text, since tracebacks
+# do not survive pickling back to the parent.
+def _run_timed(fn, job):
+    start = systime.monotonic()
+    try:
+        return fn(job), None, systime.monotonic() - start
+    except Exception as e:
+        return None, f"{e}\n{traceback.format_exc()}", systime.monotonic() - start
+
+
+# Entry point of an analysis process. Sends the timed result back over `conn`.
+def _run_in_process(conn, fn, job):
+    outcome = _run_timed(fn, job)
+    try:
+        conn.send(outcome)
+    except Exception as e:
+        conn.send((None, f"Could not return the result: {e}", outcome[2]))
+
+    conn.close()
+
+
+#
+# Two-stage job scheduler: an I/O stage on a rate-limited thread pool (data fetches) followed by a
+# CPU stage on a bounded process pool (analysis).
+#
+# Fetches are shared between jobs with the same fetch key, so several analyzers over one symbol
+# only update it once. A fetch running longer than `fetch_timeout` fails its jobs; its thread
+# can't be stopped, so fetch functions should also time out their own requests.
+#
+# Each analysis runs in a process of its own, started when it is scheduled, and no more than
+# `cpu_workers` run at once, so a job's timeout measures its own run time rather than its time in
+# the queue. A timed-out analysis is killed, which frees its slot right away and keeps a hung model
+# from holding up the exit of the process. Analyses are started from a fork server (or spawned)
+# rather than forked from this process, as a fork taken while a fetch thread holds a lock would
+# leave the child holding it forever.
+#
+# Completed jobs are delivered as JobResults on `results`.
+#
+class JobScheduler:
+    def __init__(self, cpu_workers = 0, io_workers = 4, fetch_rate = 1.0, fetch_burst = 1, timeout = None, fetch_timeout = None, inline = False):
+        if cpu_workers <= 0:
+            cpu_workers = os.cpu_count() or 1
+
+        self.cpu_workers = cpu_workers
+        self.io_workers = io_workers
+        self.limiter = RateLimiter(fetch_rate, fetch_burst)
+        self.timeout = timeout
+        self.fetch_timeout = fetch_timeout
+        self.inline = inline
+
+        self.results = queue.Queue()
+        self.events = queue.Queue()
+        self.fetch_started = {}
+        self.jobs = []
+
+
+    # Adds a job. `fetch_fn(job)` runs in the I/O stage, once per distinct `fetch_key`.
+    # `run_fn(job)` runs in a worker process and its return value is the job's result.
+    # Both must be importable module-level functions, and the job must be picklable.
+    def submit(self, job, fetch_fn, run_fn, fetch_key = None):
+        self.jobs.append((job, fetch_fn, run_fn, fetch_key))
+
+
+    def rate_limited(self, fetch_fn, job, key = None):
+        self.limiter.acquire()
+        start = systime.monotonic()
+        self.fetch_started[key] = start
+        fetch_fn(job)
+        return systime.monotonic() - start
+
+
+    # Runs every submitted job and blocks until all have completed, failed or timed out.
+    # Returns the JobResults in completion order.
+    def run(self):
+        perf_start = dt.datetime.now()
+        log(f"Scheduling {len(self.jobs)} job(s) on {self.cpu_workers} worker process(es) and {self.io_workers} fetch thread(s)", 'sched')
+
+        if self.inline:
+            completed = self.run_inline()
+        else:
+            completed = self.run_pooled()
+
+        self.log_summary(completed, (dt.datetime.now() - perf_start).total_seconds())
+        return completed
+
+
+    # Runs jobs one at a time in the calling thread. Useful under a debugger.
+    def run_inline(self):
+        completed = []
+        fetched = {}
+
+        for job, fetch_fn, run_fn, fetch_key in self.jobs:
+            key = fetch_key if fetch_key is not None else id(job)
+            try:
+                if key not in fetched:
+                    fetched[key] = self.rate_limited(fetch_fn, job)
+
+                result, error, run_elapsed = _run_timed(run_fn, job)
+                status = JOB_DONE if error is None else JOB_FAILED
+                completed.append(self.complete(JobResult(job, status, result, error, fetched[key], run_elapsed), len(completed)))
+
+            except Exception as e:
+                completed.append(self.complete(JobResult(job, JOB_FAILED, error=f"{e}"), len(completed)))
+
+        return completed
+
+
+    def run_pooled(self):
+        try:
+            mp = multiprocessing.get_context('forkserver')
+            mp.set_forkserver_preload(list(set([run_fn.__module__ for job, fetch_fn, run_fn, fetch_key in self.jobs])))
+        except ValueError:
+            mp = multiprocessing.get_context('spawn')
+
+        completed = []
+        ready = deque()
+        running = {}
+        fetches = {}
+        keys = []
+        abandoned = set()
+        io_pool = ThreadPoolExecutor(self.io_workers)
+
+        try:
+            # Stage 1: fetches. Jobs sharing a fetch key wait on the same future.
+            for n, (job, fetch_fn, run_fn, fetch_key) in enumerate(self.jobs):
+                key = fetch_key if fetch_key is not None else ('job', n)
+                keys.append(key)
+                if key not in fetches:
+                    fetches[key] = io_pool.submit(self.rate_limited, fetch_fn, job, key)
+
+                fetches[key].add_done_callback(lambda future, n=n: self.events.put(('fetched', n, future)))
+
+            remaining = len(self.jobs)
+
+            while remaining > 0:
+
+                # Stage 2: analyses, bounded to the number of workers
+                while len(ready) > 0 and len(running) < self.cpu_workers:
+                    n, fetch_elapsed = ready.popleft()
+                    job, fetch_fn, run_fn, fetch_key = self.jobs[n]
+                    conn, child_conn = mp.Pipe(duplex=False)
+                    process = mp.Process(target=_run_in_process, args=(child_conn, run_fn, job), name=f"analysis-{n}")
+                    process.start()
+                    child_conn.close()
+                    running[n] = (process, conn, systime.monotonic(), fetch_elapsed)
+
+                # Analyses report back on their pipe, or just exit if they crashed
+                handles = {}
+                for n, (process, conn, started, fetch_elapsed) in running.items():
+                    handles[conn] = n
+                    handles[process.sentinel] = n
+
+                finished = set([handles[handle] for handle in wait(list(handles.keys()), timeout=0.05)]) if len(handles) > 0 else set()
+                for n in finished:
+                    process, conn, started, fetch_elapsed = running.pop(n)
+                    try:
+                        result, error, run_elapsed = conn.recv()
+                    except EOFError:
+                        process.join()
+                        result, error, run_elapsed = None, f"Worker exited with code {process.exitcode}", systime.monotonic() - started
+
+                    conn.close()
+                    process.join()
+
+                    status = JOB_DONE if error is None else JOB_FAILED
+                    completed.append(self.complete(JobResult(self.jobs[n][0], status, result, error, fetch_elapsed, run_elapsed), len(completed)))
+                    remaining -= 1
+
+                # Fetches. Only waited on when no analysis is running.
+                timeout = 0.25 if len(running) == 0 else 0
+                while True:
+                    try:
+                        event, n, future = self.events.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+
+                    timeout = 0
+                    if keys[n] in abandoned:
+                        continue
+
+                    error = future.exception()
+                    if error is not None:
+                        completed.append(self.complete(JobResult(self.jobs[n][0], JOB_FAILED, error=f"Fetch failed: {error}"), len(completed)))
+                        remaining -= 1
+                    else:
+                        ready.append((n, future.result()))
+
+                # Give up on overdue fetches and fail the jobs waiting on them
+                if self.fetch_timeout is not None:
+                    now = systime.monotonic()
+                    for key, started in list(self.fetch_started.items()):
+                        if key in abandoned or fetches[key].done() or now - started <= self.fetch_timeout:
+                            continue
+
+                        abandoned.add(key)
+                        for n in [n for n in range(len(self.jobs)) if keys[n] == key]:
+                            completed.append(self.complete(JobResult(self.jobs[n][0], JOB_TIMEOUT, error=f"Fetch timed out after {self.fetch_timeout}s", fetch_elapsed=now - started), len(completed)))
+                            remaining -= 1
+
+                # Kill overdue analyses
+                if self.timeout is not None:
+                    now = systime.monotonic()
+                    for n in [n for n, (process, conn, started, fetch_elapsed) in running.items() if now - started > self.timeout]:
+                        process, conn, started, fetch_elapsed = running.pop(n)
+                        self.kill(process, conn)
+                        completed.append(self.complete(JobResult(self.jobs[n][0], JOB_TIMEOUT, error=f"Timed out after {self.timeout}s", fetch_elapsed=fetch_elapsed, run_elapsed=now - started), len(completed)))
+                        remaining -= 1
+
+        finally:
+            # Only left over if the loop was interrupted
+            for process, conn, started, fetch_elapsed in running.values():
+                self.kill(process, conn)
+
+            # Abandoned fetches are not waited for
+            io_pool.shutdown(wait=len(abandoned) == 0, cancel_futures=True)
+
+        return completed
+
+
+    def kill(self, process, conn):
+        process.kill()
+        process.join()
+        conn.close()
+
+
+    def complete(self, job_result, num_completed):
+        if job_result.status != JOB_DONE:
+            log(f"Job {job_result.job.get('name', '')} {job_result.status}: {job_result.error}", 'sched')
+
+        log(f"[{num_completed + 1}/{len(self.jobs)}] {job_result.job.get('name', '')} {job_result.status} (fetch {job_result.fetch_elapsed:.2f}s, run {job_result.run_elapsed:.2f}s)", 'sched')
+        self.results.put(job_result)
+        return job_result
+
+
+    def log_summary(self, completed, elapsed):
+        counts = { status: len([r for r in completed if r.status == status]) for status in [JOB_DONE, JOB_FAILED, JOB_TIMEOUT] }
+        run_time = sum([r.run_elapsed for r in completed])
+        fetch_time = sum([r.fetch_elapsed for r in completed])
+        throughput = len(completed) / elapsed if elapsed > 0 else 0
+
+        log(f"Finished {len(completed)} job(s) in {elapsed:.2f}s ({throughput:.2f} jobs/s): {counts[JOB_DONE]} done, {counts[JOB_FAILED]} failed, {counts[JOB_TIMEOUT]} timed out", 'sched')
+        log(f"Total fetch time {fetch_time:.2f}s, total analysis time {run_time:.2f}s", 'sched')
@@ -0,0 +1,120 @@
+import atexit
+import asyncio
+import threading
+import traceback
+from collections import OrderedDict
+from utils import *
+
+
+#
+# Background writer for state saves, captures and reports.
+#
+# Jobs run in order on one thread, so tick handling never waits on disk or chart rendering.
+# Callers snapshot what they want written before submitting, and the job only does the I/O.
+#
+# Jobs submitted under a key are coalesced: if a job with the same key is still waiting, it is
+# replaced by the newer one, keeping its place in line. Repeated state saves during a burst of
+# state changes therefore cost one write. Jobs without a key (e.g. appends) always run.
+#
+# Pending jobs are flushed on exit.
+#
+class PersistenceWorker:
+    def __init__(self, name = 'persistence'):
+        self.name = name
+        self.jobs = OrderedDict()
+        self.changed = threading.Condition()
+        self.is_running_job = False
+        self.is_stopping = False
+        self.next_id = 0
+
+        self.num_submitted = 0
+        self.num_coalesced = 0
+        self.num_completed = 0
+        self.num_failed = 0
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+
+    # Queues `fn(*args)`. Returns immediately.
+    def submit(self, fn, *args, key = None):
+        with self.changed:
+            self.num_submitted += 1
+
+            if key is None:
+                key = ('job', self.next_id)
+                self.next_id += 1
+            elif key in self.jobs:
+                self.num_coalesced += 1
+
+            self.jobs[key] = (fn, args)
+            self.changed.notify_all()
+
+
+    def run(self):
+        while True:
+            with self.changed:
+                while len(self.jobs) == 0:
+                    if self.is_stopping:
+                        return
+
+                    self.changed.wait()
+
+                key, (fn, args) = self.jobs.popitem(last=False)
+                self.is_running_job = True
+
+            try:
+                fn(*args)
+                self.num_completed += 1
+            except Exception as e:
+                self.num_failed += 1
+                log(f"Background write '{key}' failed: {e}\n{traceback.format_exc()}", self.name)
+
+            with self.changed:
+                self.is_running_job = False
+                self.changed.notify_all()
+
+
+    # Blocks until every job submitted so far has run
+    def flush(self):
+        with self.changed:
+            while len(self.jobs) > 0 or self.is_running_job:
+                self.changed.wait()
+
+
+    async def flush_async(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+
+    def stop(self):
+        with self.changed:
+            self.is_stopping = True
+            self.changed.notify_all()
+
+        self.thread.join()
+
+
+    def get_stats(self):
+        return {
+            'pending': len(self.jobs),
+            'submitted': self.num_submitted,
+            'coalesced': self.num_coalesced,
+            'completed': self.num_completed,
+            'failed': self.num_failed,
+        }
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+# Gets the process-wide worker, starting it on first use
+def get_persistence_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = PersistenceWorker()
+            atexit.register(_worker.stop)
+
+        return _worker
+
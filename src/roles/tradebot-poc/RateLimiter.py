@@ -0,0 +1,68 @@
+import asyncio
+import threading
+import time as systime
+
+
+#
+# Thread-safe token bucket. Allows bursts of up to `burst` calls and `rate` calls per second
+# on average after that. Calls can cost more than one token, e.g. weighted API requests.
+#
+class RateLimiter:
+    def __init__(self, rate, burst = 1):
+        if rate <= 0:
+            raise Exception(f"Invalid rate {rate}")
+
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = systime.monotonic()
+        self.lock = threading.Lock()
+
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    # Takes `cost` tokens if they are available without waiting. Returns True if it did.
+    def try_acquire(self, cost = 1):
+        return self.take(cost) == 0
+
+
+    # Takes `cost` tokens if available, otherwise returns the seconds to wait before trying again
+    def take(self, cost):
+        cost = min(cost, self.burst)
+        with self.lock:
+            self.refill(systime.monotonic())
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0
+
+            return (cost - self.tokens) / self.rate
+
+
+    # Blocks until `cost` tokens are available, then takes them
+    def acquire(self, cost = 1):
+        while True:
+            wait = self.take(cost)
+            if wait == 0:
+                return
+
+            systime.sleep(wait)
+
+
+    # Waits without blocking the event loop until `cost` tokens are available, then takes them
+    async def acquire_async(self, cost = 1):
+        while True:
+            wait = self.take(cost)
+            if wait == 0:
+                return
+
+            await asyncio.sleep(wait)
+
+
+    # Reconciles with usage reported by the server, which also counts calls made elsewhere
+    def observe_used(self, used):
+        with self.lock:
+            self.refill(systime.monotonic())
+            self.tokens = min(self.tokens, self.burst - used)
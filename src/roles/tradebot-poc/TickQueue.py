@@ -0,0 +1,190 @@
+import asyncio
+import time as systime
+from collections import deque
+from utils import *
+
+
+DEFAULT_TICK_QUEUE_SIZE = 256
+
+# Seconds between queue metric reports
+TICK_QUEUE_REPORT_INTERVAL = 60
+
+# Smoothing of the average lag
+TICK_QUEUE_LAG_ALPHA = 0.1
+
+
+#
+# Queued event. `superseded` entries have been coalesced away and are skipped.
+#
+class TickEntry:
+    __slots__ = ['event_name', 'event_time', 'symbol', 'payload', 'enqueued', 'required', 'superseded', 'seq']
+
+    def __init__(self, event_name, event_time, symbol, payload, required, seq):
+        self.event_name = event_name
+        self.event_time = event_time
+        self.symbol = symbol
+        self.payload = payload
+        self.enqueued = systime.monotonic()
+        self.required = required
+        self.superseded = False
+        self.seq = seq
+
+
+#
+# Bounded queue of stream events between a socket reader and a bot.
+#
+# Events that must be seen (interval-close klines, with 'x' set, and anything that isn't a kline,
+# such as execution reports) are always delivered in order. The queue holds at most `maxsize` of
+# those, and put() waits for the consumer once it is full, which pushes back on the reader rather
+# than growing without bound.
+#
+# In-progress klines are coalesced: while one is still queued for a symbol, a newer one replaces
+# its payload in place, so a consumer that falls behind catches up on the latest price instead of
+# replaying every stale tick. Events are never reordered, though: if events that must be seen were
+# queued after the in-progress kline, it stays as it is and the newer one is queued behind them.
+# A kline close supersedes the latest queued in-progress kline of its symbol.
+#
+class TickQueue:
+    def __init__(self, maxsize = DEFAULT_TICK_QUEUE_SIZE, tag = 'ticks'):
+        if maxsize < 1:
+            raise Exception(f"Invalid tick queue size {maxsize}")
+
+        self.maxsize = maxsize
+        self.tag = tag
+        self.entries = deque()
+        self.num_required = 0
+        self.closed = False
+        self.changed = asyncio.Condition()
+
+        # Symbol -> queued, coalescable entry
+        self.pending = {}
+        self.num_queued = 0
+        self.last_required_seq = 0
+
+        self.num_received = 0
+        self.num_processed = 0
+        self.num_coalesced = 0
+        self.max_depth = 0
+        self.lag_ms = 0.0
+        self.max_lag_ms = 0
+        self.max_wait_ms = 0
+        self.reported = systime.monotonic()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    @staticmethod
+    def is_required(event_name, payload):
+        return event_name != 'kline' or payload is None or payload.get('x', False) is True
+
+
+    async def put(self, event_name, event_time, symbol, payload):
+        async with self.changed:
+            self.num_received += 1
+            required = self.is_required(event_name, payload)
+
+            if not required:
+                entry = self.pending.get(symbol)
+                if entry is not None and entry.seq > self.last_required_seq:
+                    entry.event_time = event_time
+                    entry.payload = payload
+                    self.num_coalesced += 1
+                    return
+
+                self.num_queued += 1
+                entry = TickEntry(event_name, event_time, symbol, payload, False, self.num_queued)
+                self.pending[symbol] = entry
+
+            else:
+                while self.num_required >= self.maxsize and not self.closed:
+                    await self.changed.wait()
+
+                if event_name == 'kline':
+                    superseded = self.pending.pop(symbol, None)
+                    if superseded is not None:
+                        superseded.superseded = True
+                        self.num_coalesced += 1
+
+                self.num_queued += 1
+                entry = TickEntry(event_name, event_time, symbol, payload, True, self.num_queued)
+                self.last_required_seq = entry.seq
+                self.num_required += 1
+
+            self.entries.append(entry)
+            self.max_depth = max(self.max_depth, len(self.entries))
+            self.changed.notify_all()
+
+
+    # Gets the next event as (event name, event time, symbol, payload), or None once closed and empty
+    async def get(self):
+        async with self.changed:
+            while True:
+                while len(self.entries) == 0:
+                    if self.closed:
+                        return None
+
+                    await self.changed.wait()
+
+                entry = self.entries.popleft()
+                if entry.required:
+                    self.num_required -= 1
+                    self.changed.notify_all()
+                elif entry.superseded:
+                    continue
+                elif self.pending.get(entry.symbol) is entry:
+                    del self.pending[entry.symbol]
+
+                break
+
+        self.observe(entry)
+        return entry.event_name, entry.event_time, entry.symbol, entry.payload
+
+
+    def observe(self, entry):
+        now = systime.monotonic()
+        self.num_processed += 1
+
+        lag_ms = max(0, int(systime.time() * 1000) - int(entry.event_time))
+        self.lag_ms += (lag_ms - self.lag_ms) * TICK_QUEUE_LAG_ALPHA
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        self.max_wait_ms = max(self.max_wait_ms, int((now - entry.enqueued) * 1000))
+
+        if now - self.reported >= TICK_QUEUE_REPORT_INTERVAL:
+            self.reported = now
+            self.log_stats()
+
+
+    # Passes events to `handler(event_name, event_time, symbol, payload)` until the queue is closed
+    async def consume(self, handler):
+        while True:
+            item = await self.get()
+            if item is None:
+                return
+
+            await handler(*item)
+
+
+    async def close(self):
+        async with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+
+    def get_stats(self):
+        return {
+            'depth': len(self.entries),
+            'max_depth': self.max_depth,
+            'received': self.num_received,
+            'processed': self.num_processed,
+            'coalesced': self.num_coalesced,
+            'lag_ms': round(self.lag_ms),
+            'max_lag_ms': self.max_lag_ms,
+            'max_wait_ms': self.max_wait_ms,
+        }
+
+
+    def log_stats(self):
+        stats = self.get_stats()
+        log(f"Tick queue depth {stats['depth']} (max {stats['max_depth']}), {stats['processed']}/{stats['received']} processed, {stats['coalesced']} coalesced, lag {stats['lag_ms']} ms (max {stats['max_lag_ms']} ms), max wait {stats['max_wait_ms']} ms", self.tag)
@@ -0,0 +1,296 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import numpy as np
+from os import path
+from collections import OrderedDict
+from contextlib import contextmanager
+from utils import *
+
+
+#
+# Persistent, content-addressed cache of forecasts.
+#
+# Entries are keyed by a SHA-256 of the training values, the model configuration and the horizon,
+# so a forecast is reused whenever the same window is forecast the same way again, whichever
+# symbol, run or day it came from. Each entry is a small .npy file, and the least recently used
+# entries are evicted once the cache grows past `max_bytes`.
+#
+# Sizes and recency are kept in one append-only index file shared by every process using the
+# cache: a record per entry added, used or evicted. Opening the cache reads that file instead of
+# scanning the entries, and each process catches up on the records the others appended before it
+# evicts, so they all work from the same view. The index is locked while it is appended to and is
+# compacted once it holds many more records than entries.
+#
+# Entries are written to the side and renamed into place, and a missing file is simply a miss.
+# Use get_forecast_cache() so a process opens the cache once.
+#
+
+DEFAULT_FORECAST_CACHE_BYTES = 256 * 1024 * 1024
+
+FORECAST_INDEX_NAME = 'index.log'
+
+# The index is compacted once it holds this many records per entry (and at least the minimum)
+FORECAST_INDEX_COMPACT_RATIO = 4
+FORECAST_INDEX_COMPACT_MIN = 4096
+
+
+def get_forecast_cache_path():
+    return path.join(os.getcwd(), 'data', 'cache', 'forecasts')
+
+
+class ForecastCache:
+    def __init__(self, cache_path = None, max_bytes = DEFAULT_FORECAST_CACHE_BYTES):
+        self.path = cache_path if cache_path is not None else get_forecast_cache_path()
+        self.index_path = path.join(self.path, FORECAST_INDEX_NAME)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Key -> entry size, least recently used first, as of `offset` bytes into the index
+        self.entries = OrderedDict()
+        self.size = 0
+        self.offset = 0
+        self.num_records = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.index = None
+        self.index_ino = None
+        self.pid = None
+
+        with self.locked():
+            if self.offset == 0:
+                self.rebuild()
+
+
+    # Opens the index. Forked processes open their own, since a lock is shared with the
+    # parent's open file.
+    def open_index(self):
+        if self.index is not None:
+            self.index.close()
+
+        self.index = open(self.index_path, 'a+b')
+        self.pid = os.getpid()
+
+
+    # Holds the index lock and catches up on the records appended since the last time. If the index
+    # was compacted in the meantime, it is reopened and read again from the start.
+    @contextmanager
+    def locked(self):
+        if self.pid != os.getpid():
+            self.open_index()
+
+        while True:
+            fcntl.flock(self.index.fileno(), fcntl.LOCK_EX)
+            try:
+                current_ino = os.stat(self.index_path).st_ino
+            except FileNotFoundError:
+                current_ino = None
+
+            if current_ino == os.fstat(self.index.fileno()).st_ino:
+                break
+
+            fcntl.flock(self.index.fileno(), fcntl.LOCK_UN)
+            self.open_index()
+
+        try:
+            ino = os.fstat(self.index.fileno()).st_ino
+            if ino != self.index_ino:
+                self.entries = OrderedDict()
+                self.size = 0
+                self.offset = 0
+                self.num_records = 0
+                self.index_ino = ino
+
+            self.sync()
+            yield
+
+        finally:
+            fcntl.flock(self.index.fileno(), fcntl.LOCK_UN)
+
+
+    # Applies the records after `offset`. Call with the lock held.
+    def sync(self):
+        self.index.seek(self.offset)
+        data = self.index.read()
+
+        # A crash may leave a partial last line
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            self.apply(line.split())
+
+        self.offset += end
+
+
+    def apply(self, record):
+        self.num_records += 1
+        op, key = record[0], record[1]
+
+        if op == '+':
+            size = int(record[2])
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        elif op == '*':
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        elif op == '-':
+            self.size -= self.entries.pop(key, 0)
+
+
+    # Appends records to the index and applies them. Call with the lock held.
+    def append(self, *records):
+        self.index.write(''.join([' '.join(record) + '\n' for record in records]).encode('utf-8'))
+        self.index.flush()
+        self.sync()
+
+
+    # Indexes the entries on disk, oldest first. Only needed for a cache without an index yet.
+    def rebuild(self):
+        found = []
+        for shard in os.listdir(self.path):
+            shard_path = path.join(self.path, shard)
+            if not path.isdir(shard_path):
+                continue
+
+            for name in os.listdir(shard_path):
+                if not name.endswith('.npy'):
+                    continue
+
+                try:
+                    stat = os.stat(path.join(shard_path, name))
+                    found.append((stat.st_mtime, name[:-4], stat.st_size))
+                except FileNotFoundError:
+                    pass
+
+        if len(found) > 0:
+            log(f"Indexing {len(found)} cached forecast(s) in '{self.path}'...")
+            self.append(*[('+', key, str(size)) for mtime, key, size in sorted(found)])
+
+
+    # Rewrites the index with one record per entry. Call with the lock held.
+    def compact(self):
+        if self.num_records <= max(FORECAST_INDEX_COMPACT_MIN, FORECAST_INDEX_COMPACT_RATIO * len(self.entries)):
+            return
+
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(''.join([f"+ {key} {size}\n" for key, size in self.entries.items()]).encode('utf-8'))
+
+        os.replace(temp_path, self.index_path)
+
+        # Other processes notice the new index the next time they lock it
+        self.open_index()
+        self.index_ino = os.fstat(self.index.fileno()).st_ino
+        self.offset = os.path.getsize(self.index_path)
+        self.num_records = len(self.entries)
+
+
+    # Gets the cache key of forecasting `n_periods` from `training` with a model configuration
+    @staticmethod
+    def get_key(training, config, n_periods):
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(training, dtype=np.float64).tobytes())
+        digest.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(str(n_periods).encode('utf-8'))
+        return digest.hexdigest()
+
+
+    def get_entry_path(self, key):
+        return path.join(self.path, key[:2], key + '.npy')
+
+
+    # Gets a cached forecast, or None
+    def get(self, key):
+        entry_path = self.get_entry_path(key)
+        try:
+            forecast = np.load(entry_path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            if key in self.entries:
+                with self.locked():
+                    if key in self.entries:
+                        self.append(('-', key))
+
+            return None
+
+        self.hits += 1
+        with self.locked():
+            if key in self.entries:
+                self.append(('*', key))
+            else:
+                self.append(('+', key, str(os.path.getsize(entry_path))))
+
+        return forecast
+
+
+    def put(self, key, forecast):
+        entry_path = self.get_entry_path(key)
+        os.makedirs(path.dirname(entry_path), exist_ok=True)
+
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as file:
+            np.save(file, np.asarray(forecast, dtype=np.float64))
+
+        os.replace(temp_path, entry_path)
+        size = os.path.getsize(entry_path)
+
+        with self.locked():
+            self.append(('+', key, str(size)))
+            self.evict()
+            self.compact()
+
+
+    # Removes least recently used entries until the cache fits in `max_bytes`. Call with the lock held.
+    def evict(self):
+        evicted = []
+        size = self.size
+        for key, entry_size in self.entries.items():
+            if size <= self.max_bytes:
+                break
+
+            size -= entry_size
+            evicted.append(key)
+
+        for key in evicted:
+            try:
+                os.remove(self.get_entry_path(key))
+            except FileNotFoundError:
+                pass
+
+        if len(evicted) > 0:
+            self.evictions += len(evicted)
+            self.append(*[('-', key) for key in evicted])
+
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.get_hit_rate(),
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# Gets the process-wide forecast cache at a path (by default the working directory's), opening it
+# on first use
+def get_forecast_cache(cache_path = None):
+    cache_path = cache_path if cache_path is not None else get_forecast_cache_path()
+    with _caches_lock:
+        if cache_path not in _caches:
+            _caches[cache_path] = ForecastCache(cache_path)
+
+        return _caches[cache_path]
@@ -0,0 +1,200 @@
+import os
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pmdarima.arima import ARIMA, AutoARIMA
+from utils import *
+
+
+#
+# Rolling ARIMA forecasts over a series of training windows.
+#
+# A full stepwise order search is expensive and the order it picks rarely changes when the window
+# moves by a day. So the order found by a search is reused for the following windows, and each of
+# those is refit with the previous window's parameters as the starting point, which converges in a
+# few iterations. The search is re-run every `research_interval` windows, or as soon as the
+# per-observation BIC of a refit degrades by more than `degradation_tolerance` relative to the fit
+# found by the last search.
+#
+# Contiguous runs of windows are independent of each other, so the windows are split into
+# segments that are forecast in parallel, each starting with its own search.
+#
+
+# Order search settings, as used by TrendFinder
+default_search_args = {
+    'start_p': 0, 'start_q': 0,
+    'start_P': 0, 'start_Q': 0,
+    'max_p': 8, 'max_q': 8,
+    'max_P': 5, 'max_Q': 5,
+    'error_action': 'ignore',
+    'information_criterion': 'bic',
+    'suppress_warnings': True,
+}
+
+DEFAULT_RESEARCH_INTERVAL = 20
+DEFAULT_DEGRADATION_TOLERANCE = 0.05
+
+# Smallest number of windows worth giving a worker of its own
+MIN_SEGMENT_WINDOWS = 8
+
+
+def search_model(training, search_args):
+    return AutoARIMA(**search_args).fit(training).model_
+
+
+# Refits a model's order to a new window, starting from its parameters
+def refit_model(model, training):
+    return ARIMA(order=model.order,
+                 seasonal_order=model.seasonal_order,
+                 with_intercept=model.with_intercept,
+                 start_params=model.params(),
+                 suppress_warnings=True).fit(training)
+
+
+def get_bic_per_obs(model, training):
+    return model.bic() / len(training)
+
+
+# Forecasts a run of windows in order, reusing the model from one window to the next.
+# Returns (forecasts, number of searches, number of refits).
+def forecast_segment(series, windows, n_periods, search_args, research_interval, degradation_tolerance):
+    forecasts = []
+    model = None
+    baseline = None
+    since_search = 0
+    num_searches = 0
+    num_refits = 0
+    prev_window = None
+    prev_forecast = None
+
+    for begin, end in windows:
+
+        # Windows clipped at the end of the series can repeat
+        if (begin, end) == prev_window:
+            forecasts.append(prev_forecast)
+            continue
+
+        training = series[begin:end]
+        training = training[~np.isnan(training)]
+
+        # Scheduled re-search
+        if since_search >= research_interval:
+            model = None
+
+        if model is not None:
+            try:
+                candidate = refit_model(model, training)
+                if get_bic_per_obs(candidate, training) <= baseline + degradation_tolerance:
+                    model = candidate
+                    since_search += 1
+                    num_refits += 1
+                else:
+                    model = None
+
+            except Exception as e:
+                model = None
+
+        if model is None:
+            model = search_model(training, search_args)
+            baseline = get_bic_per_obs(model, training)
+            since_search = 0
+            num_searches += 1
+
+        prev_window = (begin, end)
+        prev_forecast = np.asarray(model.predict(n_periods=n_periods))
+        forecasts.append(prev_forecast)
+
+    return forecasts, num_searches, num_refits
+
+
+class RollingForecaster:
+    def __init__(self,
+                 n_periods,
+                 search_args = None,
+                 research_interval = DEFAULT_RESEARCH_INTERVAL,
+                 degradation_tolerance = DEFAULT_DEGRADATION_TOLERANCE,
+                 workers = 0):
+
+        self.n_periods = n_periods
+        self.search_args = search_args if search_args is not None else default_search_args
+        self.research_interval = research_interval
+        self.degradation_tolerance = degradation_tolerance
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.num_searches = 0
+        self.num_refits = 0
+
+
+    # Splits windows into contiguous segments, one per worker
+    def get_segments(self, windows):
+        num_segments = max(1, min(self.workers, len(windows) // MIN_SEGMENT_WINDOWS))
+        bounds = np.linspace(0, len(windows), num_segments + 1).astype(int)
+        return [windows[bounds[i]:bounds[i + 1]] for i in range(num_segments) if bounds[i + 1] > bounds[i]]
+
+
+    # Model configuration, as used in forecast cache keys
+    def get_config(self):
+        return {
+            'search': self.search_args,
+            'research_interval': self.research_interval,
+            'degradation_tolerance': self.degradation_tolerance,
+        }
+
+
+    # Forecasts `n_periods` ahead from each (begin, end) training window of `series`.
+    # Returns one forecast array per window, in order. Only windows missing from `cache` are fit.
+    def run(self, series, windows, cache = None):
+        series = np.asarray(series, dtype=np.float64)
+        windows = list(windows)
+
+        if cache is None:
+            return self.forecast(series, windows)
+
+        config = self.get_config()
+        keys = []
+        forecasts = []
+        for begin, end in windows:
+            training = series[begin:end]
+            key = cache.get_key(training[~np.isnan(training)], config, self.n_periods)
+            keys.append(key)
+            forecasts.append(cache.get(key))
+
+        missing = [i for i, forecast in enumerate(forecasts) if forecast is None]
+        if len(missing) > 0:
+            fitted = self.forecast(series, [windows[i] for i in missing])
+            for i, forecast in zip(missing, fitted):
+                forecasts[i] = forecast
+                cache.put(keys[i], forecast)
+
+        return forecasts
+
+
+    def forecast(self, series, windows):
+        segments = self.get_segments(windows)
+        args = (self.n_periods, self.search_args, self.research_interval, self.degradation_tolerance)
+
+        results = None
+        if len(segments) > 1:
+            try:
+                try:
+                    mp = multiprocessing.get_context('fork')
+                except ValueError:
+                    mp = multiprocessing.get_context()
+
+                with ProcessPoolExecutor(len(segments), mp_context=mp) as pool:
+                    futures = [pool.submit(forecast_segment, series, segment, *args) for segment in segments]
+                    results = [future.result() for future in futures]
+
+            # Daemonic workers (e.g. when already running in a pool) cannot start processes of their own
+            except AssertionError as e:
+                log(f"Forecasting segments serially: {e}", 'forecast')
+
+        if results is None:
+            results = [forecast_segment(series, segment, *args) for segment in segments]
+
+        forecasts = []
+        for segment_forecasts, num_searches, num_refits in results:
+            forecasts.extend(segment_forecasts)
+            self.num_searches += num_searches
+            self.num_refits += num_refits
+
+        return forecasts
@@ -5,12 +5,13 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from findiff import FinDiff
 from utils import *
+from trendlines import find_trendlines
 from skimage import *
 import matplotlib
 import trendln
-from pmdarima.arima import AutoARIMA
+from .RollingForecaster import RollingForecaster
+from .ForecastCache import get_forecast_cache
 
 
 class TrendFinder():#AnalyzerBase):
@@ -185,7 +186,6 @@ class TrendFinder():#AnalyzerBase):
 
         # Generate ARIMA sequence predictions for each applicable column
         for col in ['MovAvgClose']:# ['LogMovAvgOpen', 'LogMovAvgClose', 'LogMovAvgLow', 'LogMovAvgHigh', 'LogMovAvgVolume']:
-            offset = 0
             if ctx['backtesting']:
                 start_day = days_to_train
                 end_day = num_days + days_to_predict
@@ -193,22 +193,19 @@ class TrendFinder():#AnalyzerBase):
                 start_day = data['MovAvgClose'].size[0] # TODO: Rm?
                 end_day = num_days + days_to_train
 
-            for day in range(start_day, end_day):
+            # Training windows, clipped to the data like .iloc[day - days_to_train:day + 1]
+            windows = [(max(0, day - days_to_train), min(num_days, day + 1)) for day in range(start_day, end_day)]
 
-                # BEGIN LOOP
-                training = data['LogMovAvgClose'].iloc[day - days_to_train:day + 1].dropna()
-            
-                # Finding the best parameters
-                model    = AutoARIMA(start_p=0, start_q=0,
-                                        start_P=0, start_Q=0,
-                                        max_p=8, max_q=8,
-                                        max_P=5, max_Q=5,
-                                        error_action='ignore',
-                                        information_criterion='bic',
-                                        suppress_warnings=True)
-
-                # Getting predictions for the optimum parameters by fitting to the training set
-                forecast = model.fit_predict(training, n_periods=days_to_predict)
+            # The cache's counters are for the whole process
+            cache = get_forecast_cache()
+            hits, misses, evictions = cache.hits, cache.misses, cache.evictions
+
+            forecaster = RollingForecaster(days_to_predict, workers=safe_get(ctx, 'forecast_workers', 0))
+            forecasts = forecaster.run(data['LogMovAvgClose'].to_numpy(), windows, cache)
+            log(f"Forecast {len(windows)} days with {forecaster.num_searches} order searches and {forecaster.num_refits} warm refits. Cache: {cache.hits - hits} hits, {cache.misses - misses} misses, {cache.evictions - evictions} evictions", self.tag)
+
+            for offset, day in enumerate(range(start_day, end_day)):
+                forecast = forecasts[offset]
 
                 # Getting the last predicted value from the next N days
                 try:
@@ -221,18 +218,6 @@ class TrendFinder():#AnalyzerBase):
                     log(f"Error predicting future: {e}")
                     pass
 
-                # IN LOOP
-                #try:
-                #    preds[col[9:]] = np.exp(forecast)
-                #    preds[col[9:]].iloc[offset:days_to_predict] = np.exp(forecast[-1])
-                #except Exception as e:
-                #    log(f"Error predicting future: {e}")
-                #    pass
-
-
-                offset = offset + 1
-                # END LOOP
-
         return preds
 
 
@@ -338,12 +323,7 @@ class TrendFinder():#AnalyzerBase):
 
         # Method 2
 
-        dx = 1 #1 day interval
-        d_dx = FinDiff(0, dx, 1)
-        d2_dx2 = FinDiff(0, dx, 2)
-        clarr = np.asarray(closes)
-        mom = d_dx(clarr)
-        momacc = d2_dx2(clarr)
+        mom, momacc = get_momentum(np.asarray(closes, dtype=np.float64))
 
         h = closes#.lolist()
         minimaIdxs, maximaIdxs = get_extrema(h, mom, momacc, True), get_extrema(h, mom, momacc, False)
@@ -384,8 +364,7 @@ class TrendFinder():#AnalyzerBase):
         log(f"extrema3: {(p, r, ymax, pmax, zmxe)}", self.tag)
 
         # TODO: Evaluate these!
-        #mintrend, maxtrend = get_trend(minimaIdxs), get_trend(maximaIdxs)
-        #mintrend, maxtrend = get_trend_opt(minimaIdxs), get_trend_opt(maximaIdxs)
+        mintrend, maxtrend = find_trendlines(closes, minimaIdxs), find_trendlines(closes, maximaIdxs)
         #mintrend, maxtrend = hough(minimaIdxs), hough(maximaIdxs)
         #mintrend, maxtrend = prob_hough(minimaIdxs), prob_hough(maximaIdxs)
 
@@ -453,62 +432,6 @@ def make_image(data, Idxs):
         image[int((h[x] - m) * scl), x] = 255
     return image, tested_angles, scl, m
 
-def get_trend(Idxs):
-    trend = []
-    for x in range(len(Idxs)):
-        for y in range(x+1, len(Idxs)):
-            for z in range(y+1, len(Idxs)):
-                trend.append(([Idxs[x], Idxs[y], Idxs[z]],
-                    get_bestfit3(Idxs[x], h[Idxs[x]],
-                                Idxs[y], h[Idxs[y]],
-                                Idxs[z], h[Idxs[z]])))
-    return list(filter(lambda val: val[1][3] <= fltpct, trend))
-
-def get_trend_opt(Idxs):
-  slopes, trend = [], []
-  for x in range(len(Idxs)): #O(n^2*log n) algorithm
-    slopes.append([])
-    for y in range(x+1, len(Idxs)):
-      slope = (h[Idxs[x]] - h[Idxs[y]]) / (Idxs[x] - Idxs[y])
-      slopes[x].append((slope, y))
-  for x in range(len(Idxs)):
-    slopes[x].sort(key=lambda val: val[0])
-    CurIdxs = [Idxs[x]]
-    for y in range(0, len(slopes[x])):
-      CurIdxs.append(Idxs[slopes[x][y][1]])
-      if len(CurIdxs) < 3: continue
-      res = get_bestfit([(p, h[p]) for p in CurIdxs])
-      if res[3] <= fltpct:
-        CurIdxs.sort()
-        if len(CurIdxs) == 3:
-          trend.append((CurIdxs, res))
-          CurIdxs = list(CurIdxs)
-        else: CurIdxs, trend[-1] = list(CurIdxs), (CurIdxs, res)
-      else: CurIdxs = [CurIdxs[0], CurIdxs[-1]] #restart search
-  return trend
-
-
-#
-# Gets local extrema
-# TODO: Parameterize
-# 
-def get_extrema(h, mom, momacc, isMin=False):
-    return [x for x in range(len(mom))
-    if (momacc[x] > 0 if isMin else momacc[x] < 0) and
-      (mom[x] == 0 or #slope is 0
-        (x != len(mom) - 1 and #check next day
-          (mom[x] > 0 and mom[x+1] < 0 and
-           h[x] >= h[x+1] or
-           mom[x] < 0 and mom[x+1] > 0 and
-           h[x] <= h[x+1]) or
-         x != 0 and #check prior day
-          (mom[x-1] > 0 and mom[x] < 0 and
-           h[x-1] < h[x] or
-           mom[x-1] < 0 and mom[x] > 0 and
-           h[x-1] > h[x])))]
-
-
-
 def agg_min(x):
     print (f"agg {x}")
     if (len(x) < 3):
@@ -0,0 +1,82 @@
+import sys
+import statistics
+import subprocess
+from os import path
+from utils import *
+
+
+#
+# Startup benchmark.
+#
+# Imports each entry point in a fresh interpreter, the way a CLI invocation or a spawned sweep
+# worker would, and checks the median import time against its budget. Heavy optional
+# dependencies (charting, yfinance, trendln) must only load when used, so any that an entry point
+# loads at import time is a failure too.
+#
+# Budgets are in milliseconds on a warm disk cache and leave some headroom; use --budget-scale on
+# slower machines rather than raising them.
+#
+
+# Modules that no entry point may import at startup
+lazy_modules = ['plotly', 'yfinance', 'trendln', 'findiff', 'matplotlib', 'art']
+
+# (entry point, module, import budget in ms, further modules it must not load)
+startup_targets = [
+    ('sm', 'sm', 600, ['binance', 'talib']),
+    ('sweep', 'sweep', 700, ['binance']),
+    ('evolve', 'evolve', 700, ['binance']),
+    ('trade', 'trade', 1600, []),
+    ('fleet', 'fleet', 1600, []),
+]
+
+probe = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+print(elapsed, *[name for name in {watched} if name in sys.modules])
+'''
+
+
+# Imports `module` in a new interpreter. Returns (ms, watched modules that were loaded).
+def measure_import(module, watched):
+    code = probe.format(module=module, watched=repr(watched))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=path.dirname(path.abspath(__file__)))
+    if result.returncode != 0:
+        raise Exception(f"Importing '{module}' failed:\n{result.stderr}")
+
+    fields = result.stdout.strip().splitlines()[-1].split()
+    return float(fields[0]), fields[1:]
+
+
+def run_bench_command(args):
+    runs = max(1, int(args['runs']))
+    scale = float(args['budget_scale'])
+    failures = []
+
+    for name, module, budget, disallowed in startup_targets:
+        watched = lazy_modules + disallowed
+        timings = []
+        loaded = []
+
+        # The first run warms the disk cache and is not counted
+        measure_import(module, watched)
+        for i in range(runs):
+            elapsed, loaded = measure_import(module, watched)
+            timings.append(elapsed)
+
+        median = statistics.median(timings)
+        limit = budget * scale
+        status = 'ok' if median <= limit and len(loaded) == 0 else 'OVER'
+        log(f"{name:8} {median:7.0f} ms (budget {limit:.0f} ms, min {min(timings):.0f} ms) {status}", 'bench')
+
+        if median > limit:
+            failures.append(f"'{name}' took {median:.0f} ms to import, over its {limit:.0f} ms budget")
+
+        if len(loaded) > 0:
+            failures.append(f"'{name}' loads {', '.join(loaded)} at import time")
+
+    if len(failures) > 0:
+        raise Exception("Startup budget exceeded:\n" + '\n'.join(failures))
+
+    log(f"All entry points within budget", 'bench')
@@ -0,0 +1,82 @@
+from utils import *
+
+
+#
+# Builds bars of longer timescales from one stream of closed base bars.
+#
+# Bars are klines in the REST layout (open time, open, high, low, close, volume, close time,
+# quote volume, trades, taker buy base volume, taker buy quote volume). Each subscribed timescale
+# keeps one bar in progress, which every base bar updates in O(1); once the base bar that ends a
+# bucket arrives, the bar is emitted to the timescale's handlers. Buckets are aligned to the epoch,
+# as the exchange's are (UTC midnight for days), so aggregated bars line up with the exchange's.
+#
+# If base bars are missing (e.g. the bot was down), a bar is emitted with what it has when the
+# next bucket starts.
+#
+class BarAggregator:
+    def __init__(self, base = TimeScale.MINUTE):
+        self.base = base
+        self.base_ms = timescale_millis[base]
+        self.handlers = {}
+        self.bars = {}
+
+
+    # Calls `handler(timescale, bar)` for every closed bar of `timescale`
+    def subscribe(self, timescale, handler):
+        if timescale_millis[timescale] % self.base_ms != 0:
+            raise Exception(f"Can't build {timescale.value} bars from {self.base.value} bars")
+
+        self.handlers.setdefault(timescale, []).append(handler)
+        self.bars.setdefault(timescale, None)
+
+
+    def get_timescales(self):
+        return list(self.handlers.keys())
+
+
+    # Gets the bar in progress for a timescale, or None
+    def get_partial(self, timescale):
+        return self.bars.get(timescale)
+
+
+    # Adds a closed base bar
+    def update(self, kline):
+        open_time = to_millis(kline[0])
+
+        for timescale in self.handlers:
+            if timescale == self.base:
+                self.emit(timescale, kline)
+                continue
+
+            ms = timescale_millis[timescale]
+            bucket = open_time - open_time % ms
+            bar = self.bars[timescale]
+
+            if bar is not None and bar[0] != bucket:
+                self.emit(timescale, bar)
+                bar = None
+
+            if bar is None:
+                bar = [bucket, float(kline[1]), float(kline[2]), float(kline[3]), float(kline[4]), 0.0, bucket + ms - 1, 0.0, 0, 0.0, 0.0]
+            else:
+                bar[2] = max(bar[2], float(kline[2]))
+                bar[3] = min(bar[3], float(kline[3]))
+                bar[4] = float(kline[4])
+
+            bar[5] += float(kline[5])
+            bar[7] += float(kline[7])
+            bar[8] += int(float(kline[8]))
+            bar[9] += float(kline[9])
+            bar[10] += float(kline[10])
+
+            # The bucket's last base bar closes it
+            if open_time + self.base_ms >= bucket + ms:
+                self.emit(timescale, bar)
+                bar = None
+
+            self.bars[timescale] = bar
+
+
+    def emit(self, timescale, bar):
+        for handler in self.handlers[timescale]:
+            handler(timescale, bar)
@@ -0,0 +1,193 @@
+import os
+import json
+import time as systime
+from os import path
+from globals import yaml
+from utils import *
+from .Trade import Trade, TradeType
+
+
+# Records between compacted snapshots
+JOURNAL_SNAPSHOT_INTERVAL = 500
+
+# Longest a journal record may sit in the OS cache before it is fsynced, in seconds
+JOURNAL_FSYNC_INTERVAL = 1.0
+
+
+#
+# Write-ahead journal of a bot's state.
+#
+# Rather than rewriting every trade on every change, each trade and each change of the scalar
+# state (FSM state, profit, budget, ...) is appended to `<state>.journal` as one JSON line with a
+# sequence number. Lines are flushed as they are written and fsynced in batches, at most every
+# JOURNAL_FSYNC_INTERVAL seconds, and whenever the journal is synced or compacted.
+#
+# Every JOURNAL_SNAPSHOT_INTERVAL records the full state is written to the state file along with
+# the last sequence number it includes, and the journal is started over. Recovery loads that
+# snapshot and replays the records after it; a torn final line from a crash is ignored.
+#
+# Snapshots are JSON, which is also YAML, so the state file keeps its name and older YAML state
+# files still load. All writes go through the bot's PersistenceWorker, in order.
+#
+class BotJournal:
+    def __init__(self, state_path, persistence, snapshot_interval = JOURNAL_SNAPSHOT_INTERVAL, fsync_interval = JOURNAL_FSYNC_INTERVAL):
+        self.state_path = state_path
+        self.journal_path = path.splitext(state_path)[0] + '.journal'
+        self.persistence = persistence
+        self.snapshot_interval = snapshot_interval
+        self.fsync_interval = fsync_interval
+        self.seq = 0
+        self.num_since_snapshot = 0
+
+        # Only used on the persistence worker
+        self.file = None
+        self.last_fsync = systime.monotonic()
+
+
+    # Loads the last snapshot and replays the journal after it into `state`.
+    # Returns False if there was nothing to load.
+    def load(self, state):
+        snapshot = self.read_snapshot()
+        if snapshot is None and not path.exists(self.journal_path):
+            return False
+
+        if snapshot is not None:
+            state.load_from_yaml(snapshot)
+            self.seq = int(snapshot.get('journal_seq', 0))
+
+        num_replayed = 0
+        if path.exists(self.journal_path):
+            with open(self.journal_path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        log(f"Ignoring torn journal record after #{self.seq} in '{self.journal_path}'")
+                        break
+
+                    if record['seq'] <= self.seq:
+                        continue
+
+                    self.apply(state, record)
+                    self.seq = record['seq']
+                    num_replayed += 1
+
+        self.num_since_snapshot = num_replayed
+        log(f"Loaded {len(state.trades)} trade(s) and replayed {num_replayed} journal record(s)")
+        return True
+
+
+    def read_snapshot(self):
+        if not path.exists(self.state_path):
+            return None
+
+        with open(self.state_path) as file:
+            content = file.read()
+
+        try:
+            return json.loads(content)
+        except ValueError:
+            # Written as YAML before journaling
+            return yaml.load(content)
+
+
+    @staticmethod
+    def apply(state, record):
+        op = record['op']
+        if op == 'trade':
+            trade = Trade(state.symbol, TradeType.BUY)
+            trade.from_yaml(record['trade'])
+
+            index = record['index']
+            if index < len(state.trades):
+                state.trades[index] = trade
+            else:
+                state.trades.append(trade)
+
+        elif op == 'state':
+            state.load_fields(record['values'])
+
+        else:
+            raise Exception(f"Unknown journal record '{op}'")
+
+
+    # Journals the trade at `index` in the state's trades, new or updated
+    def record_trade(self, state, index):
+        trade = state.trades[index]
+        self.append(state, { 'op': 'trade', 'index': index, 'trade': trade.to_yaml(trade) })
+
+
+    # Journals the scalar state
+    def record_state(self, state):
+        self.append(state, { 'op': 'state', 'values': state.get_fields() })
+
+
+    def append(self, state, record):
+        self.seq += 1
+        record['seq'] = self.seq
+        self.persistence.submit(self.write_record, json.dumps(record))
+
+        self.num_since_snapshot += 1
+        if self.num_since_snapshot >= self.snapshot_interval:
+            self.snapshot(state)
+
+
+    # Writes a compacted snapshot of `state` and starts a new journal
+    def snapshot(self, state):
+        content = state.get_yaml()
+        content['journal_seq'] = self.seq
+        self.num_since_snapshot = 0
+        self.persistence.submit(self.write_snapshot, content)
+
+
+    # Blocks until everything journaled so far is on disk
+    def sync(self):
+        self.persistence.submit(self.fsync)
+        self.persistence.flush()
+
+
+    def write_record(self, line):
+        if self.file is None:
+            self.file = open(self.journal_path, 'a')
+
+        self.file.write(line + '\n')
+        self.file.flush()
+
+        if systime.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.fsync()
+
+
+    def fsync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+        self.last_fsync = systime.monotonic()
+
+
+    def write_snapshot(self, content):
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(content, file)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_path, self.state_path)
+
+        # Records up to the snapshot are no longer needed
+        if self.file is not None:
+            self.file.close()
+
+        self.file = open(self.journal_path, 'w')
+        self.last_fsync = systime.monotonic()
+
+
+    def close(self):
+        self.persistence.submit(self.close_file)
+        self.persistence.flush()
+
+
+    def close_file(self):
+        if self.file is not None:
+            self.fsync()
+            self.file.close()
+            self.file = None
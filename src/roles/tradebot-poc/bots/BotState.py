@@ -1,4 +1,5 @@
 from .Trade import Trade, TradeState, TradeType
+from .TradeLedger import TradeLedger
 from enum import IntEnum
 from utils import *
 import globals
@@ -52,7 +53,7 @@ class BotState:
         self.default_trade_pct = 0.01
         self.target_yield_pct = 0.01
         self.total_profit = 0
-        self.trades = []
+        self.trades = TradeLedger()
         self.events = []
         self.exch_fee_base = 0
         self.exch_fee_pct = 0.001 # Binance
@@ -68,10 +69,7 @@ class BotState:
     def load_from_yaml(self, yaml):
         self.name = safe_get(yaml, 'name', 'bot')
         self.genetics = safe_get(yaml, 'genetics', None)
-        self.budget = float(safe_get(yaml, 'budget', 0.0))
-        self.default_trade_pct = float(safe_get(yaml, 'default_trade_pct', 0.1))
-        self.saved_fsm_state = FsmState(int(safe_get(yaml, 'saved_fsm_state', FsmState.INIT)))
-        self.total_profit = float(safe_get(yaml, 'total_profit', 0))
+        self.load_fields(yaml)
         self.exch_fee_base = float(safe_get(yaml, 'exch_fee_base', BINANCE_FEE_BASE))
         self.exch_fee_pct = float(safe_get(yaml, 'exch_fee_pct', BINANCE_FEE_PCT))
         self.symbol = safe_get(yaml, 'symbol')
@@ -87,14 +85,29 @@ class BotState:
 
         return
 
-    def get_portfolio(self):
-        total = 0;
 
-        # TODO: Implement
-        # ... Add up buy pairs
-        for t in self.trades:
-            if t.type == TradeType.Buy:
-                total += 0
+    # Loads the scalar state that changes while trading, as journaled
+    def load_fields(self, yaml):
+        self.budget = float(safe_get(yaml, 'budget', 0.0))
+        self.default_trade_pct = float(safe_get(yaml, 'default_trade_pct', 0.1))
+        self.saved_fsm_state = FsmState(int(safe_get(yaml, 'saved_fsm_state', FsmState.INIT)))
+        self.total_profit = float(safe_get(yaml, 'total_profit', 0))
+        if 'target_yield_pct' in yaml:
+            self.target_yield_pct = float(yaml['target_yield_pct'])
+
+
+    def get_fields(self):
+        d = {}
+        d['saved_fsm_state'] = int(self.saved_fsm_state)
+        d['budget'] = self.budget
+        d['default_trade_pct'] = self.default_trade_pct
+        d['total_profit'] = self.total_profit
+        d['target_yield_pct'] = self.target_yield_pct
+        return d
+
+
+    def get_portfolio(self):
+        # TODO: Implement, e.g. with self.trades.get_open_position()
 
         # TEMP
         return self.total_profit
@@ -106,11 +119,7 @@ class BotState:
         d['genetics'] = self._genotype.to_string(full=True)
         d['genetics_short'] = self._genotype.to_string(full=False)
         d['symbol'] = self.symbol
-        d['saved_fsm_state'] = int(self.saved_fsm_state)
-        d['budget'] = self.budget
-        d['default_trade_pct'] = self.default_trade_pct
-        d['total_profit'] = self.total_profit
-        d['target_yield_pct'] = self.target_yield_pct
+        d.update(self.get_fields())
         d['exch_base_fee'] = self.exch_fee_base
         d['exch_base_pct'] = self.exch_fee_pct
         d['symbol_base'] = self.symbol_base.to_yaml()
@@ -0,0 +1,272 @@
+import math
+from collections import deque
+
+
+#
+# Streaming indicators.
+#
+# Each indicator consumes closed intervals through commit() in constant time, and can be asked what
+# its value *would be* if a given price closed the current interval through evaluate(). evaluate()
+# never mutates committed state, which lets the bot rate every in-progress tick against the same
+# history without copying it.
+#
+# Seeding and operation order follow TA-Lib so that values match talib.RSI/BBANDS/SMA/EMA run over
+# the same closes.
+#
+# commit_many() commits a run of closes at once, e.g. a run-in. Window indicators only look at the
+# closes that are still in their window; recursive ones run their recurrence over plain floats.
+#
+
+
+# Wilder-smoothed RSI. Seeded with the simple average of the first `period` changes.
+class StreamingRsi:
+    def __init__(self, period=14):
+        self.period = period
+        self.count = 0
+        self.prev_close = None
+        self.avg_gain = 0.0
+        self.avg_loss = 0.0
+        self.value = math.nan
+
+
+    def _next(self, close):
+        gain, loss = self.avg_gain, self.avg_loss
+        count = self.count + 1
+
+        if self.prev_close is None:
+            return gain, loss, count
+
+        diff = close - self.prev_close
+        period = self.period
+
+        if count <= period + 1:
+            # Still accumulating the seed window
+            if diff < 0:
+                loss -= diff
+            else:
+                gain += diff
+
+            if count == period + 1:
+                gain /= period
+                loss /= period
+        else:
+            gain *= (period - 1)
+            loss *= (period - 1)
+            if diff < 0:
+                loss -= diff
+            else:
+                gain += diff
+            gain /= period
+            loss /= period
+
+        return gain, loss, count
+
+
+    def _rsi(self, gain, loss, count):
+        if count <= self.period:
+            return math.nan
+
+        total = gain + loss
+        if total == 0:
+            return 0.0
+
+        return 100.0 * (gain / total)
+
+
+    def commit(self, close):
+        self.avg_gain, self.avg_loss, self.count = self._next(close)
+        self.prev_close = close
+        self.value = self._rsi(self.avg_gain, self.avg_loss, self.count)
+        return self.value
+
+
+    def evaluate(self, price):
+        gain, loss, count = self._next(price)
+        return self._rsi(gain, loss, count)
+
+
+    def commit_many(self, closes):
+        for close in closes:
+            self.avg_gain, self.avg_loss, self.count = self._next(close)
+            self.prev_close = close
+
+        self.value = self._rsi(self.avg_gain, self.avg_loss, self.count)
+        return self.value
+
+
+# Simple moving average over the last `period` closes
+class StreamingSma:
+    def __init__(self, period):
+        self.period = period
+        self.window = deque()
+        self.partial = 0.0
+        self.value = math.nan
+
+
+    def _mean(self, price):
+        if len(self.window) < self.period - 1:
+            return math.nan
+
+        return (self.partial + price) / self.period
+
+
+    def commit(self, close):
+        self.value = self._mean(close)
+        self.partial += close
+        self.window.append(close)
+
+        if len(self.window) >= self.period:
+            self.partial -= self.window.popleft()
+
+        return self.value
+
+
+    def evaluate(self, price):
+        return self._mean(price)
+
+
+    def commit_many(self, closes):
+        for close in closes[-self.period:]:
+            self.commit(close)
+
+        return self.value
+
+
+# Exponential moving average, seeded with the SMA of the first `period` closes
+class StreamingEma:
+    def __init__(self, period):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.count = 0
+        self.seed = 0.0
+        self.value = math.nan
+
+
+    def _next(self, price):
+        count = self.count + 1
+
+        if count < self.period:
+            return math.nan
+        elif count == self.period:
+            return (self.seed + price) / self.period
+        else:
+            return ((price - self.value) * self.k) + self.value
+
+
+    def commit(self, close):
+        value = self._next(close)
+        self.count += 1
+
+        if self.count < self.period:
+            self.seed += close
+
+        self.value = value
+        return value
+
+
+    def evaluate(self, price):
+        return self._next(price)
+
+
+    def commit_many(self, closes):
+        for close in closes:
+            self.commit(close)
+
+        return self.value
+
+
+# Bollinger bands: SMA middle band +/- `nbdev` population standard deviations
+class StreamingBollinger:
+    def __init__(self, period=5, nbdevup=2.0, nbdevdn=2.0):
+        self.period = period
+        self.nbdevup = nbdevup
+        self.nbdevdn = nbdevdn
+        self.window = deque()
+        self.partial = 0.0
+        self.value = (math.nan, math.nan, math.nan)
+
+
+    def _bands(self, price):
+        if len(self.window) < self.period - 1:
+            return (math.nan, math.nan, math.nan)
+
+        period = self.period
+        middle = (self.partial + price) / period
+
+        # Two-pass variance over the (small) window. Running sums of squares lose most of their
+        # precision at typical crypto price levels.
+        variance = (price - middle) ** 2
+        for close in self.window:
+            variance += (close - middle) ** 2
+
+        stddev = math.sqrt(variance / period)
+
+        return (middle + stddev * self.nbdevup, middle, middle - stddev * self.nbdevdn)
+
+
+    def commit(self, close):
+        self.value = self._bands(close)
+        self.partial += close
+        self.window.append(close)
+
+        if len(self.window) >= self.period:
+            self.partial -= self.window.popleft()
+
+        return self.value
+
+
+    def evaluate(self, price):
+        return self._bands(price)
+
+
+    def commit_many(self, closes):
+        for close in closes[-self.period:]:
+            self.commit(close)
+
+        return self.value
+
+
+#
+# A named set of streaming indicators that are committed and evaluated together.
+#
+class IndicatorEngine:
+    def __init__(self):
+        self.indicators = {}
+        self.num_committed = 0
+
+
+    def add(self, name, indicator):
+        self.indicators[name] = indicator
+        return indicator
+
+
+    # Commits a closed interval to every indicator
+    def commit(self, close):
+        for indicator in self.indicators.values():
+            indicator.commit(close)
+
+        self.num_committed += 1
+
+
+    # Commits many closed intervals, oldest first
+    def commit_many(self, closes):
+        closes = [float(close) for close in closes]
+        for indicator in self.indicators.values():
+            indicator.commit_many(closes)
+
+        self.num_committed += len(closes)
+
+
+    # Returns the values every indicator would have if `price` closed the current interval.
+    # Committed state is left untouched.
+    def evaluate(self, price):
+        return { name: indicator.evaluate(price) for name, indicator in self.indicators.items() }
+
+
+    # The latest committed value of a single indicator
+    def value(self, name):
+        return self.indicators[name].value
+
+
+    def values(self):
+        return { name: indicator.value for name, indicator in self.indicators.items() }
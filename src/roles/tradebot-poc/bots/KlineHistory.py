@@ -0,0 +1,184 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+from utils import to_millis
+
+
+hist_columns = ['open-time', 'open', 'close', 'low', 'high', 'volume', 'close-time', 'quote-asset-volume', 'num-trades', 'taker-buy-base-volume', 'taker-buy-quote-volume', 'event', 'event-description']
+
+# Typed storage for the numeric history columns. Times are Unix epoch millis.
+hist_dtypes = {
+    'open-time': np.int64,
+    'open': np.float64,
+    'close': np.float64,
+    'low': np.float64,
+    'high': np.float64,
+    'volume': np.float64,
+    'close-time': np.int64,
+    'quote-asset-volume': np.float64,
+    'num-trades': np.int64,
+    'taker-buy-base-volume': np.float64,
+    'taker-buy-quote-volume': np.float64,
+}
+
+# Columns of REST klines, in order
+kline_columns = ['open-time', 'open', 'high', 'low', 'close', 'volume', 'close-time', 'quote-asset-volume', 'num-trades', 'taker-buy-base-volume', 'taker-buy-quote-volume']
+
+# Numeric fields of kline stream payloads, as captured for replay
+tick_dtypes = {
+    't': np.int64,
+    'T': np.int64,
+    'o': np.float64,
+    'c': np.float64,
+    'h': np.float64,
+    'l': np.float64,
+    'v': np.float64,
+    'n': np.int64,
+    'x': np.bool_,
+    'q': np.float64,
+    'V': np.float64,
+    'Q': np.float64,
+}
+
+# Length of a history interval, in millis
+HISTORY_INTERVAL_MS = 60 * 1000
+
+# Retention policy: Wilder-smoothed indicators take ~10 periods to shed their seed, so keep
+# at least that much warm-up for the longest indicator period
+HISTORY_WARMUP_FACTOR = 10
+HISTORY_MIN_CAPACITY = 1000
+
+
+# Gets the number of intervals a bot must retain to support indicators up to `longest_period`
+def required_history_capacity(longest_period, warmup_factor = HISTORY_WARMUP_FACTOR):
+    return max(HISTORY_MIN_CAPACITY, int(longest_period) * warmup_factor)
+
+
+# Gets a kline stream payload as a row in the layout of REST klines, as intake expects
+def get_kline_from_stream(pl):
+    return [pl['t'], pl['o'], pl['h'], pl['l'], pl['c'], pl['v'], pl['T'], pl['q'], pl['n'], pl['V'], pl['Q']]
+
+
+
+# Gets a kline in the REST layout as a history row
+def get_history_row(kl):
+    return {
+        'open-time': to_millis(kl[0]),
+        'open': float(kl[1]),
+        'high': float(kl[2]),
+        'low': float(kl[3]),
+        'close': float(kl[4]),
+        'volume': float(kl[5]),
+        'close-time': to_millis(kl[6]),
+        'quote-asset-volume': float(kl[7]),
+        'num-trades': int(float(kl[8])),
+        'taker-buy-base-volume': float(kl[9]),
+        'taker-buy-quote-volume': float(kl[10]),
+    }
+
+
+# Converts a list of klines in the REST layout (numbers or numeric strings) to typed history
+# columns in one pass
+def get_kline_columns(data):
+    if len(data) == 0:
+        return { name: np.zeros(0, dtype=hist_dtypes[name]) for name in kline_columns }
+
+    table = np.asarray([row[:len(kline_columns)] for row in data])
+    columns = {}
+    for ix, name in enumerate(kline_columns):
+        values = table[:, ix]
+        if hist_dtypes[name] == np.int64 and values.dtype.kind == 'U':
+            values = values.astype(np.float64)
+
+        columns[name] = values.astype(hist_dtypes[name])
+
+    return columns
+
+
+#
+# Fixed-capacity columnar ring buffer of klines.
+#
+# Each column is stored twice back-to-back (a "mirrored" ring), so the most recent N rows are always
+# one contiguous slice. This lets window() hand out zero-copy NumPy views regardless of where the
+# write head is. Appends are O(1) and the oldest rows are overwritten once capacity is reached.
+#
+class KlineHistory:
+    def __init__(self, capacity = HISTORY_MIN_CAPACITY):
+        if capacity < 1:
+            raise Exception(f"Invalid history capacity {capacity}")
+
+        self.capacity = capacity
+        self.head = 0
+        self.num_appended = 0
+        self.columns = { name: np.zeros(capacity * 2, dtype=dtype) for name, dtype in hist_dtypes.items() }
+
+
+    def __len__(self):
+        return min(self.num_appended, self.capacity)
+
+
+    # Appends a row. Values are keyed by column name; times must already be epoch millis.
+    def append(self, row):
+        head = self.head
+        mirror = head + self.capacity
+
+        for name, column in self.columns.items():
+            value = row[name]
+            column[head] = value
+            column[mirror] = value
+
+        self.head = (head + 1) % self.capacity
+        self.num_appended += 1
+
+
+    # Appends many rows at once. `columns` maps every column name to an array of equal length.
+    # Only the last `capacity` rows are kept, as with append.
+    def extend(self, columns):
+        n = len(columns['open-time'])
+        if n == 0:
+            return
+
+        kept = min(n, self.capacity)
+        ix = (self.head + np.arange(n - kept, n)) % self.capacity
+
+        for name, column in self.columns.items():
+            values = columns[name][n - kept:]
+            column[ix] = values
+            column[ix + self.capacity] = values
+
+        self.head = (self.head + n) % self.capacity
+        self.num_appended += n
+
+
+    # Gets a read-only, zero-copy view of the last `n` values of a column (all retained rows if None)
+    def window(self, name, n = None):
+        size = len(self)
+        if n is None or n > size:
+            n = size
+
+        end = self.head + self.capacity
+        view = self.columns[name][end - n:end]
+        view.flags.writeable = False
+        return view
+
+
+    # Gets the most recent value of a column, or None if the buffer is empty
+    def last(self, name):
+        if self.num_appended == 0:
+            return None
+
+        return self.columns[name][self.head + self.capacity - 1]
+
+
+    # Materializes the retained rows (or the last `n`) as a DataFrame in the `hist_columns` layout
+    def to_frame(self, n = None):
+        data = {}
+        for name in hist_columns:
+            if name in ['open-time', 'close-time']:
+                data[name] = [dt.datetime.fromtimestamp(t / 1000) for t in self.window(name, n).tolist()]
+            elif name in self.columns:
+                data[name] = self.window(name, n).copy()
+            else:
+                data[name] = ''
+
+        return pd.DataFrame(data, columns=hist_columns)
@@ -0,0 +1,172 @@
+import uuid
+import time as systime
+from utils import *
+
+
+# Seconds between reconciliation polls of in-flight orders, in case a user data event is missed
+ORDER_RECONCILE_INTERVAL = 30
+
+# Statuses after which an order no longer changes
+# https://github.com/binance/binance-spot-api-docs/blob/master/enums.md#order-status-status
+terminal_order_statuses = ['FILLED', 'CANCELED', 'REJECTED', 'EXPIRED', 'EXPIRED_IN_MATCH']
+
+
+#
+# An order placed by a bot, as last reported by the exchange.
+#
+class TrackedOrder:
+    __slots__ = ['client_order_id', 'order_id', 'symbol', 'side', 'price', 'quantity', 'status',
+                 'filled_quantity', 'filled_quote', 'commission', 'commission_asset', 'update_time']
+
+    def __init__(self, client_order_id, symbol, side, price, quantity):
+        self.client_order_id = client_order_id
+        self.order_id = ''
+        self.symbol = symbol
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.status = 'NEW'
+        self.filled_quantity = 0.0
+        self.filled_quote = 0.0
+        self.commission = 0.0
+        self.commission_asset = None
+        self.update_time = 0
+
+
+    def is_done(self):
+        return self.status in terminal_order_statuses
+
+
+    # Average fill price, or the order price if nothing has filled yet
+    def get_avg_price(self):
+        if self.filled_quantity <= 0:
+            return self.price
+
+        return self.filled_quote / self.filled_quantity
+
+
+#
+# Book of a bot's in-flight orders, keyed by the client order id the bot assigns when placing them.
+#
+# Orders are updated from `executionReport` events on the user data stream as they happen, so
+# the bot doesn't have to poll the exchange while it waits for a fill. Every
+# ORDER_RECONCILE_INTERVAL seconds the orders still open are also queried over REST, which
+# recovers from events missed while the user data socket was reconnecting.
+#
+# Updates are applied only when they are newer than what is known, so a poll racing an event
+# can't move an order backwards.
+#
+class OrderTracker:
+    def __init__(self, tag = 'orders', reconcile_interval = ORDER_RECONCILE_INTERVAL):
+        self.tag = tag
+        self.reconcile_interval = reconcile_interval
+        self.orders = {}
+        self.last_reconcile = systime.monotonic()
+        self.num_events = 0
+        self.num_polls = 0
+
+
+    # Makes a client order id. Binance allows up to 36 characters of [.A-Za-z0-9:/_-].
+    def new_client_order_id(self, side):
+        return f"sm-{side.lower()}-{uuid.uuid4().hex[:24]}"
+
+
+    def track(self, client_order_id, symbol, side, price, quantity):
+        order = TrackedOrder(client_order_id, symbol, side, price, quantity)
+        self.orders[client_order_id] = order
+        return order
+
+
+    def get(self, client_order_id):
+        return self.orders.get(client_order_id)
+
+
+    # Stops tracking an order, e.g. once its fill has been handled
+    def forget(self, client_order_id):
+        self.orders.pop(client_order_id, None)
+
+
+    def get_open_orders(self):
+        return [order for order in self.orders.values() if not order.is_done()]
+
+
+    # Applies an executionReport. Returns the order if it is ours and changed, else None.
+    # https://github.com/binance/binance-spot-api-docs/blob/master/user-data-stream.md#order-update
+    def on_exec_report(self, msg):
+        # Cancels report the order being cancelled as the original client order id
+        client_order_id = msg['C'] if msg['x'] == 'CANCELED' and msg.get('C') else msg['c']
+        order = self.orders.get(client_order_id)
+        if order is None:
+            return None
+
+        self.num_events += 1
+        update_time = int(msg['T'])
+        filled_quantity = float(msg['z'])
+        if not self.is_newer(order, update_time, filled_quantity, msg['X']):
+            return None
+
+        order.order_id = str(msg['i'])
+        order.status = msg['X']
+        order.filled_quantity = filled_quantity
+        order.filled_quote = float(msg['Z'])
+        order.update_time = update_time
+
+        # Commission is reported per execution
+        if msg['x'] == 'TRADE':
+            order.commission += float(msg['n'])
+            order.commission_asset = msg['N']
+
+        return order
+
+
+    # Applies an order as returned by the REST API. Returns the order if it changed, else None.
+    def on_order(self, response):
+        order = self.orders.get(response['clientOrderId'])
+        if order is None:
+            return None
+
+        update_time = int(response.get('updateTime', response.get('transactTime', 0)))
+        filled_quantity = float(response['executedQty'])
+        if not self.is_newer(order, update_time, filled_quantity, response['status']):
+            return None
+
+        order.order_id = str(response['orderId'])
+        order.status = response['status']
+        order.filled_quantity = filled_quantity
+        order.filled_quote = float(response['cummulativeQuoteQty'])
+        order.update_time = update_time
+        return order
+
+
+    def is_newer(self, order, update_time, filled_quantity, status):
+        if order.is_done():
+            return False
+
+        if filled_quantity < order.filled_quantity or update_time < order.update_time:
+            return False
+
+        return status != order.status or filled_quantity != order.filled_quantity
+
+
+    def is_reconcile_due(self):
+        return len(self.get_open_orders()) > 0 and systime.monotonic() - self.last_reconcile >= self.reconcile_interval
+
+
+    # Polls the exchange for every open order. Returns the orders that changed.
+    async def reconcile(self, client, api_symbol):
+        self.last_reconcile = systime.monotonic()
+        changed = []
+
+        for order in self.get_open_orders():
+            self.num_polls += 1
+            try:
+                response = await client.get_order(symbol=api_symbol, origClientOrderId=order.client_order_id)
+            except Exception as e:
+                log(f"Could not check order '{order.client_order_id}': {e}", self.tag)
+                continue
+
+            if self.on_order(response) is not None:
+                log(f"Order '{order.client_order_id}' was {order.status} (caught by reconciliation)", self.tag)
+                changed.append(order)
+
+        return changed
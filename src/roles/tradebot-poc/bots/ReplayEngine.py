@@ -0,0 +1,269 @@
+import os
+import datetime as dt
+import numpy as np
+import pandas as pd
+from os import path
+from utils import *
+from storage import ColumnarFile, COLUMNAR_EXT
+
+from .BotState import FsmState
+from .Trade import Trade, TradeType
+from .TradeLedger import TradeLedger, get_round_trip_profits
+from .IndicatorEngine import StreamingRsi, StreamingBollinger
+from .Signals import TradeSignal, SignalParams, evaluate_signal, get_buy_quantity, get_sell_profit, SIGNAL_RSI_PERIOD, SIGNAL_BOLLINGER_PERIOD, SIGNAL_BOLLINGER_NBDEV
+
+
+#
+# Captured history + ticks for a backtest, loaded once into typed arrays.
+#
+class BacktestData:
+    def __init__(self, name, history_open_time, history_close, tick_time, tick_price, tick_closed):
+        self.name = name
+
+        # Closed intervals: open time (epoch millis) and close price
+        self.history_open_time = history_open_time
+        self.history_close = history_close
+
+        # Ticks: kline open time (epoch millis), last price and whether the tick closed its kline
+        self.tick_time = tick_time
+        self.tick_price = tick_price
+        self.tick_closed = tick_closed
+
+
+    # Index of the first history row that overlaps the ticks, i.e. the end of the run-in period
+    def get_runin_end(self):
+        if len(self.tick_time) == 0:
+            return len(self.history_open_time)
+
+        return int(np.searchsorted(self.history_open_time, self.tick_time[0], side='left'))
+
+
+def get_backtest_paths(backtest_name, ext = '.csv'):
+    root = path.join(os.getcwd(), 'data', 'training-data', backtest_name)
+    return root + '-history' + ext, root + '-ticks' + ext
+
+
+# Loads a captured backtest (see TradeBot capture mode). Columnar captures are preferred over CSVs.
+def load_backtest_data(backtest_name) -> BacktestData:
+    history_path, ticks_path = get_backtest_paths(backtest_name, COLUMNAR_EXT)
+    if path.exists(history_path) and path.exists(ticks_path):
+        history = ColumnarFile(history_path).read(['open-time', 'close'])
+        ticks = ColumnarFile(ticks_path).read(['t', 'c', 'x'])
+        return BacktestData(backtest_name, history['open-time'], history['close'], ticks['t'], ticks['c'], ticks['x'])
+
+    history_path, ticks_path = get_backtest_paths(backtest_name)
+
+    try:
+        history = pd.read_csv(history_path, usecols=['open-time', 'close'])
+        ticks = pd.read_csv(ticks_path, usecols=lambda c: c in ['t', 'c', 'x'])
+
+    except Exception as e:
+        log(f"Could not run backtest '{backtest_name}'. Verify that both paths exists and are valid backtesting materials: {history_path}, {ticks_path}")
+        raise
+
+    # History times are written as local date strings
+    history_open_time = history['open-time']
+    if history_open_time.dtype.kind in 'iu':
+        history_open_time = history_open_time.to_numpy(dtype=np.int64)
+    else:
+        history_open_time = np.array([to_millis(t) for t in history_open_time.tolist()], dtype=np.int64)
+
+    if 'x' in ticks:
+        tick_closed = ticks['x'].to_numpy(dtype=bool)
+    else:
+        tick_closed = np.zeros(len(ticks), dtype=bool)
+
+    return BacktestData(
+        backtest_name,
+        history_open_time,
+        history['close'].to_numpy(dtype=np.float64),
+        ticks['t'].to_numpy(dtype=np.int64),
+        ticks['c'].to_numpy(dtype=np.float64),
+        tick_closed)
+
+
+#
+# Results of a replay. Trades are kept as plain tuples of (tick index, time, type, price, quantity)
+# and only turned into Trade objects on request.
+#
+class ReplayResult:
+    def __init__(self):
+        self.trades = []
+        self.total_profit = 0.0
+        self.num_ticks = 0
+        self.elapsed = 0.0
+        self.fsm_state = FsmState.READY
+
+
+    def get_ticks_per_sec(self):
+        if self.elapsed <= 0:
+            return 0
+
+        return self.num_ticks / self.elapsed
+
+
+    # Profit of each completed buy/sell round trip, in order
+    def get_realized_profits(self):
+        ix, trade_time, trade_type, price, quantity = self.get_arrays()
+        closing, profits = get_round_trip_profits(trade_type, price, quantity, price * quantity, np.zeros(len(price)))
+        return profits
+
+
+    # Gets the trades as arrays of (tick index, time, type, price, quantity)
+    def get_arrays(self):
+        if len(self.trades) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8),
+                    np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float64))
+
+        ix, trade_time, trade_type, price, quantity = zip(*self.trades)
+        return (np.asarray(ix, dtype=np.int64), np.asarray(trade_time, dtype=np.int64), np.asarray(trade_type, dtype=np.int8),
+                np.asarray(price, dtype=np.float64), np.asarray(quantity, dtype=np.float64))
+
+
+    # Largest peak-to-trough drop of the marked-to-market equity curve. `prices` is the series the
+    # trade indices refer to (ticks for a replay, closes for an interval backtest).
+    def get_max_drawdown(self, prices):
+        prices = np.asarray(prices, dtype=np.float64)
+        if len(prices) == 0 or len(self.trades) == 0:
+            return 0.0
+
+        equity = np.zeros(len(prices))
+        realized = np.zeros(len(prices))
+        entry = None
+
+        for ix, trade_time, trade_type, price, quantity in self.trades:
+            if trade_type == TradeType.BUY:
+                entry = (ix, price)
+            elif entry is not None:
+                equity[entry[0]:ix] += (prices[entry[0]:ix] - entry[1]) * quantity
+                realized[ix] += get_sell_profit(entry[1], quantity, price)
+                entry = None
+
+        # Still holding at the end
+        if entry is not None:
+            equity[entry[0]:] += (prices[entry[0]:] - entry[1]) * quantity
+
+        equity += np.cumsum(realized)
+        equity = np.concatenate([[0.0], equity])
+        return float(np.max(np.maximum.accumulate(equity) - equity))
+
+
+    def to_ledger(self, symbol):
+        ix, trade_time, trade_type, price, quantity = self.get_arrays()
+        gross = np.where(trade_type == TradeType.BUY, -(price * quantity), price * quantity)
+        return TradeLedger.from_arrays(symbol, type=trade_type, time=trade_time, price=price, quantity=quantity,
+                                       gross=gross, stop=price, limit=price)
+
+
+    def to_trades(self, symbol):
+        trades = []
+        for ix, trade_time, trade_type, price, quantity in self.trades:
+            trade = Trade(symbol, trade_type)
+            trade.time = dt.datetime.fromtimestamp(trade_time / 1000)
+            trade.price = price
+            trade.quantity = quantity
+            trade.stop = price
+            trade.limit = price
+
+            if trade_type == TradeType.BUY:
+                trade.gross = -(price * quantity)
+            else:
+                trade.gross = price * quantity
+
+            trades.append(trade)
+
+        return trades
+
+
+#
+# Replays captured ticks through the bot's trading rules without the async/REST/logging machinery
+# of TradeBot.handle_symbol_tick. Orders are assumed to fill immediately at the tick price.
+#
+class ReplayEngine:
+    def __init__(self, params: SignalParams, budget, default_trade_pct):
+        self.params = params
+        self.budget = budget
+        self.default_trade_pct = default_trade_pct
+
+
+    @staticmethod
+    def from_state(state):
+        return ReplayEngine(SignalParams.from_state(state), state.budget, state.default_trade_pct)
+
+
+    # Replays the ticks of a backtest after running in on the history that precedes them
+    def run(self, data: BacktestData) -> ReplayResult:
+        runin_end = data.get_runin_end()
+        return self.replay(data.history_close[:runin_end], data.tick_time, data.tick_price, data.tick_closed)
+
+
+    # Replays closed intervals only, treating each close as a single tick
+    def run_intervals(self, open_time, close) -> ReplayResult:
+        return self.replay([], open_time, close, np.ones(len(close), dtype=bool))
+
+
+    def replay(self, runin_close, tick_time, tick_price, tick_closed) -> ReplayResult:
+        perf_start = dt.datetime.now()
+
+        rsi = StreamingRsi(SIGNAL_RSI_PERIOD)
+        bollinger = StreamingBollinger(SIGNAL_BOLLINGER_PERIOD, SIGNAL_BOLLINGER_NBDEV, SIGNAL_BOLLINGER_NBDEV)
+
+        for close in np.asarray(runin_close, dtype=np.float64).tolist():
+            rsi.commit(close)
+            bollinger.commit(close)
+
+        result = ReplayResult()
+        params = self.params
+        fsm_state = FsmState.READY
+        prev_trade_price = None
+        position_quantity = 0.0
+
+        # Plain lists are much faster to walk than NumPy scalars
+        times = np.asarray(tick_time).tolist()
+        prices = np.asarray(tick_price, dtype=np.float64).tolist()
+        closed = np.asarray(tick_closed, dtype=bool).tolist()
+
+        interval_time = times[0] if len(times) > 0 else None
+        interval_committed = False
+        prev_price = None
+
+        for ix in range(len(prices)):
+            event_time = times[ix]
+            price = prices[ix]
+
+            # A new kline started. Commit the previous one at its last price unless the stream
+            # already flagged it as closed.
+            if event_time != interval_time:
+                if not interval_committed and prev_price is not None:
+                    rsi.commit(prev_price)
+                    bollinger.commit(prev_price)
+
+                interval_time = event_time
+                interval_committed = False
+
+            upper, _, lower = bollinger.evaluate(price)
+            signal = evaluate_signal(fsm_state, params, price, rsi.evaluate(price), upper, lower, prev_trade_price)
+
+            if signal == TradeSignal.BUY:
+                position_quantity = get_buy_quantity(self.budget, self.default_trade_pct, price)
+                result.trades.append((ix, event_time, TradeType.BUY, price, position_quantity))
+                prev_trade_price = price
+                fsm_state = FsmState.WAITING_FOR_SELL_OPP
+
+            elif signal == TradeSignal.SELL:
+                result.trades.append((ix, event_time, TradeType.SELL, price, position_quantity))
+                result.total_profit += get_sell_profit(prev_trade_price, position_quantity, price)
+                prev_trade_price = price
+                fsm_state = FsmState.WAITING_FOR_BUY_OPP
+
+            if closed[ix] and not interval_committed:
+                rsi.commit(price)
+                bollinger.commit(price)
+                interval_committed = True
+
+            prev_price = price
+
+        result.num_ticks = len(prices)
+        result.fsm_state = fsm_state
+        result.elapsed = (dt.datetime.now() - perf_start).total_seconds()
+        return result
@@ -0,0 +1,101 @@
+from enum import IntEnum
+from .BotState import FsmState
+
+
+#
+# The RSI/Bollinger entry and exit rules, shared by the live bot, the replay engine and the
+# vectorized backtester so they can never drift apart.
+#
+
+# Indicator settings the rules are evaluated against. The Bollinger bands are TA-Lib's defaults,
+# which the bot has always traded on (talib.BBANDS with no arguments).
+SIGNAL_RSI_PERIOD = 6
+SIGNAL_BOLLINGER_PERIOD = 20
+SIGNAL_BOLLINGER_NBDEV = 2.0
+
+# Genes read by the rules. Other genes have no effect on a backtest.
+SIGNAL_GENES = ['RSIL', 'RSIH', 'BBBBO', 'BBSBO']
+
+
+class TradeSignal(IntEnum):
+    NONE = 0
+    BUY = 1
+    SELL = 2
+
+
+# The genes and settings the trading rules depend on
+class SignalParams:
+    def __init__(self, rsi_low, rsi_high, bb_buy_breakouts_only, bb_sell_breakouts_only, target_yield_pct):
+        self.rsi_low = rsi_low
+        self.rsi_high = rsi_high
+        self.bb_buy_breakouts_only = bb_buy_breakouts_only
+        self.bb_sell_breakouts_only = bb_sell_breakouts_only
+        self.target_yield_pct = target_yield_pct
+
+
+    @staticmethod
+    def from_state(state):
+        return SignalParams(
+            state.get('RSIL'),
+            state.get('RSIH'),
+            state.get('BBBBO'),
+            state.get('BBSBO'),
+            state.target_yield_pct)
+
+
+    @staticmethod
+    def from_genotype(genotype, target_yield_pct):
+        return SignalParams(
+            genotype.get_value('RSIL'),
+            genotype.get_value('RSIH'),
+            genotype.get_value('BBBBO'),
+            genotype.get_value('BBSBO'),
+            target_yield_pct)
+
+
+# Rates a price against the indicators.
+# `prev_trade_price` is the price of the bot's previous trade, or None if it has not traded yet.
+def evaluate_signal(fsm_state, params, price, rsi, bollinger_upper, bollinger_lower, prev_trade_price):
+
+    # RSI opportunity
+    if rsi < params.rsi_low:
+
+        # BUY LOW !!!
+        if fsm_state == FsmState.READY or fsm_state == FsmState.WAITING_FOR_BUY_OPP:
+            if params.bb_buy_breakouts_only and not price < bollinger_lower:
+                return TradeSignal.NONE
+
+            return TradeSignal.BUY
+
+    elif rsi >= params.rsi_high:
+
+        # Even if RSI indicates a sell signal, the price may be lower than the previous.
+        # An example would be in a sharp downturn, where mean reversions and even possibly
+        # positive Bollinger escape might be lower than the buy in price due to steep slope.
+        if prev_trade_price is None:
+            return TradeSignal.NONE
+
+        # Ensure we're selling at or above target
+        # TODO: Fees. Handle exit states / adaptive stop-loss mode.
+        target_floor = prev_trade_price + (prev_trade_price * params.target_yield_pct)
+        if price <= target_floor:
+            return TradeSignal.NONE
+
+        if fsm_state == FsmState.WAITING_FOR_SELL_OPP:
+            if params.bb_sell_breakouts_only and not price > bollinger_upper:
+                return TradeSignal.NONE
+
+            return TradeSignal.SELL
+
+    return TradeSignal.NONE
+
+
+# Quantity to buy at `price`, using the bot's default wager of its budget
+def get_buy_quantity(budget, default_trade_pct, price):
+    return (budget * default_trade_pct) / price
+
+
+# Realized profit of selling a position. Mirrors the trade gross/fees bookkeeping in TradeBot.
+def get_sell_profit(buy_price, quantity, sell_price, fees = 0):
+    gross = sell_price * quantity - fees
+    return (gross - fees) - (buy_price * quantity)
@@ -0,0 +1,247 @@
+import numpy as np
+from collections import deque
+from trendlines import find_anchored_trendlines, DEFAULT_TRENDLINE_ERRPCT
+
+
+# Number of recent pivots searched for lines, and of lines kept, per side
+SR_MAX_PIVOTS = 32
+SR_MAX_LINES = 8
+
+
+# Checks whether `line` runs through all of `other`'s pivots along the same slope, i.e. is `other`
+# extended by newer pivots. The slopes may differ by as much as moves the line by `tolerance` over
+# `other`'s span.
+def extends_line(line, other, tolerance):
+    ids, (slope, intercept, error) = line
+    other_ids, (other_slope, other_intercept, other_error) = other
+    if not set(other_ids) <= set(ids):
+        return False
+
+    return abs(slope - other_slope) * (other_ids[-1] - other_ids[0]) <= tolerance
+
+
+#
+# Rolling max/min over the last `window` values, using monotonic deques. Amortized O(1) per value.
+#
+class RollingRange:
+    def __init__(self, window):
+        self.window = window
+        self.maxes = deque()
+        self.mins = deque()
+
+
+    def push(self, id, value):
+        while len(self.maxes) > 0 and self.maxes[-1][1] <= value:
+            self.maxes.pop()
+        while len(self.mins) > 0 and self.mins[-1][1] >= value:
+            self.mins.pop()
+
+        self.maxes.append((id, value))
+        self.mins.append((id, value))
+
+        expired = id - self.window
+        while self.maxes[0][0] <= expired:
+            self.maxes.popleft()
+        while self.mins[0][0] <= expired:
+            self.mins.popleft()
+
+
+    def get_span(self):
+        if len(self.maxes) == 0:
+            return 0.0
+
+        return self.maxes[0][1] - self.mins[0][1]
+
+
+#
+# Streaming pivots and trendlines for one side (lows for support, highs for resistance).
+#
+# A pivot is detected with the same momentum/acceleration rule as utils.get_extrema_mask, using
+# central differences, so a bar is confirmed as a pivot two bars after it closes. Each new pivot
+# is then used as the anchor of the slope-sorted line search in trendlines.find_trendlines, over
+# the most recent pivots only, which bounds the work per pivot regardless of uptime.
+#
+# A pivot that extends a line found earlier finds the whole line again. The longer line replaces
+# the earlier one, so the line buffer holds distinct lines.
+#
+# When many bars are taken in at once (update_many), only the newest pivots are searched, as many
+# as it takes to fill the line buffer with lines no newer one extends; lines from older ones would
+# be pushed out anyway. Each search sees the pivots and tolerance it would have had, so the result
+# is the same.
+#
+class PivotTracker:
+    def __init__(self, is_min, window, errpct = DEFAULT_TRENDLINE_ERRPCT):
+        self.is_min = is_min
+        self.window = window
+        self.errpct = errpct
+        self.values = deque(maxlen=5)
+        self.range = RollingRange(window)
+        self.pivots = deque(maxlen=SR_MAX_PIVOTS)
+        self.lines = deque(maxlen=SR_MAX_LINES)
+
+
+    # Same scale as trendlines.get_trendline_tolerance, over the rolling window
+    def get_tolerance(self):
+        return self.range.get_span() / self.window * self.errpct
+
+
+    # Takes the value of bar `id`. Returns the id of a newly confirmed pivot, or -1.
+    def update(self, id, value):
+        pivot = self.push(id, value)
+        if pivot is None:
+            return -1
+
+        self.pivots.append(pivot)
+        tolerance = self.get_tolerance()
+        self.add_lines(self.find_lines(self.pivots, tolerance), tolerance)
+        return pivot[0]
+
+
+    # Takes the values of bars `first_id` onwards
+    def update_many(self, first_id, values):
+        pivots = list(self.pivots)
+        searches = []
+
+        for i, value in enumerate(values):
+            pivot = self.push(first_id + i, value)
+            if pivot is not None:
+                pivots.append(pivot)
+                searches.append((len(pivots), self.get_tolerance()))
+
+        # Newest first, skipping lines that a newer one replaces
+        lines = []
+        for end, tolerance in reversed(searches):
+            if len(lines) >= SR_MAX_LINES:
+                break
+
+            found = self.find_lines(pivots[max(0, end - SR_MAX_PIVOTS):end], tolerance)
+            found = [(line, tolerance) for line in found if not any([extends_line(newer, line, newer_tolerance) for newer, newer_tolerance in lines])]
+            lines = found + lines
+
+        self.pivots = deque(pivots, maxlen=SR_MAX_PIVOTS)
+        for line, tolerance in lines:
+            self.add_lines([line], tolerance)
+
+
+    # Keeps newly found lines, replacing any they extend
+    def add_lines(self, lines, tolerance):
+        for line in lines:
+            for other in [other for other in self.lines if extends_line(line, other, tolerance)]:
+                self.lines.remove(other)
+
+            self.lines.append(line)
+
+
+    # Takes a value. Returns (id, value) of a newly confirmed pivot, or None.
+    def push(self, id, value):
+        self.values.append(value)
+        self.range.push(id, value)
+        if len(self.values) < 5:
+            return None
+
+        a, b, c, d, e = self.values
+        if not self.is_pivot(a, b, c, d, e):
+            return None
+
+        return (id - 2, c)
+
+
+    # Checks whether `c` is a pivot given the two values either side of it
+    def is_pivot(self, a, b, c, d, e):
+        acc = b - 2 * c + d
+        if (self.is_min and acc <= 0) or (not self.is_min and acc >= 0):
+            return False
+
+        mom_prev = (c - a) / 2
+        mom = (d - b) / 2
+        mom_next = (e - c) / 2
+
+        next_turn = (mom > 0 and mom_next < 0 and c >= d) or (mom < 0 and mom_next > 0 and c <= d)
+        prior_turn = (mom_prev > 0 and mom < 0 and b < c) or (mom_prev < 0 and mom > 0 and b > c)
+        return mom == 0 or next_turn or prior_turn
+
+
+    # Finds the lines ending at the newest of `pivots`
+    def find_lines(self, pivots, tolerance):
+        if len(pivots) < 3:
+            return []
+
+        # Relative to the oldest pivot, to keep the running sums well conditioned
+        origin = pivots[0][0]
+        xf = [float(id - origin) for id, value in pivots]
+        yl = [value for id, value in pivots]
+
+        anchor = len(xf) - 1
+        slopes = (np.asarray(yl[:anchor]) - yl[anchor]) / (np.asarray(xf[:anchor]) - xf[anchor])
+        order = np.argsort(slopes, kind='stable').tolist()
+
+        lines = []
+        for pts, (slope, intercept, error) in find_anchored_trendlines(xf, yl, anchor, order, tolerance):
+            ids = sorted([int(xf[p]) + origin for p in pts])
+            lines.append((ids, (slope, intercept - slope * origin, error)))
+
+        return lines
+
+
+    def get_last_pivot_id(self):
+        return self.pivots[-1][0] if len(self.pivots) > 0 else -1
+
+
+#
+# Incremental support and resistance, fed one closed kline at a time.
+#
+# Replaces re-running extrema detection and trendline search over the whole history on every
+# analysis: each kline is O(1) and analysis reads the current state. Bar ids count klines from
+# the first one fed, so they stay comparable across the lifetime of the bot.
+#
+class SupportResistanceTracker:
+    def __init__(self, window, errpct = DEFAULT_TRENDLINE_ERRPCT):
+        self.num_bars = 0
+        self.support = PivotTracker(True, window, errpct)
+        self.resistance = PivotTracker(False, window, errpct)
+
+
+    def update(self, low, high):
+        id = self.num_bars
+        self.num_bars += 1
+        self.support.update(id, low)
+        self.resistance.update(id, high)
+
+
+    # Takes many closed klines at once, oldest first
+    def update_many(self, lows, highs):
+        first_id = self.num_bars
+        self.num_bars += len(lows)
+        self.support.update_many(first_id, lows)
+        self.resistance.update_many(first_id, highs)
+
+
+    def get_last_minima_id(self):
+        return self.support.get_last_pivot_id()
+
+
+    def get_last_maxima_id(self):
+        return self.resistance.get_last_pivot_id()
+
+
+    # 1 if the latest pivot is a maximum (heading down from a peak), -1 otherwise, as in
+    # TradeBot.perform_analysis
+    def get_direction(self):
+        return 1.0 if self.get_last_minima_id() < self.get_last_maxima_id() else -1.0
+
+
+    def get_minima_ids(self):
+        return [id for id, value in self.support.pivots]
+
+
+    def get_maxima_ids(self):
+        return [id for id, value in self.resistance.pivots]
+
+
+    # Recent support lines as (pivot ids, (slope, intercept, standard error)), oldest first
+    def get_support_lines(self):
+        return list(self.support.lines)
+
+
+    def get_resistance_lines(self):
+        return list(self.resistance.lines)
@@ -18,6 +18,9 @@ class TradeType(IntEnum):
 
 
 class Trade:
+    __slots__ = ['symbol', 'type', 'time', 'price', 'gross', 'fees', 'exchange', 'state', 'quantity', 'strike',
+                 'limit', 'stop', 'rating', 'notes', 'stoploss_price', 'stoploss_order_id', 'order_id', 'target']
+
     def __init__(self, symbol, type):
         self.symbol = symbol
         self.type = type
@@ -1,9 +1,6 @@
 import os
 import pandas as pd
 import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
-import trendln
 import json
 import globals
 from enum import IntEnum
@@ -13,18 +10,23 @@ from ruamel.yaml import YAML
 from binance.client import Client
 from binance.enums import *
 from binance.helpers import round_step_size
-from findiff import FinDiff
-from rich import inspect
-import talib
-from talib import MA_Type
-
-# See https://mrjbq7.github.io/ta-lib/ for docs
-import talib
-from talib import RSI, BBANDS
 
 from .BotState import BotState, FsmState
+from .BotJournal import BotJournal
 from .Trade import Trade, TradeState, TradeType
+from .IndicatorEngine import IndicatorEngine, StreamingRsi, StreamingSma, StreamingBollinger
+from .KlineHistory import KlineHistory, hist_columns, hist_dtypes, tick_dtypes, required_history_capacity, get_kline_from_stream, get_history_row, kline_columns, HISTORY_INTERVAL_MS
+from .BarAggregator import BarAggregator
+from .SupportResistanceTracker import SupportResistanceTracker
+from .OrderTracker import OrderTracker
+from .Signals import SignalParams, TradeSignal, evaluate_signal, get_buy_quantity, SIGNAL_RSI_PERIOD, SIGNAL_BOLLINGER_PERIOD, SIGNAL_BOLLINGER_NBDEV
 from globals import yaml
+from storage import ColumnarFile, COLUMNAR_EXT, get_kline_cache
+from PersistenceWorker import get_persistence_worker
+
+
+# How close to its end an interval is considered to be closing, in millis
+INTERVAL_CLOSING_MS = 10 * 1000
 
 
 class SymbolContext:
@@ -37,8 +39,6 @@ class SymbolContext:
 # https://binance-docs.github.io/apidocs/spot/en/#websocket-market-streams
 # https://binance-docs.github.io/apidocs/spot/en/#individual-symbol-ticker-streams
 
-hist_columns = ['open-time', 'open', 'close', 'low', 'high', 'volume', 'close-time', 'quote-asset-volume', 'num-trades', 'taker-buy-base-volume', 'taker-buy-quote-volume', 'event', 'event-description']
-
 # Simple bot that buys low and sells high
 class TradeBot:
     def __init__(self, workspace, symbol, params, id, name, genetics = ''):
@@ -51,9 +51,14 @@ class TradeBot:
         self.fsm_state = FsmState.INIT
         self.state: BotState = None
         self.tag = name
-        self.history = pd.DataFrame(columns=hist_columns)
         self.ticks = []#pd.DateFrame(columns=hist_columns)
-        self.resolution = '1m'
+        self.capture_files = {}
+        self.history_captured = 0
+
+        # State saves, captures and reports are written in the background
+        self.persistence = get_persistence_worker()
+        self.journal = BotJournal(self.get_state_path(), self.persistence)
+        self.resolution = TimeScale.MINUTE
         self.last_sample_min = -1
         self.current_event_time = dt.datetime.now()
         self.playback_curr_time = dt.datetime.now()
@@ -63,9 +68,11 @@ class TradeBot:
         self.is_playback = False
         self.is_live_trading = False
         self.client = None
+        self.kline_cache = None
         self.prev_last_minima_id = -1
         self.prev_last_maxima_id = -1
         self.has_handled_interval_closing = False
+        self.num_high_latency_ticks = 0
         self.trades = []
         self.last_stats = None
         self.last_closed_interval_price = None
@@ -77,8 +84,47 @@ class TradeBot:
         self.moving_avg_window_medium = 25
         self.moving_avg_window_large = 99
 
+        # Indicator params (TA-Lib defaults). Trading signals are rated against the first RSI period.
+        self.rsi_periods = [SIGNAL_RSI_PERIOD, 12, 24]
+        self.bollinger_period = SIGNAL_BOLLINGER_PERIOD
+        self.bollinger_nbdev = SIGNAL_BOLLINGER_NBDEV
+
+        # Streaming indicators, committed once per closed interval
+        self.indicators = self.create_indicator_engine()
+
+        # Bounded kline history. Indicators carry their own state, so the buffer only needs
+        # enough warm-up for analysis of the longest window.
+        longest_period = max(self.rsi_periods + [self.bollinger_period, self.moving_avg_window_large])
+        self.history = KlineHistory(required_history_capacity(longest_period))
+
+        # Extrema and trendlines, updated per closed interval over the same window as the history
+        self.support_resistance = SupportResistanceTracker(self.history.capacity)
+
+        # In-flight orders, updated from the user data stream
+        self.orders = OrderTracker(self.tag)
+
+        # Bars of the longer timescales the genome follows, built from the base history
+        self.bars = BarAggregator(self.resolution)
+        self.bar_histories = {}
+
+
+    # Builds the streaming indicators the trading logic reads on every tick
+    def create_indicator_engine(self):
+        engine = IndicatorEngine()
 
-    # Initializes the bot with a rolling window of data to prime itself in
+        for period in self.rsi_periods:
+            engine.add(f'rsi{period}', StreamingRsi(period))
+
+        engine.add('bbands', StreamingBollinger(self.bollinger_period, self.bollinger_nbdev, self.bollinger_nbdev))
+
+        for window in [self.moving_avg_window_small, self.moving_avg_window_medium, self.moving_avg_window_large]:
+            engine.add(f'ma{window}', StreamingSma(window))
+
+        return engine
+
+
+    # Initializes the bot with a rolling window of data to prime itself in, as kline columns (see
+    # KlineCache.load and get_kline_columns)
     async def initialize(self, client, data, runin_end = None):
         self.client = client
 
@@ -89,17 +135,20 @@ class TradeBot:
         # TEMP
         if not self.is_playback: #and not self.is_capturing:
             self.load_state(self.genetics)
+            self.kline_cache = get_kline_cache(self.symbol.replace('_', ''))
         elif self.state is None:
             self.state = BotState(self.name, self.symbol, self.genetics)
 
         ##self.change_fsm_state(FsmState.RUNIN)
-        self.analyze_runin(data, runin_end)
+        self.subscribe_timescales()
+        self.analyze_runin(data, end=runin_end)
 
-        log(f"Initializing with {len(data)} data points", self.tag)
+        log(f"Initializing with {len(data['open-time'])} data points", self.tag)
         log(f"Genotype is: {self.state.get_genotype_str(full=True)}", self.tag)
 
         # Restore the proper FSM state
         self.change_fsm_state(self.state.saved_fsm_state)
+        self.resume_order_tracking()
 
         #if self.state is FsmState.READY and self.is_capturing is not True:
         #    self.change_fsm_state(FsmState.ACTIVE)
@@ -134,9 +183,25 @@ class TradeBot:
         self.param_bw_rsi_l = self.state.get('BWRSI')
         self.param_sw_rsi_h = self.state.get('SWRSI')
 
+        self.signal_params = SignalParams.from_state(self.state)
         return
 
 
+    # Builds bars for every timescale in the genome's TS gene besides the base one
+    def subscribe_timescales(self):
+        for timescale in self.state.get('TS'):
+            if timescale == self.resolution or timescale in self.bar_histories:
+                continue
+
+            self.bar_histories[timescale] = KlineHistory(self.history.capacity)
+            self.bars.subscribe(timescale, self.intake_bar)
+            log(f"Following {timescale.value} bars", self.tag)
+
+
+    def intake_bar(self, timescale, bar):
+        self.bar_histories[timescale].append(get_history_row(bar))
+
+
     # Gets the path where the bot stores its state
     def get_state_path(self):
         return self.get_output_path(self.symbol) + f'-state.yml'
@@ -148,177 +213,118 @@ class TradeBot:
         log(f"Loading bot state from '{state_path}'...", self.tag)
 
         self.state = BotState(self.name, self.symbol, genetics)
-        if path.exists(state_path):
-            with open(state_path) as file:
-                state_raw = yaml.load(file)
-                #state_raw = json.load(file)
-
-                if state_raw is None:
-                    log(f"WARNING: Could not load bot state")
-                else:
-                    self.state.load_from_yaml(state_raw)
-
-            return
+        if not self.journal.load(self.state):
+            log(f"WARNING: Could not load bot state")
 
+        return
 
-    def save_state(self):
-        state_path = self.get_state_path()
-        log(f"Saving bot state to '{state_path}'...")
 
+    # Journals the bot's scalar state. With `snapshot`, also writes out the whole state, e.g. after
+    # trades were added without being journaled.
+    def save_state(self, snapshot = False):
         self.state.saved_fsm_state = self.fsm_state
+        self.journal.record_state(self.state)
 
-        with open(state_path, 'w') as file:
-            content = self.state.get_yaml()
-            yaml.dump(content, file)
+        if snapshot:
+            log(f"Saving bot state to '{self.get_state_path()}'...")
+            self.journal.snapshot(self.state)
 
         return
 
 
-    # Analyzes the run-in period before trading begins
-    def analyze_runin(self, data, start = None, end = None):
+    # Analyzes the run-in period before trading begins. `columns` are kline columns.
+    def analyze_runin(self, columns, start = None, end = None):
         log(f"Analyzing runin data...", self.tag)
 
         perf_start = dt.datetime.now()
 
-        #data.reset_index(drop=True)
-
-        for entry in data:
-            ts = load_time(entry[0])
-            if end is not None and ts > end:
-                break
-            else:
-                self.intake_kline_entry(entry, historical=True)
-
-        try:
-            self.history.to_csv(path.join(self.get_output_path(self.symbol) + f"-runin.csv"))
-        except Exception as e:
-            log(f"Could not open run-in file! {len(data)} entries will not be saved an run-in")
-            pass
-
-        timeframe = dt.timedelta(minutes=60 * 4) # TODO: MAKE CONFIGURABLE DUH
+        # Klines opening within [start, end]
+        open_times = columns['open-time']
+        first = 0 if start is None else int(np.searchsorted(open_times, to_millis(start), side='left'))
+        last = len(open_times) if end is None else int(np.searchsorted(open_times, to_millis(end), side='right'))
+        self.intake_kline_columns({ name: values[first:last] for name, values in columns.items() })
 
-        if end is None:
-            end = dt.datetime.now()
+        runin = self.history.to_frame()
+        self.persistence.submit(self.save_runin, runin)
 
-        if start is None:
-            start = (end - timeframe)
-
-        first_entry = data[0]
-        first_ts = load_time(first_entry[0])
-
-        if start < first_ts:
-            start = first_ts
-        
         # Initial analysis
-        self.perform_analysis(self.history, start, end)
+        self.perform_analysis()
+
+        # Tracker ids count every kline taken in; the frame only holds the retained ones
+        first_id = self.history.num_appended - len(self.history)
+        minimaIdxs = [id - first_id for id in self.support_resistance.get_minima_ids() if id >= first_id]
+        maximaIdxs = [id - first_id for id in self.support_resistance.get_maxima_ids() if id >= first_id]
+        if not globals.headless:
+            self.persistence.submit(self.plot_diagnostics, runin, minimaIdxs, maximaIdxs, key=('diagnostics', self.get_output_path(self.symbol)))
 
         # TODO: Proper prev price logic
-        self.prev_tick_price = self.prev_price = float(data[-1][4])
+        self.prev_tick_price = self.prev_price = self.last_closed_interval_price
         perf_end = dt.datetime.now()
+        log(f"Took in {len(self.history)} run-in intervals in {millis_between(perf_start, perf_end)} ms", self.tag)
         return
 
 
-    # Note: window_size in relative time res units (min. minutes), not tick rate
-    def perform_analysis(self, data, start, end, tick_data=[]):
-        log(f"Performing analysis", self.tag)
-
-        # Compute some useful stats on our window
-        stats = data.copy()#[len(data) - self.moving_avg_window_large:]
-
-        col_avg_small = f'MovAvgClose{self.moving_avg_window_small}'
-        col_avg_medium = f'MovAvgClose{self.moving_avg_window_medium}'
-        col_avg_large = f'MovAvgClose{self.moving_avg_window_large}'
-
-        # Compute moving averges back 5, 15, 30 minutes/days/weeks/months
-        stats[col_avg_small] = data['close'].rolling(self.moving_avg_window_small).mean().dropna()
-        stats[col_avg_medium] = data['close'].rolling(self.moving_avg_window_medium).mean().dropna()
-        stats[col_avg_large] = data['close'].rolling(self.moving_avg_window_large).mean().dropna()
-
-        # NOTE: No rounding here due to minor currency values in coins... really should be using fixed point
-        stats[f'Log' + col_avg_small] = stats[col_avg_small].apply(np.log)#.apply(lambda x: round(x, 2))
-        stats[f'Log' + col_avg_medium] = stats[col_avg_medium].apply(np.log)
-        stats[f'Log' + col_avg_large] = stats[col_avg_large].apply(np.log)
-
-
-        #
-        # Compute extrema
-        # 
-        lows = stats['low']
-        highs = stats['high']
-        closes = stats['close']
-
-        perf_start = dt.datetime.now()
-
-        # Compute extrema
-        #dx = 1 # interval
-        #d_dx = FinDiff(0, dx, 1)
-        #d2_dx2 = FinDiff(0, dx, 2)
-        #clarr = np.asarray(closes)
-        #mom = d_dx(clarr)
-        #momacc = d2_dx2(clarr)
-#
-        #h = closes#.lolist()
-        #minimaIdxs, maximaIdxs = get_extrema(h, mom, momacc, True), get_extrema(h, mom, momacc, False)
-        #
-        #ymin, ymax = [h[x] for x in minimaIdxs], [h[x] for x in maximaIdxs]
-        #zmin, zmne, _, _, _ = np.polyfit(minimaIdxs, ymin, 1, full=True)  #y=zmin[0]*x+zmin[1]
-        #pmin = np.poly1d(zmin).c
-        #
-        #if len(maximaIdxs) > 0:
-        #    zmax, zmxe, _, _, _ = np.polyfit(maximaIdxs, ymax, 1, full=True) #y=zmax[0]*x+zmax[1]
-        #    pmax = np.poly1d(zmax).c
-        #
-
-        accuracy=128
-        mins, maxs = trendln.calc_support_resistance((lows.tolist(), highs.tolist()), accuracy=accuracy)
-        (minimaIdxs, pmin, mintrend, minwindows), (maximaIdxs, pmax, maxtrend, maxwindows) = mins, maxs
+    # Reads the latest extrema and support/resistance from the streaming tracker. Constant-time,
+    # so it can run on every rollover.
+    def perform_analysis(self):
+        sr = self.support_resistance
+        last_minima_id = sr.get_last_minima_id()
+        last_maxima_id = sr.get_last_maxima_id()
 
-        perf_end = dt.datetime.now()
+        is_new_minima = last_minima_id != self.prev_last_minima_id
+        is_new_maxima = last_maxima_id != self.prev_last_maxima_id
 
-        #elapsed_extrema = perf_end - perf_start
-        log(f"Computed extrema in {perf_end - perf_start}", self.tag)
+        # Keep track, so we can observe new extrema
+        self.prev_last_minima_id = last_minima_id
+        self.prev_last_maxima_id = last_maxima_id
 
+        extrema_direction = sr.get_direction()
 
-        #
-        # Filter extrema "noise"
-        #
+        support = sr.get_support_lines()
+        resistance = sr.get_resistance_lines()
 
-        #
-        # Analyze extrema
-        #
+        if is_new_minima or is_new_maxima:
+            log(f"Extrema: last minima {last_minima_id}, last maxima {last_maxima_id}, direction {extrema_direction}, {len(support)} support and {len(resistance)} resistance lines", self.tag)
 
-        if len(minimaIdxs) > 0:
-            last_minima_id = minimaIdxs[-1]
-        else:
-            last_minima_id = -1
+        # TODO: Slope of moving average including tick
 
-        if len(maximaIdxs) > 0:
-            last_maxima_id = maximaIdxs[-1]
-        else:
-            last_maxima_id = -1
+        self.last_stats = {
+            'last_minima_id': last_minima_id,
+            'last_maxima_id': last_maxima_id,
+            'extrema_direction': extrema_direction,
+            'support': support[-1] if len(support) > 0 else None,
+            'resistance': resistance[-1] if len(resistance) > 0 else None,
+        }
+        return
 
 
-        # TODO: Statefulness
-        # 
-        is_first_minima = self.prev_last_minima_id == -1
-        is_first_maxima = self.prev_last_maxima_id == -1
+    def save_runin(self, runin):
+        try:
+            runin.to_csv(path.join(self.get_output_path(self.symbol) + f"-runin.csv"))
+        except Exception as e:
+            log(f"Could not open run-in file! {len(runin)} entries will not be saved an run-in")
+            pass
 
-        # Keep track, so we can observe new extrema
-        self.prev_last_minima_id = last_minima_id
-        self.prev_last_maxima_id = last_maxima_id
 
-        extrema_direction = 0
-        if last_minima_id < last_maxima_id:
-            extrema_direction = 1.0
-        else:
-            extrema_direction = -1.0
+    # Writes a chart of the history's moving averages and tracked extrema.
+    # Runs on the persistence worker, so only reads what it is given.
+    def plot_diagnostics(self, data, minimaIdxs, maximaIdxs):
+        stats = data.copy()
 
+        col_avg_small = f'MovAvgClose{self.moving_avg_window_small}'
+        col_avg_medium = f'MovAvgClose{self.moving_avg_window_medium}'
+        col_avg_large = f'MovAvgClose{self.moving_avg_window_large}'
 
-        # TODO: Slope of moving average including tick
+        # Compute moving averges back 5, 15, 30 minutes/days/weeks/months
+        stats[col_avg_small] = data['close'].rolling(self.moving_avg_window_small).mean()
+        stats[col_avg_medium] = data['close'].rolling(self.moving_avg_window_medium).mean()
+        stats[col_avg_large] = data['close'].rolling(self.moving_avg_window_large).mean()
 
         #
         # Plot diagnostics
         #
+        import plotly.graph_objects as go
+
         plot_template = go.layout.Template()
         #plot_template.layout.annotationdefaults = dict(font=dict(color="crimson"))
         #plot_template.theme = 'plotly_dark'
@@ -365,20 +371,8 @@ class TradeBot:
 
         except Exception as e:
             log(f"Error running chart... skipping")
-            # TODO FIX
-            return
            
         # fig.show()
-
-        # Finding the root mean squared error
-        #try:
-        #    rmse = mean_squared_error(stock_df['MovAvg'][stock].loc[pred_df.index], pred_df[stock], squared=False)
-        #    print(f"On average, the model is off by {rmse} for {stock}\n")
-        #except ValueError:
-        #    print(f"Missing data for mean_squared_error")
-        #    pass
-
-        self.last_stats = stats
         return
 
 
@@ -386,70 +380,133 @@ class TradeBot:
     # Processes the next kline entry and adds it to the rolling window.
     # Note: Always assumes it's the latest!
     def intake_kline_entry(self, kl, historical = True):
+        close = float(kl[4])
+        close_time = to_millis(kl[6])
 
-        open_time = load_time(kl[0])
-        close_time = load_time(kl[6])
+        # TODO: What about adjusted close???
 
-        open = float(kl[1])
-        high = float(kl[2])
-        low = float(kl[3])
-        close = float(kl[4])
-        volume = float(kl[5])
-        quote_asset_volume = float(kl[7])
-        number_of_trades = float(kl[8])
-        taker_buy_base_volume = float(kl[9])
-        taker_buy_quote_volume = float(kl[10])
-        ignore = kl[11]
+        if self.history.last('close-time') == close_time:
+            log(f"Ignoring duplicate interval row in intake_kline_entry")
+            return
+
+        self.history.append(get_history_row(kl))
+        self.bars.update(kl)
 
-        event = ''
-        event_description = ''
+        self.indicators.commit(close)
+        self.support_resistance.update(float(kl[3]), float(kl[2]))
+        self.last_closed_interval_price = close
+        return
 
-        row = [open_time, open, close, low, high, volume, close_time, quote_asset_volume, number_of_trades, taker_buy_base_volume, taker_buy_quote_volume, event, event_description]
 
+    # Takes in many closed klines at once, as typed columns (see get_kline_columns). Same effect as
+    # intake_kline_entry on each in turn, with the history and indicators filled in bulk.
+    def intake_kline_columns(self, columns):
+        last_close_time = self.history.last('close-time')
+        if last_close_time is not None:
+            first = int(np.searchsorted(columns['close-time'], last_close_time, side='right'))
+            columns = { name: values[first:] for name, values in columns.items() }
 
-        # TODO: What about adjusted close???
+        closes = columns['close']
+        if len(closes) == 0:
+            return
 
-        if len(self.history) == 0:
-            prev_entry = None
-        else:
-            prev_entry = self.history.tail(1)
+        self.history.extend(columns)
+        self.indicators.commit_many(closes.tolist())
 
-        if (prev_entry is not None and load_time(prev_entry['close-time'].iloc[-1]) == close_time):
-            log(f"Ignoring duplicate interval row in intake_kline_entry")
+        self.support_resistance.update_many(columns['low'].tolist(), columns['high'].tolist())
 
-        # TODO: Prune history...but note that doing so seems to completely break RSI...
-        self.history.loc[len(self.history)] = row
-        self.last_closed_interval_price = close
+        if len(self.bars.get_timescales()) > 0:
+            for kl in zip(*[columns[name].tolist() for name in kline_columns]):
+                self.bars.update(kl)
+
+        self.last_closed_interval_price = float(closes[-1])
         return
 
 
-    # Updates the historical lines.
-    # TODO: Thread
-    async def update_history(self, ticks=1):
-        if self.is_playback:
-            return
-        else:
-            source, target = globals.currencies.parse_pair(self.symbol)
-            api_symbol = source.symbol + target.symbol
-            k = await self.client.get_historical_klines(api_symbol, Client.KLINE_INTERVAL_1MINUTE, "2m ago PST") # TODO: Time res
-            #log(f"Server request")
+    # Adds a closed kline from the stream to the history. If the stream skipped intervals, e.g.
+    # across a reconnect, the missing ones are fetched over REST first. In playback, klines are
+    # taken as they come and nothing is fetched or cached, as in ReplayEngine.
+    async def update_history(self, kline):
+        open_time = int(kline[0])
+        last_open_time = self.history.last('open-time')
 
-            open_time = 0
+        if last_open_time is not None:
+            if open_time <= last_open_time:
+                log(f"Ignoring closed interval @ {load_time(open_time)} already in the history", self.tag)
+                return
 
-            #k = [open_time, open, close, low, high, volume, close_time, quote_asset_volume, number_of_trades, taker_buy_base_volume, taker_buy_quote_volume, event, event_description]
-            self.intake_kline_entry(k[0])
+            if open_time > last_open_time + HISTORY_INTERVAL_MS and not self.is_playback:
+                await self.backfill_history(int(last_open_time) + HISTORY_INTERVAL_MS, open_time - 1)
 
+        self.intake_kline_entry(kline)
+        if not self.is_playback:
+            self.kline_cache.add(kline)
 
-            if self.is_capturing:
-                self.history.to_csv(path.join(self.get_output_path(self.symbol) + f"-history.csv"))
+        self.perform_analysis()
+
+        if self.is_capturing:
+            self.emit_captured_history()
+
+        return
+
+
+    # Fetches the intervals opening between `start` and `end` (millis) and adds them to the history
+    async def backfill_history(self, start, end):
+        num_missing = (end - start) // HISTORY_INTERVAL_MS + 1
+        log(f"Backfilling {num_missing} missed interval(s) from {load_time(start)}", self.tag)
+
+        api_symbol = self.symbol.replace('_', '')
+        while start <= end:
+            klines = await self.client.get_klines(symbol=api_symbol, interval=Client.KLINE_INTERVAL_1MINUTE, startTime=start, endTime=end, limit=1000) # TODO: Time res
+            if len(klines) == 0:
+                break
+
+            for kl in klines:
+                self.intake_kline_entry(kl)
+                self.kline_cache.add(kl)
+
+            start = int(klines[-1][0]) + HISTORY_INTERVAL_MS
 
         return
 
 
-    # Writes any captured ticks to disk. For training purposes.
+    # Gets a capture file, starting a fresh one the first time it is used in this session.
+    # Capture files are only used from the persistence worker.
+    def get_capture_file(self, kind, dtypes):
+        if kind not in self.capture_files:
+            capture_path = self.get_output_path(self.symbol) + f"-{kind}{COLUMNAR_EXT}"
+            if path.exists(capture_path):
+                os.remove(capture_path)
+
+            self.capture_files[kind] = ColumnarFile(capture_path, list(dtypes.items()))
+
+        return self.capture_files[kind]
+
+
+    # Appends history rows that have not been captured yet. For training purposes.
+    def emit_captured_history(self):
+        num_new = min(self.history.num_appended - self.history_captured, len(self.history))
+        if num_new <= 0:
+            return
+
+        # Copied, since the ring buffer reuses its rows
+        rows = { name: self.history.window(name, num_new).copy() for name in hist_dtypes }
+        self.persistence.submit(self.append_capture, 'history', hist_dtypes, rows)
+        self.history_captured = self.history.num_appended
+
+
+    # Appends any ticks captured since the last call to disk. For training purposes.
     def emit_captured_ticks(self):
-        df = pd.DataFrame.from_records(self.ticks)
-        df.to_csv(self.get_output_path(self.symbol) + '-ticks.csv')
+        if len(self.ticks) == 0:
+            return
+
+        rows = { name: np.asarray([tick[name] for tick in self.ticks]).astype(dtype) for name, dtype in tick_dtypes.items() }
+        self.persistence.submit(self.append_capture, 'ticks', tick_dtypes, rows)
+        self.ticks = []
+
+
+    def append_capture(self, kind, dtypes, rows):
+        self.get_capture_file(kind, dtypes).append(rows)
 
 
     # Seems as though Binance's test API gives us back a static snapshot of old data for historicals.
@@ -466,8 +523,8 @@ class TradeBot:
         return
 
 
-
-    def handle_exec_report(self, msg):
+    # Handles an executionReport from the user data stream
+    async def handle_exec_report(self, event_time, msg):
         
         # "e": "executionReport",        // Event type
         # "E": 1499405658658,            // Event time
@@ -502,27 +559,71 @@ class TradeBot:
         # "Y": "0.00000000",             // Last quote asset transacted quantity (i.e. lastPrice * lastQty)
         # "Q": "0.00000000"              // Quote Order Qty
 
-        order_id = msg['c']
-        quantity = msg['q']
-        price = msg['p']
-        stop_price = msg['P']
-        exec_type = msg['x']
-        exec_status = msg['X']
-        avg_price = float(msg['Z']) / float(msg['z'])
+        order = self.orders.on_exec_report(msg)
+        if order is not None:
+            self.handle_order_update(order)
+
+        return
+
 
-        log(f"Order update for order '{order_id}': Status: {exec_status}")
+    # Handles a change to one of the bot's orders, reported by the user data stream or reconciliation
+    def handle_order_update(self, order):
+        log(f"Order update for order '{order.client_order_id}': Status: {order.status}, filled {order.filled_quantity} @ {order.get_avg_price()}", self.tag)
+        if not order.is_done():
+            return
 
+        self.orders.forget(order.client_order_id)
+        self.prev_order = None
 
-        # ... update trades
-        is_buy_order_conf = exec_type == ''
+        if order.status != ORDER_STATUS_FILLED:
+            log(f"Order '{order.client_order_id}' was {order.status}", 'WARN')
 
-        if is_buy_order_conf:
             if self.fsm_state == FsmState.WAITING_FOR_BUY_ORDER_CONF:
-                self.change_fsm_state(FsmState.WAITING_FOR_SELL_OPP)
-            elif self.fsm_state == FsmState.WAITING_FOR_SELL_ORDER_CONF:
                 self.change_fsm_state(FsmState.WAITING_FOR_BUY_OPP)
+            elif self.fsm_state == FsmState.WAITING_FOR_SELL_ORDER_CONF:
+                self.change_fsm_state(FsmState.WAITING_FOR_SELL_OPP)
 
-        return
+            return
+
+        log(f"Order '{order.client_order_id}' has been FILLED!")
+
+        if self.fsm_state == FsmState.WAITING_FOR_BUY_ORDER_CONF:
+            log(f"Buy order '{order.client_order_id}' completed")
+
+            # TODO: Fill out the trade with the actual data
+
+            self.change_fsm_state(FsmState.WAITING_FOR_SELL_OPP)
+
+        elif self.fsm_state == FsmState.WAITING_FOR_SELL_ORDER_CONF:
+
+            trade = self.state.get_prev_trade()
+            prev_trade = self.state.get_prev_prev_trade()
+
+            profit = (trade.gross - trade.fees) - (prev_trade.price * prev_trade.quantity)
+
+            self.state.total_profit += profit
+            profit_str = globals.currencies.render(self.state.symbol_quote, profit)
+
+            note = f"SELL {trade.quantity} {self.symbol} @ {trade.price} for profit of {profit}"
+            log(note, 'SELLSELLSELL')
+            log(f"Total profit so far is {self.state.total_profit}")
+
+            self.change_fsm_state(FsmState.WAITING_FOR_BUY_OPP)
+
+
+    # After a restart, picks up tracking of the order the bot was waiting on. It is polled right
+    # away, since its fill may have been missed while the bot was down.
+    def resume_order_tracking(self):
+        if self.fsm_state != FsmState.WAITING_FOR_BUY_ORDER_CONF and self.fsm_state != FsmState.WAITING_FOR_SELL_ORDER_CONF:
+            return
+
+        trade = self.state.get_prev_trade()
+        if trade is None or not trade.order_id:
+            return
+
+        side = SIDE_BUY if trade.type == TradeType.BUY else SIDE_SELL
+        self.orders.track(trade.order_id, self.symbol, side, trade.price, trade.quantity)
+        self.orders.last_reconcile = 0
 
 
     # Normalizes a price and quantity based on the symbol's settings
@@ -567,6 +668,12 @@ class TradeBot:
         quantity_str = f"{quantity:.8f}"
 
 
+        # The order is tracked by an id of our own. Order updates are handled on the same queue as
+        # ticks, so none can arrive before it is tracked below; an order the exchange refused is
+        # never tracked.
+        client_order_id = self.orders.new_client_order_id(SIDE_BUY)
+        trade.order_id = client_order_id
+
         # Live only!
         if self.is_live_trading:
             log(f"--- LIVE TRADE for {quantity} ---")
@@ -576,11 +683,11 @@ class TradeBot:
                 type=ORDER_TYPE_LIMIT,
                 timeInForce=TIME_IN_FORCE_GTC,
                 quantity=quantity_str,
-                price=str(price))
+                price=str(price),
+                newClientOrderId=client_order_id)
 
             self.change_fsm_state(FsmState.WAITING_FOR_BUY_ORDER_CONF)
             self.prev_order = order
-            trade.order_id = order['orderId']
         else:
             order = await self.client.create_test_order(
                 symbol=f"{self.state.symbol.replace('_', '')}",
@@ -588,21 +695,22 @@ class TradeBot:
                 type=ORDER_TYPE_LIMIT,
                 timeInForce=TIME_IN_FORCE_GTC,
                 quantity=quantity_str,
-                price=str(price))
+                price=str(price),
+                newClientOrderId=client_order_id)
 
             self.change_fsm_state(FsmState.WAITING_FOR_BUY_ORDER_CONF)
             self.prev_order = order
 
-            # TODO: Deal with empty obj here from Binance test API
-            trade.order_id = order['orderId']
+        self.orders.track(client_order_id, self.symbol, SIDE_BUY, price, quantity)
 
-        jsons = json.dumps(order, indent=4, sort_keys=True)
-        print (jsons)
+        if not globals.headless:
+            log(json.dumps(order, sort_keys=True), 'order')
 
-        #trade.order_id = order.id
         self.record_trade(trade)
         self.save_state()
         log(note, 'BUYBUYBUY')
+
+        self.fill_test_order(client_order_id)
         return trade
 
 
@@ -635,6 +743,9 @@ class TradeBot:
         quantity_str = f"{quantity:.8f}"
 
 
+        client_order_id = self.orders.new_client_order_id(SIDE_SELL)
+        trade.order_id = client_order_id
+
         #
         if self.is_live_trading:
             log(f"--- LIVE TRADE for {quantity} ---")
@@ -644,10 +755,10 @@ class TradeBot:
                 type=ORDER_TYPE_LIMIT,
                 timeInForce=TIME_IN_FORCE_GTC,
                 quantity=quantity_str,
-                price=str(price))
+                price=str(price),
+                newClientOrderId=client_order_id)
                 
             self.prev_order = order
-            trade.order_id = order['orderId']
             self.change_fsm_state(FsmState.WAITING_FOR_SELL_ORDER_CONF)
         else:
             order = await self.client.create_test_order(
@@ -656,23 +767,40 @@ class TradeBot:
                 type=ORDER_TYPE_LIMIT,
                 timeInForce=TIME_IN_FORCE_GTC,
                 quantity=quantity_str,
-                price=str(price))
+                price=str(price),
+                newClientOrderId=client_order_id)
                 
             self.prev_order = order
-            trade.order_id =  order['orderId']
             self.change_fsm_state(FsmState.WAITING_FOR_SELL_ORDER_CONF)
 
-        jsons = json.dumps(order)
-        print (jsons)
+        self.orders.track(client_order_id, self.symbol, SIDE_SELL, price, trade.quantity)
+
+        if not globals.headless:
+            log(json.dumps(order, sort_keys=True), 'order')
 
 
         #.add_note(note)
         self.record_trade(trade)
         self.save_state()
         log(note, 'BUYBUYBUY')
+
+        self.fill_test_order(client_order_id)
         return trade
 
 
+    # Test orders are validated by the exchange but never reach the book, so when not trading live
+    # they are taken to fill at their limit price as soon as they are placed
+    def fill_test_order(self, client_order_id):
+        if self.is_live_trading:
+            return
+
+        order = self.orders.get(client_order_id)
+        order.status = ORDER_STATUS_FILLED
+        order.filled_quantity = order.quantity
+        order.filled_quote = order.price * order.quantity
+        self.handle_order_update(order)
+
+
     # Handle symbol ticks. Assume 2s with a history interval of 1m
     async def handle_symbol_tick(self, event_name, event_time, symbol, pl):
         param_latency_limit_ms = 500
@@ -752,6 +880,10 @@ class TradeBot:
             log(f"Unknown event '{event_name}'. Skipping message", self.tag)
             return
 
+        # Played back ticks happen at their event time
+        if self.is_playback:
+            self.playback_curr_time = load_time(event_time)
+
         time_current = self.get_current_time()
         time_event = load_time(event_time)
         time_spread_ms = millis_between(time_event, time_current)
@@ -759,9 +891,8 @@ class TradeBot:
 
         self.current_event_time = time_event
 
-        # Detect close (minute res)
+        # Interval closes are reported by the stream (see rollover below)
         # TODO: Other time resolutions
-        # TODO: Dispatch to separate thread
         if self.last_sample_min == -1:
             self.last_sample_min = time_event.minute
 
@@ -770,9 +901,12 @@ class TradeBot:
             self.capture_tick(pl)
 
 
-        # Warning logic
+        # Warning logic. Once per interval; the tick queue reports sustained lag.
         if time_spread_ms > param_latency_limit_ms:
-            log(f"Event latency is HIGH @ {time_spread_ms} ms", 'WARN')
+            if self.num_high_latency_ticks == 0:
+                log(f"Event latency is HIGH @ {time_spread_ms} ms", 'WARN')
+
+            self.num_high_latency_ticks += 1
 
 
         #print (f"TICK {time_event.second}: Price ${curr_price} V: {volume_total_traded_base}")
@@ -784,9 +918,6 @@ class TradeBot:
         state_holding_volume = 0
         state_holding_strike = 0
 
-        # Assumes run-in / perform_analysis called
-        stats = self.last_stats
-
         #
         # Run behaviours. This is where trades actually happen: on tick.
         # This allows us to place orders when we have reasonable confidence what the next
@@ -795,8 +926,8 @@ class TradeBot:
         # If we're getting close to close, or thinks are looking too risky,
         # we'll want to make a decision on what to do and have an order ready for the next window
 
-        # TODO: Time res
-        interval_is_closing = time_event.second > 50
+        # Stream klines carry the interval's close time
+        interval_is_closing = int(pl['T']) - event_time <= INTERVAL_CLOSING_MS
 
         if self.is_playback:
 
@@ -812,38 +943,30 @@ class TradeBot:
         # Indicators
         #
         
-        # Indicator: RSI
-        # Get the RSI for history + current tick
-        data_rsi = self.history['close'].copy()
-        data_rsi.loc[len(data_rsi)] = curr_price
+        # Evaluate the indicators as if this tick closed the interval. Committed indicator state
+        # only advances on interval close (see intake_kline_entry).
+        indicators = self.indicators.evaluate(curr_price)
 
-        data_rsi = data_rsi.tail(1000)
+        rsi6 = indicators['rsi6']
+        rsi12 = indicators['rsi12']
+        rsi24 = indicators['rsi24']
 
-        rsi6 = RSI(data_rsi, timeperiod=6).tolist()[-1]
-        rsi12 = RSI(data_rsi, timeperiod=12).tolist()[-1]
-        rsi24 = RSI(data_rsi, timeperiod=24).tolist()[-1]
+        if not globals.headless:
+            log(f"RSI(6): {rsi6} RSI(12): {rsi12} RSI(24): {rsi24}", 'stats')
 
-        print("RSI(6): {} RSI(12): {} RSI(24): {}".format(rsi6, rsi12, rsi24))
-
-        rsi = RSI(data_rsi, timeperiod=6).tolist()[-1]
-        upper, middle, lower = time('compute-bollinger-bands', lambda: talib.BBANDS(data_rsi))
-
-        bollinger_lower = lower.iloc[-1]
-        bollinger_upper = upper.iloc[-1]
+        rsi = indicators[f'rsi{SIGNAL_RSI_PERIOD}']
+        bollinger_upper, _, bollinger_lower = indicators['bbands']
 
         current_tick_rsi = rsi
 
-        col_avg_small = f'MovAvgClose{self.moving_avg_window_small}'
-        col_avg_medium = f'MovAvgClose{self.moving_avg_window_medium}'
-        col_avg_large = f'MovAvgClose{self.moving_avg_window_large}'
-
-        ma_small = self.show_in_quote_currency(stats[col_avg_small].tolist()[-1])
-        stat_str_1 = f"{self.symbol} | P: {curr_price} | V: {trade_total}"
-        stat_str_2 = f"MA({self.moving_avg_window_small}): {ma_small}"
-        stat_str_3 = f"RSI: {round(current_tick_rsi)}"
-        stat_str_4 = f"BBU: {self.show_in_quote_currency(bollinger_upper)} BBL: {self.show_in_quote_currency(bollinger_lower)}"
+        if not globals.headless:
+            ma_small = self.show_in_quote_currency(self.indicators.value(f'ma{self.moving_avg_window_small}'))
+            stat_str_1 = f"{self.symbol} | P: {curr_price} | V: {trade_total}"
+            stat_str_2 = f"MA({self.moving_avg_window_small}): {ma_small}"
+            stat_str_3 = f"RSI: {round(current_tick_rsi)}"
+            stat_str_4 = f"BBU: {self.show_in_quote_currency(bollinger_upper)} BBL: {self.show_in_quote_currency(bollinger_lower)}"
 
-        log(f"{stat_str_1} | {stat_str_2} | {stat_str_3} | {stat_str_4}", 'stats')
+            log(f"{stat_str_1} | {stat_str_2} | {stat_str_3} | {stat_str_4}", 'stats')
 
 
         # TODO: Future enhancement: Observe remaining ticks till the close just in case of a last
@@ -877,11 +1000,8 @@ class TradeBot:
         #
 
         # Buying power express in quote currency, e.g. BUSD for BTC/BUSD
-        buying_power = self.state.budget * self.state.default_trade_pct
-
         # Use max buying power every timez
-
-        buy_quantity = buying_power / curr_price
+        buy_quantity = get_buy_quantity(self.state.budget, self.state.default_trade_pct, curr_price)
 
         target_yield_pct = self.state.target_yield_pct
         target_yield = self.prev_price * target_yield_pct
@@ -902,133 +1022,41 @@ class TradeBot:
         # https://github.com/binance/binance-spot-api-docs/blob/master/rest-api.md
 
         #
-        # Poll order status
+        # Order status
         #
-        if (not self.is_playback) and (self.fsm_state == FsmState.WAITING_FOR_BUY_ORDER_CONF or self.fsm_state == FsmState.WAITING_FOR_SELL_ORDER_CONF):
-            #if self.fsm_state == FsmState.WAITING_FOR_BUY_ORDER_CONF:
-            #    prev_order = self.state.get_prev_trade()
-            #elif self.fsm_state == FsmState.WAITING_FOR_SELL_ORDER_CONF:
-            #    prev_order = self.state.get_prev_trade()
-            prev_order = self.state.get_prev_trade()
-            order_id = prev_order.order_id
-            log(f"Checking order '{order_id}'...")
-            checked_order = await self.client.get_order(symbol=self.symbol.replace('_', ''), orderId=order_id)
-
-            # https://github.com/binance/binance-spot-api-docs/blob/master/rest-api.md#query-order-user_data
-            #  "symbol": "LTCBTC",
-            #  "orderId": 1,
-            #  "orderListId": -1 //Unless part of an OCO, the value will always be -1.
-            #  "clientOrderId": "myOrder1",
-            #  "price": "0.1",
-            #  "origQty": "1.0",
-            #  "executedQty": "0.0",
-            #  "cummulativeQuoteQty": "0.0",
-            #  "status": "NEW",
-            #  "timeInForce": "GTC",
-            #  "type": "LIMIT",
-            #  "side": "BUY",
-            #  "stopPrice": "0.0",
-            #  "icebergQty": "0.0",
-            #  "time": 1499827319559,
-            #  "updateTime": 1499827319559,
-            #  "isWorking": true,
-            #  "origQuoteOrderQty": "0.000000"
-            status = checked_order['status']
-            orderId = checked_order['orderId']
-
-            log(f"Waiting for order {order_id} (status {status})...")
-
-            if status == ORDER_STATUS_FILLED:
-                log(f"Order {order_id} has been FILLED!")
-                self.prev_order = None
-
-                if self.fsm_state == FsmState.WAITING_FOR_BUY_ORDER_CONF:
-                    log(f"Buy order {orderId} completed")
-
-                    # TODO: Fill out the trade with the actual data
-
-                    log(f"{json.dumps(checked_order)}")
-
-                    self.change_fsm_state(FsmState.WAITING_FOR_SELL_OPP)
-
-                elif self.fsm_state == FsmState.WAITING_FOR_SELL_ORDER_CONF:
-
-                    trade = self.state.get_prev_trade()
-                    prev_trade = self.state.get_prev_prev_trade()
-
-                    profit = (trade.gross - trade.fees) - (prev_trade.price * prev_trade.quantity)
-                   
-                    self.state.total_profit += profit
-                    profit_str = globals.currencies.render(self.state.symbol_quote, profit)
-
-                    note = f"SELL {trade.quantity} {self.symbol} @ {trade.price} for profit of {profit}"
-                    log(note, 'SELLSELLSELL')
-                    log(f"Total profit so far is {self.state.total_profit}")
-
-                    self.change_fsm_state(FsmState.WAITING_FOR_BUY_OPP)
-
-
-
-
-        # RSI opportunity
-        elif current_tick_rsi < self.param_rsi_low:
-            #log(f"{self.symbol} is undersold at {curr_price} at {time_current} (tRSI: {current_tick_rsi})", 'note')
-
-            # BUY LOW !!!
-            if self.fsm_state is FsmState.READY or self.fsm_state is FsmState.WAITING_FOR_BUY_OPP:
-                below_bollinger_lower = curr_price < bollinger_lower
-
-                if self.param_bb_buy_breakouts_only and not below_bollinger_lower:
-                    #log(f"Skip buy opp inside Bollinger band @ {curr_price}")
-                    pass
-                else:
-                    # TODO: Timestamp logic... use TS from exchange?
-                    trade = await self.place_buy_order(curr_price, buy_quantity, time_current)
-            #else:
-                #log(f"Missed out on possible BUY due to current state of {FsmState(self.fsm_state).name}")
-
-        elif current_tick_rsi >= self.param_rsi_high:
-            #log(f"{self.symbol} is oversold at {curr_price} at {time_current} (tRSI: {current_tick_rsi})", 'note')
-
+        # Orders are updated from the user data stream as their executionReports arrive. While
+        # waiting on one, the exchange is only polled every so often in case an event was missed.
+        #
+        if self.fsm_state == FsmState.WAITING_FOR_BUY_ORDER_CONF or self.fsm_state == FsmState.WAITING_FOR_SELL_ORDER_CONF:
+            if (not self.is_playback) and self.orders.is_reconcile_due():
+                for order in await self.orders.reconcile(self.client, self.symbol.replace('_', '')):
+                    self.handle_order_update(order)
 
-            # Even if RSI indicates a buy signal, the price may be lower than the previous.
-            # An example would be in a sharp downturn, where mean reversions and even possibly
-            # positive Bollinger escape might be lower than the buy in price due to steep slope.
 
-            #
-            # Sell constraints
-            #
+        # RSI/Bollinger opportunity
+        else:
             prev_trade = self.state.get_prev_trade()
-            if prev_trade is not None: # TODO: Fees
-                target_floor = prev_trade.price + (prev_trade.price * target_yield_pct)
-
-            #
-            # Ensure we're selling at or above target
-            #
-            # TODO: Handle exit states / adaptive stop-loss mode.
-            if prev_trade is not None and curr_price <= target_floor:
-                #log(f"Not selling @ {curr_price} as it is below target price of {target_floor}", self.symbol)
-                pass
-            elif prev_trade is not None and self.fsm_state is FsmState.WAITING_FOR_SELL_OPP:
-                above_bollinger_upper = curr_price > bollinger_upper
-
-                if self.param_bb_sell_breakouts_only and not above_bollinger_upper:
-                    #log(f"Skip sell opp inside Bollinger band @ {curr_price}")
-                    pass
-                else:
-                    trade = await self.place_sell_order(prev_trade, curr_price, prev_trade.quantity, time_current)
-
+            prev_trade_price = prev_trade.price if prev_trade is not None else None
+            signal = evaluate_signal(self.fsm_state, self.signal_params, curr_price, current_tick_rsi, bollinger_upper, bollinger_lower, prev_trade_price)
 
-            #else:
-            #    log(f"Missed out on possible SELL due to current state of {FsmState(self.fsm_state).name}")
+            if signal == TradeSignal.BUY:
+                # TODO: Timestamp logic... use TS from exchange?
+                trade = await self.place_buy_order(curr_price, buy_quantity, time_current)
+            elif signal == TradeSignal.SELL:
+                trade = await self.place_sell_order(prev_trade, curr_price, prev_trade.quantity, time_current)
 
         #
-        # Roll over to next active timeframe
+        # Roll over to next active timeframe once the stream reports the interval closed
         # 
-        if self.last_sample_min != time_current.minute:
+        if pl['x']:
             log(f"Rolling over to next active timeframe @ {time_event}", 'time')
             self.has_handled_interval_closing = False
 
+            if self.num_high_latency_ticks > 1:
+                log(f"Event latency was HIGH for {self.num_high_latency_ticks} ticks", 'WARN')
+
+            self.num_high_latency_ticks = 0
+
             # TODO: Compare prev tick + new interval
             self.prev_price = curr_price
 
@@ -1036,7 +1064,7 @@ class TradeBot:
             self.playback_tick_in_interval_counter = 0
 
             # Note: If we write an event, it's written after the fact into the history
-            await self.update_history(ticks=1)
+            await self.update_history(get_kline_from_stream(pl))
 
 
             # If capturing, write the tick history to disk
@@ -1095,6 +1123,7 @@ class TradeBot:
 
         self.state.add_trade(trade)
         self.state.total_profit += profit
+        self.journal.record_trade(self.state, len(self.state.trades) - 1)
 
         # TODO: Offload to rendering thread
         #self.snapshot_trendlines(self.history, f"-trade-snapshot-{len(self.state.trades)}.png")
@@ -1102,7 +1131,9 @@ class TradeBot:
 
 
     # Computes Bollinger Bands (r)
+    # See https://mrjbq7.github.io/ta-lib/ for docs
     def compute_indicator_bollinger(self, data, window, period=10, colsuffix=''):
+        import talib
 
         try:
             close = data['close']
@@ -1271,8 +1302,15 @@ class TradeBot:
 
     def disconnect(self):
         try:
-            self.emit_captured_ticks()
-            self.save_state()
+            if self.is_capturing:
+                self.emit_captured_history()
+                self.emit_captured_ticks()
+
+            if self.kline_cache is not None:
+                self.kline_cache.flush()
+
+            self.save_state(snapshot=True)
+            self.journal.close()
         except:
             pass
 
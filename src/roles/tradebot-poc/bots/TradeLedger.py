@@ -0,0 +1,253 @@
+import sys
+import datetime as dt
+import numpy as np
+import pandas as pd
+from .Trade import Trade, TradeState, TradeType
+
+
+LEDGER_INITIAL_CAPACITY = 16
+
+# Numeric trade fields and how they are stored. Times are Unix epoch millis.
+ledger_dtypes = {
+    'type': np.int8,
+    'state': np.int8,
+    'time': np.int64,
+    'price': np.float64,
+    'quantity': np.float64,
+    'gross': np.float64,
+    'fees': np.float64,
+    'limit': np.float64,
+    'stop': np.float64,
+    'rating': np.float64,
+    'stoploss_price': np.float64,
+    'target': np.float64,
+}
+
+# Text trade fields. Each distinct value is stored once per ledger.
+ledger_text_fields = ['symbol', 'exchange', 'order_id', 'stoploss_order_id']
+
+
+# Profit of each completed round trip, given a trade sequence. A sell closes the latest buy
+# before it, as long as no other sell came in between; unmatched sells are ignored.
+# Returns (indices of the closing sells, profits).
+def get_round_trip_profits(types, prices, quantities, gross, fees):
+    n = len(types)
+    ix = np.arange(n)
+    is_buy = types == TradeType.BUY
+    is_sell = types == TradeType.SELL
+
+    last_buy = np.maximum.accumulate(np.where(is_buy, ix, -1)) if n > 0 else ix
+    last_sell = np.maximum.accumulate(np.where(is_sell, ix, -1)) if n > 0 else ix
+    prev_sell = np.concatenate([[-1], last_sell[:-1]]) if n > 0 else ix
+
+    closing = np.flatnonzero(is_sell & (last_buy >= 0) & (last_buy > prev_sell))
+    entries = last_buy[closing]
+    profits = (gross[closing] - fees[closing]) - prices[entries] * quantities[entries]
+    return closing, profits
+
+
+#
+# Columnar ledger of a bot's trades.
+#
+# Trades are stored as a struct of typed arrays that grow geometrically, with text fields as small
+# integer codes into a per-ledger table of interned strings. Compared to a list of Trade objects
+# this takes a fraction of the memory, and aggregates (P&L, fees, open position, win rate) are
+# vectorized.
+#
+# It behaves like the list it replaces: append, len, indexing (including negative indices) and
+# iteration all work with Trade objects, which are materialized on access. Changing a returned
+# Trade does not change the ledger; assign it back by index.
+#
+class TradeLedger:
+    def __init__(self, capacity = LEDGER_INITIAL_CAPACITY):
+        self.size = 0
+        self.columns = { name: np.zeros(capacity, dtype=dtype) for name, dtype in ledger_dtypes.items() }
+        self.codes = { name: np.zeros(capacity, dtype=np.int32) for name in ledger_text_fields }
+        self.texts = []
+        self.text_codes = {}
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+
+    def get_index(self, i):
+        if i < 0:
+            i += self.size
+
+        if i < 0 or i >= self.size:
+            raise IndexError(f"Trade index {i} out of range")
+
+        return i
+
+
+    def __getitem__(self, i):
+        i = self.get_index(i)
+        c = self.columns
+
+        trade = Trade(self.get_text('symbol', i), TradeType(int(c['type'][i])))
+        trade.state = TradeState(int(c['state'][i]))
+        trade.time = dt.datetime.fromtimestamp(c['time'][i] / 1000)
+        trade.price = float(c['price'][i])
+        trade.quantity = float(c['quantity'][i])
+        trade.gross = float(c['gross'][i])
+        trade.fees = float(c['fees'][i])
+        trade.limit = float(c['limit'][i])
+        trade.stop = float(c['stop'][i])
+        trade.rating = float(c['rating'][i])
+        trade.stoploss_price = float(c['stoploss_price'][i])
+        trade.target = float(c['target'][i])
+        trade.exchange = self.get_text('exchange', i)
+        trade.order_id = self.get_text('order_id', i)
+        trade.stoploss_order_id = self.get_text('stoploss_order_id', i)
+        return trade
+
+
+    def __setitem__(self, i, trade):
+        self.set(self.get_index(i), trade)
+
+
+    def append(self, trade):
+        self.reserve(self.size + 1)
+        self.size += 1
+        self.set(self.size - 1, trade)
+        return trade
+
+
+    def extend(self, ledger):
+        n = len(ledger)
+        self.reserve(self.size + n)
+
+        for name, column in self.columns.items():
+            column[self.size:self.size + n] = ledger.column(name)
+
+        # Translate the other ledger's text codes into this one's
+        remap = np.asarray([self.intern(text) for text in ledger.texts], dtype=np.int32)
+        for name, codes in self.codes.items():
+            codes[self.size:self.size + n] = remap[ledger.codes[name][:n]] if n > 0 else []
+
+        self.size += n
+
+
+    def set(self, i, trade):
+        values = {
+            'type': int(trade.type),
+            'state': int(trade.state),
+            'time': int(trade.time.timestamp() * 1000),
+            'price': trade.price,
+            'quantity': trade.quantity,
+            'gross': trade.gross,
+            'fees': trade.fees,
+            'limit': trade.limit,
+            'stop': trade.stop,
+            'rating': trade.rating,
+            'stoploss_price': float(trade.stoploss_price or 0),
+            'target': trade.target or 0,
+        }
+
+        for name, column in self.columns.items():
+            column[i] = values[name]
+
+        for name, codes in self.codes.items():
+            codes[i] = self.intern(getattr(trade, name))
+
+
+    def reserve(self, capacity):
+        current = len(self.columns['type'])
+        if capacity <= current:
+            return
+
+        capacity = max(capacity, current * 2)
+        for columns in [self.columns, self.codes]:
+            for name, column in columns.items():
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                columns[name] = grown
+
+
+    # Gets the code of a text value, adding it to the table if new. Order ids from the exchange
+    # may be numbers, so everything is stored as text.
+    def intern(self, text):
+        text = sys.intern('' if text is None else str(text))
+        code = self.text_codes.get(text)
+        if code is None:
+            code = len(self.texts)
+            self.texts.append(text)
+            self.text_codes[text] = code
+
+        return code
+
+
+    def get_text(self, name, i):
+        return self.texts[self.codes[name][i]]
+
+
+    # Gets a numeric column over the trades, e.g. 'price'. Zero-copy.
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+
+    # Builds a ledger from columns of trade fields; missing ones are zero or empty
+    @staticmethod
+    def from_arrays(symbol, **arrays):
+        size = len(arrays['type'])
+        ledger = TradeLedger(max(size, 1))
+        ledger.size = size
+
+        for name, values in arrays.items():
+            ledger.columns[name][:size] = values
+
+        ledger.columns['state'][:size] = TradeState.OPEN
+        ledger.codes['symbol'][:size] = ledger.intern(symbol)
+        ledger.codes['exchange'][:size] = ledger.intern('binance')
+        ledger.codes['order_id'][:size] = ledger.intern('')
+        ledger.codes['stoploss_order_id'][:size] = ledger.intern('')
+
+        return ledger
+
+
+    # Indices of the sells that closed a round trip, and the profit of each
+    def get_round_trips(self):
+        c = self.column
+        return get_round_trip_profits(c('type'), c('price'), c('quantity'), c('gross'), c('fees'))
+
+
+    def get_realized_pnl(self):
+        closing, profits = self.get_round_trips()
+        return float(np.sum(profits))
+
+
+    def get_win_rate(self):
+        closing, profits = self.get_round_trips()
+        return float(np.mean(profits > 0)) if len(profits) > 0 else 0.0
+
+
+    def get_total_fees(self):
+        return float(np.sum(self.column('fees')))
+
+
+    # Quantity bought and not yet sold
+    def get_open_position(self):
+        types = self.column('type')
+        quantities = self.column('quantity')
+        return float(np.sum(quantities[types == TradeType.BUY]) - np.sum(quantities[types == TradeType.SELL]))
+
+
+    def to_frame(self):
+        frame = pd.DataFrame({ name: self.column(name) for name in ledger_dtypes })
+        frame['time'] = pd.to_datetime(frame['time'], unit='ms')
+
+        texts = np.asarray(self.texts, dtype=object)
+        for name in ledger_text_fields:
+            frame[name] = texts[self.codes[name][:self.size]] if self.size > 0 else []
+
+        return frame
+
+
+    def get_nbytes(self):
+        return sum([column.nbytes for column in self.columns.values()]) + sum([codes.nbytes for codes in self.codes.values()])
@@ -0,0 +1,175 @@
+import datetime as dt
+import numpy as np
+import talib
+from utils import *
+
+from .BotState import FsmState
+from .Trade import TradeType
+from .ReplayEngine import ReplayEngine, ReplayResult
+from .Signals import SignalParams, get_buy_quantity, get_sell_profit, SIGNAL_RSI_PERIOD, SIGNAL_BOLLINGER_PERIOD, SIGNAL_BOLLINGER_NBDEV
+
+
+#
+# Vectorized whole-history backtester for coarse screening of RSI/Bollinger genomes.
+#
+# Indicators are computed once over the entire close series and the entry/exit state machine is
+# resolved by searching the candidate arrays, so the cost is dominated by a handful of NumPy passes
+# rather than per-interval Python. Results are at interval granularity: each close is treated as
+# the only tick of its interval, which is exactly what ReplayEngine.run_intervals() does.
+#
+
+# Smallest block of sell candidates scanned at once when looking for an exit
+EXIT_SCAN_BLOCK = 256
+
+
+# Computes the indicator series the trading rules are rated against
+def compute_signal_indicators(close):
+    close = np.asarray(close, dtype=np.float64)
+    rsi = talib.RSI(close, timeperiod=SIGNAL_RSI_PERIOD)
+    upper, middle, lower = talib.BBANDS(close,
+                                        timeperiod=SIGNAL_BOLLINGER_PERIOD,
+                                        nbdevup=SIGNAL_BOLLINGER_NBDEV,
+                                        nbdevdn=SIGNAL_BOLLINGER_NBDEV,
+                                        matype=0)
+    return rsi, upper, lower
+
+
+# Gets the boolean masks of intervals where the rules would buy (if flat) or sell (if holding).
+# The sell mask excludes the target floor, which depends on the entry price.
+def get_signal_masks(params: SignalParams, close, rsi, upper, lower):
+    with np.errstate(invalid='ignore'):
+        rsi_low = rsi < params.rsi_low
+        buy = rsi_low
+        if params.bb_buy_breakouts_only:
+            buy = buy & (close < lower)
+
+        sell = (rsi >= params.rsi_high) & ~rsi_low
+        if params.bb_sell_breakouts_only:
+            sell = sell & (close > upper)
+
+    return buy, sell
+
+
+# Finds the first sell candidate after `entry` whose close clears `floor`, scanning in growing blocks
+def find_exit(close, sell_ix, entry, floor):
+    start = int(np.searchsorted(sell_ix, entry, side='right'))
+    block = EXIT_SCAN_BLOCK
+
+    while start < len(sell_ix):
+        candidates = sell_ix[start:start + block]
+        hits = np.flatnonzero(close[candidates] > floor)
+        if len(hits) > 0:
+            return int(candidates[hits[0]])
+
+        start += block
+        block *= 2
+
+    return -1
+
+
+#
+# Vectorized counterpart of ReplayEngine for closed intervals
+#
+class VectorBacktest:
+    def __init__(self, params: SignalParams, budget, default_trade_pct):
+        self.params = params
+        self.budget = budget
+        self.default_trade_pct = default_trade_pct
+
+
+    @staticmethod
+    def from_state(state):
+        return VectorBacktest(SignalParams.from_state(state), state.budget, state.default_trade_pct)
+
+
+    def run(self, open_time, close, indicators = None) -> ReplayResult:
+        perf_start = dt.datetime.now()
+
+        open_time = np.asarray(open_time)
+        close = np.asarray(close, dtype=np.float64)
+
+        if indicators is None:
+            indicators = compute_signal_indicators(close)
+
+        rsi, upper, lower = indicators
+        buy, sell = get_signal_masks(self.params, close, rsi, upper, lower)
+        buy_ix = np.flatnonzero(buy)
+        sell_ix = np.flatnonzero(sell)
+
+        # Resolve the entry/exit state machine: buy at the first candidate while flat, then sell at
+        # the first later candidate above the target floor
+        entries = []
+        exits = []
+        pos = 0
+        target_yield_pct = self.params.target_yield_pct
+
+        while True:
+            next_buy = int(np.searchsorted(buy_ix, pos, side='left'))
+            if next_buy >= len(buy_ix):
+                break
+
+            entry = int(buy_ix[next_buy])
+            entry_price = close[entry]
+            floor = entry_price + (entry_price * target_yield_pct)
+            entries.append(entry)
+
+            exit = find_exit(close, sell_ix, entry, floor)
+            if exit < 0:
+                break
+
+            exits.append(exit)
+            pos = exit + 1
+
+        entries = np.asarray(entries, dtype=np.int64)
+        exits = np.asarray(exits, dtype=np.int64)
+
+        quantity = get_buy_quantity(self.budget, self.default_trade_pct, close[entries])
+        closed = len(exits)
+        profit = get_sell_profit(close[entries[:closed]], quantity[:closed], close[exits])
+
+        result = ReplayResult()
+        result.total_profit = float(np.sum(profit))
+        result.num_ticks = len(close)
+
+        trade_times = open_time.tolist()
+        trade_prices = close.tolist()
+        quantities = quantity.tolist()
+        for n, entry in enumerate(entries.tolist()):
+            result.trades.append((entry, trade_times[entry], TradeType.BUY, trade_prices[entry], quantities[n]))
+            if n < closed:
+                exit = int(exits[n])
+                result.trades.append((exit, trade_times[exit], TradeType.SELL, trade_prices[exit], quantities[n]))
+
+        if len(entries) == 0:
+            result.fsm_state = FsmState.READY
+        elif len(entries) > closed:
+            result.fsm_state = FsmState.WAITING_FOR_SELL_OPP
+        else:
+            result.fsm_state = FsmState.WAITING_FOR_BUY_OPP
+
+        result.elapsed = (dt.datetime.now() - perf_start).total_seconds()
+        return result
+
+
+# Checks that the vectorized backtester and the tick-driven replay engine agree at interval granularity.
+# Returns (matches, vectorized result, replayed result).
+def verify_parity(params: SignalParams, budget, default_trade_pct, open_time, close, rel_tol = 1e-9):
+    vectorized = VectorBacktest(params, budget, default_trade_pct).run(open_time, close)
+    replayed = ReplayEngine(params, budget, default_trade_pct).run_intervals(open_time, close)
+
+    matches = len(vectorized.trades) == len(replayed.trades)
+
+    if matches:
+        for a, b in zip(vectorized.trades, replayed.trades):
+            if a[0] != b[0] or a[2] != b[2] or a[3] != b[3] or not np.isclose(a[4], b[4], rtol=rel_tol):
+                log(f"Parity mismatch: vectorized trade {a} vs replayed trade {b}", 'parity')
+                matches = False
+                break
+    else:
+        log(f"Parity mismatch: {len(vectorized.trades)} vectorized trades vs {len(replayed.trades)} replayed trades", 'parity')
+
+    if matches and not np.isclose(vectorized.total_profit, replayed.total_profit, rtol=rel_tol, atol=1e-12):
+        log(f"Parity mismatch: profit {vectorized.total_profit} vs {replayed.total_profit}", 'parity')
+        matches = False
+
+    return matches, vectorized, replayed
@@ -1,10 +1,21 @@
-from .TradeBot import TradeBot
 from utils import *
 
 
+# TradeBot brings in the exchange client, so it is only imported once a bot is created. Backtests,
+# sweeps and their workers only need the lighter modules of this package.
+def __getattr__(name):
+    if name == 'TradeBot':
+        from .TradeBot import TradeBot
+        globals()['TradeBot'] = TradeBot
+        return TradeBot
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
 def create_bot(type, workspace, symbol, params, id, name, genetics = ''):
     try:
         if type == 'trade-bot':
+            from .TradeBot import TradeBot
             return TradeBot(workspace, symbol, params, id, name, genetics)
         else:
             return None
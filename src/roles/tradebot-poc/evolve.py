@@ -0,0 +1,77 @@
+import os
+import datetime as dt
+from os import path
+
+from utils import *
+from genetics.GeneticOptimizer import GeneticOptimizer
+from bots.Signals import SIGNAL_GENES
+from bots.ReplayEngine import load_backtest_data
+from sweep import create_sweep_pool, evaluate_genome
+
+
+#
+# Genetic search over a captured backtest. Genomes are evaluated on the same shared-dataset
+# worker pool as `sm sweep`.
+#
+
+def run_evolve_command(args):
+    checkpoint_path = args['resume']
+
+    if checkpoint_path != '':
+        optimizer, settings = GeneticOptimizer.load_checkpoint(checkpoint_path)
+        log(f"Resuming from '{checkpoint_path}' at generation {optimizer.generation} ({len(optimizer.cache)} cached genomes)", 'evolve')
+
+    else:
+        genes = args['genes']
+        gene_names = SIGNAL_GENES if genes == '' else [x.strip() for x in genes.split(',') if x.strip() != '']
+
+        optimizer = GeneticOptimizer(gene_names,
+                                     args['genome'],
+                                     population_size=int(args['population']),
+                                     elite=int(args['elite']),
+                                     tournament_size=int(args['tournament']),
+                                     crossover_rate=float(args['crossover_rate']),
+                                     mutation_rate=float(args['mutation_rate']),
+                                     seed=args['seed'])
+
+        # Cached fitness is only valid for the dataset and trade settings it was evaluated with,
+        # so these are fixed for the life of a checkpoint
+        settings = {
+            'backtest': args['backtest'],
+            'budget': float(args['budget_initial']),
+            'wager': float(args['wager_initial']),
+            'yield_target': float(args['yield_target']),
+            'ticks': bool(args['ticks']),
+        }
+
+        checkpoint_path = args['checkpoint']
+        if checkpoint_path == '':
+            stamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+            checkpoint_path = path.join(os.getcwd(), 'output', f"evolve-{settings['backtest']}-{stamp}.yaml")
+
+    backtest = settings['backtest']
+    if backtest == '':
+        raise Exception(f"A backtest is required. See README for examples.")
+
+    log(f"Evolving {', '.join(optimizer.gene_names)} over backtest '{backtest}' with a population of {optimizer.population_size}", 'evolve')
+    data = load_backtest_data(backtest)
+
+    workers = int(args['workers'])
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    with create_sweep_pool(data, settings['budget'], settings['wager'], settings['yield_target'], settings['ticks'], workers) as pool:
+        def map_fn(genomes):
+            chunksize = max(1, len(genomes) // (workers * 4))
+            return pool.map(evaluate_genome, genomes, chunksize=chunksize)
+
+        best = optimizer.run(int(args['generations']), map_fn, checkpoint_path, settings)
+
+    total = optimizer.num_evaluations + optimizer.num_cache_hits
+    hit_rate = optimizer.num_cache_hits / total if total > 0 else 0
+    log(f"Backtested {optimizer.num_evaluations} genomes, {optimizer.num_cache_hits} served from cache ({hit_rate * 100:.1f}%)", 'evolve')
+
+    if best is not None:
+        log(f"Best: {best['genome']} | P: {best['profit']:.8f} | T: {best['trades']} | DD: {best['drawdown']:.8f}", 'evolve')
+
+    log(f"Checkpoint written to {checkpoint_path}", 'evolve')
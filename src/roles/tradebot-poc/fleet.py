@@ -0,0 +1,102 @@
+import uuid
+import asyncio
+from os import path
+
+from globals import yaml
+from utils import *
+from trade import init_new_bot, api_key, api_secret
+from bots import create_bot
+from BotRuntime import BotRuntime
+from binance import AsyncClient
+
+
+#
+# Runs a fleet of bots in one process.
+#
+# The fleet file lists the bots to run, one per symbol and genome, with optional defaults:
+#
+#   defaults:
+#     budget-initial: 1000
+#     wager-initial: 0.1
+#     yield-target: 0.01
+#   bots:
+#     - symbol: BTC_USDT
+#       name: btc-rsi
+#       genome: RSIL=30|RSIH=70
+#     - symbol: ETH_USDT
+#
+# Bots keep their state under output/<symbol>-<name>-state.yml, as with `sm bot`.
+#
+
+fleet_bot_settings = ['budget-initial', 'wager-initial', 'yield-target']
+
+
+def load_fleet(fleet_path, args):
+    with open(fleet_path) as file:
+        fleet = yaml.load(file)
+
+    if fleet is None or 'bots' not in fleet:
+        raise Exception(f"No bots in fleet '{fleet_path}'")
+
+    defaults = { setting: args[setting.replace('-', '_')] for setting in fleet_bot_settings }
+    defaults.update(fleet.get('defaults', None) or {})
+
+    entries = []
+    for n, entry in enumerate(fleet['bots']):
+        if 'symbol' not in entry:
+            raise Exception(f"Fleet bot #{n + 1} has no symbol")
+
+        settings = dict(defaults)
+        settings.update(entry)
+        settings['genome'] = settings.get('genome', '') or ''
+        settings['name'] = settings.get('name', '') or f"fleet-{n + 1}"
+        entries.append(settings)
+
+    names = [(entry['symbol'], entry['name']) for entry in entries]
+    if len(set(names)) != len(names):
+        raise Exception(f"Bot names in fleet '{fleet_path}' must be unique per symbol")
+
+    return entries
+
+
+def create_fleet_bot(entry, live, capture):
+    symbol = entry['symbol']
+    name = entry['name']
+    genome = entry['genome']
+
+    bot = create_bot('trade-bot', None, symbol, [], str(uuid.uuid4()), name, genome)
+    if bot is None:
+        raise Exception(f"Could not create bot '{name}' for {symbol}")
+
+    bot.is_live_trading = live
+    bot.is_capturing = capture
+
+    # New bots start from the fleet's settings; existing ones load their saved state on initialize
+    bot_path = bot.get_state_path()
+    if not path.exists(bot_path):
+        init_new_bot(name, bot_path, { setting.replace('-', '_'): entry[setting] for setting in fleet_bot_settings }, symbol, genome)
+
+    return bot
+
+
+async def fleet_main(args):
+    entries = load_fleet(args['fleet'], args)
+    log(f"Connecting to Binance for a fleet of {len(entries)} bot(s)...", 'fleet')
+    client = await AsyncClient.create(api_key, api_secret)
+    runtime = BotRuntime(client, int(args['weight_limit']))
+
+    try:
+        for entry in entries:
+            runtime.add_bot(create_fleet_bot(entry, args['live'], args['capture']))
+
+        await runtime.initialize()
+        await runtime.run()
+
+    finally:
+        runtime.disconnect()
+        await client.close_connection()
+
+
+def run_fleet_command(args):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(fleet_main(args))
@@ -0,0 +1,308 @@
+import os
+import random
+import datetime as dt
+import numpy as np
+from os import path
+from utils import *
+from globals import yaml
+
+from .Genotype import Genotype, GT, sep_gene
+
+
+#
+# Genetic-algorithm search over Genotype genes.
+#
+# Individuals are genome strings layered over a base genome. Fitness is the backtest profit
+# reported by an evaluator, and results are cached by the canonical full genome string so an
+# individual that reappears (elites, converged offspring, resumed runs) is never re-backtested.
+#
+
+# Standard deviation of a numeric mutation, relative to the range of the gene
+MUTATION_SCALE = 0.15
+
+CHECKPOINT_VERSION = 1
+
+
+class GeneticOptimizer:
+    def __init__(self,
+                 gene_names,
+                 base_genome = '',
+                 population_size = 40,
+                 elite = 2,
+                 tournament_size = 3,
+                 crossover_rate = 0.7,
+                 mutation_rate = 0.2,
+                 seed = None):
+
+        base = Genotype(base_genome)
+        for name in gene_names:
+            gene = base.get_gene(name)
+            if gene is None:
+                raise Exception(f"Unknown robot gene '{name}'")
+
+            if gene.type != GT.Flag and gene.bounds is None:
+                raise Exception(f"Gene '{name}' has no bounds and cannot be evolved")
+
+        if population_size < 2:
+            raise Exception(f"Invalid population size {population_size}")
+
+        if elite >= population_size:
+            raise Exception(f"Elite count {elite} must be smaller than the population size {population_size}")
+
+        self.gene_names = list(gene_names)
+        self.base_genome = base_genome
+        self.template = base
+        self.population_size = population_size
+        self.elite = elite
+        self.tournament_size = tournament_size
+        self.crossover_rate = crossover_rate
+        self.mutation_rate = mutation_rate
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        self.generation = 0
+        self.population = []
+        self.stats = []
+        self.best = None
+
+        # Evaluation results keyed by canonical genome
+        self.cache = {}
+        self.num_evaluations = 0
+        self.num_cache_hits = 0
+
+
+    # Gets the genome string for a set of values of the evolved genes
+    def make_genome(self, values):
+        genotype = Genotype(self.base_genome)
+        decls = []
+        for name, value in zip(self.gene_names, values):
+            genotype.set_value(name, value)
+            decls.append(genotype.get_gene(name).to_string())
+
+        return sep_gene.join([x for x in [self.base_genome] + decls if x != ''])
+
+
+    def get_values(self, genome):
+        genotype = Genotype(genome)
+        return [genotype.get_value(name) for name in self.gene_names]
+
+
+    # Canonical cache key. Identical individuals map to the same key however they were written.
+    @staticmethod
+    def get_key(genome):
+        return Genotype(genome).to_string(full=True)
+
+
+    def get_gene(self, name):
+        return self.template.get_gene(name)
+
+
+    def quantize(self, gene, value):
+        low, high, step = gene.bounds
+        value = min(max(value, low), high)
+        return round(low + round((value - low) / step) * step, 10)
+
+
+    def random_value(self, gene):
+        if gene.type == GT.Flag:
+            return self.rng.random() < 0.5
+
+        low, high, step = gene.bounds
+        return self.quantize(gene, self.rng.uniform(low, high))
+
+
+    def random_genome(self):
+        return self.make_genome([self.random_value(self.get_gene(name)) for name in self.gene_names])
+
+
+    def mutate(self, values):
+        mutated = list(values)
+        for i, name in enumerate(self.gene_names):
+            if self.rng.random() >= self.mutation_rate:
+                continue
+
+            gene = self.get_gene(name)
+            if gene.type == GT.Flag:
+                mutated[i] = not mutated[i]
+            else:
+                low, high, step = gene.bounds
+                mutated[i] = self.quantize(gene, mutated[i] + self.rng.gauss(0, (high - low) * MUTATION_SCALE))
+
+        return mutated
+
+
+    # Uniform crossover
+    def crossover(self, a, b):
+        return [x if self.rng.random() < 0.5 else y for x, y in zip(a, b)]
+
+
+    # Tournament selection over results
+    def select(self, results):
+        contenders = self.rng.sample(results, min(self.tournament_size, len(results)))
+        return max(contenders, key=lambda r: r['profit'])
+
+
+    # Seeds the first generation with the base genome and random individuals
+    def initialize(self):
+        self.population = [self.make_genome(self.get_values(self.base_genome))]
+        while len(self.population) < self.population_size:
+            self.population.append(self.random_genome())
+
+
+    # Evaluates genomes, backtesting only those not already in the cache.
+    # `map_fn` takes a list of genome strings and returns their results in the same order.
+    def evaluate(self, genomes, map_fn):
+        pending = {}
+        for genome in genomes:
+            key = self.get_key(genome)
+            if key in self.cache:
+                self.num_cache_hits += 1
+            elif key not in pending:
+                pending[key] = genome
+            else:
+                self.num_cache_hits += 1
+
+        if len(pending) > 0:
+            keys = list(pending.keys())
+            for key, result in zip(keys, map_fn([pending[key] for key in keys])):
+                self.cache[key] = result
+
+            self.num_evaluations += len(pending)
+
+        return [self.cache[self.get_key(genome)] for genome in genomes], len(pending)
+
+
+    # Breeds the next population from ranked results, carrying the unique elites over unchanged
+    def breed(self, results):
+        ranked = sorted(results, key=lambda r: (-r['profit'], r['drawdown']))
+
+        population = []
+        seen = set()
+        for result in ranked:
+            if len(population) >= self.elite:
+                break
+
+            key = self.get_key(result['genome'])
+            if key not in seen:
+                seen.add(key)
+                population.append(result['genome'])
+
+        while len(population) < self.population_size:
+            a = self.get_values(self.select(results)['genome'])
+            if self.rng.random() < self.crossover_rate:
+                b = self.get_values(self.select(results)['genome'])
+                a = self.crossover(a, b)
+
+            population.append(self.make_genome(self.mutate(a)))
+
+        return population
+
+
+    # Evaluates and breeds one generation
+    def step(self, map_fn):
+        perf_start = dt.datetime.now()
+        hits_before = self.num_cache_hits
+
+        results, evaluated = self.evaluate(self.population, map_fn)
+        best = max(results, key=lambda r: r['profit'])
+        if self.best is None or best['profit'] > self.best['profit']:
+            self.best = dict(best)
+
+        stats = {
+            'generation': self.generation,
+            'best_profit': float(best['profit']),
+            'mean_profit': float(np.mean([r['profit'] for r in results])),
+            'evaluated': evaluated,
+            'cached': self.num_cache_hits - hits_before,
+            'elapsed': (dt.datetime.now() - perf_start).total_seconds(),
+            'best_genome': best['genome'],
+        }
+        self.stats.append(stats)
+
+        self.population = self.breed(results)
+        self.generation += 1
+        return stats
+
+
+    # Runs until `generations` generations have completed in total, checkpointing after each one
+    def run(self, generations, map_fn, checkpoint_path = None, settings = None):
+        if len(self.population) == 0:
+            self.initialize()
+
+        while self.generation < generations:
+            stats = self.step(map_fn)
+            log(f"Gen {stats['generation']} | Best: {stats['best_profit']:.8f} | Mean: {stats['mean_profit']:.8f} | Evaluated: {stats['evaluated']} | Cached: {stats['cached']} | {stats['elapsed']:.2f}s", 'evolve')
+
+            if checkpoint_path is not None:
+                self.save_checkpoint(checkpoint_path, settings)
+
+        return self.best
+
+
+    def save_checkpoint(self, checkpoint_path, settings = None):
+        version, state, gauss_next = self.rng.getstate()
+
+        content = {
+            'version': CHECKPOINT_VERSION,
+            'settings': settings or {},
+            'optimizer': {
+                'genes': self.gene_names,
+                'base_genome': self.base_genome,
+                'population_size': self.population_size,
+                'elite': self.elite,
+                'tournament_size': self.tournament_size,
+                'crossover_rate': self.crossover_rate,
+                'mutation_rate': self.mutation_rate,
+                'seed': self.seed,
+            },
+            'rng': [version, list(state), gauss_next],
+            'generation': self.generation,
+            'population': self.population,
+            'best': self.best,
+            'stats': self.stats,
+            'num_evaluations': self.num_evaluations,
+            'num_cache_hits': self.num_cache_hits,
+            'cache': self.cache,
+        }
+
+        # Write to the side then swap, so an interrupted write never clobbers the last good checkpoint
+        os.makedirs(path.dirname(path.abspath(checkpoint_path)), exist_ok=True)
+        temp_path = checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            yaml.dump(content, file)
+
+        os.replace(temp_path, checkpoint_path)
+
+
+    # Loads an optimizer from a checkpoint. Returns (optimizer, settings).
+    @staticmethod
+    def load_checkpoint(checkpoint_path):
+        with open(checkpoint_path) as file:
+            content = yaml.load(file)
+
+        if safe_get(content, 'version') != CHECKPOINT_VERSION:
+            raise Exception(f"Unsupported checkpoint version in '{checkpoint_path}'")
+
+        config = content['optimizer']
+        optimizer = GeneticOptimizer(
+            list(config['genes']),
+            config['base_genome'],
+            int(config['population_size']),
+            int(config['elite']),
+            int(config['tournament_size']),
+            float(config['crossover_rate']),
+            float(config['mutation_rate']),
+            config['seed'])
+
+        version, state, gauss_next = content['rng']
+        optimizer.rng.setstate((int(version), tuple(int(x) for x in state), gauss_next))
+
+        optimizer.generation = int(content['generation'])
+        optimizer.population = [str(x) for x in content['population']]
+        optimizer.best = dict(content['best']) if content['best'] is not None else None
+        optimizer.stats = [dict(x) for x in content['stats']]
+        optimizer.num_evaluations = int(content['num_evaluations'])
+        optimizer.num_cache_hits = int(content['num_cache_hits'])
+        optimizer.cache = { str(key): dict(value) for key, value in content['cache'].items() }
+
+        return optimizer, dict(content['settings'])
@@ -5,7 +5,7 @@ from utils import *
 
 
 class Gene:
-    def __init__(self, name, title, type, default):
+    def __init__(self, name, title, type, default, bounds=None):
         self.name = name
         self.title = title
         self.type = type
@@ -13,15 +13,16 @@ class Gene:
         self.value = default
         self.enabled = False
 
+        # Search space for numeric genes as (min, max, step). Genes without bounds are not evolved.
+        self.bounds = bounds
+
     def to_string(self):
         value_str = ''
 
         if self.type == GT.Timescale:
-            value_str = '1m' # TODO
-        elif (self.type in [GT.Num, GT.BW, GT.SW]):
-            value_str = str(self.value)
-        elif self.type == GT.Percent:
-            value_str = str(self.value * 100)
+            value_str = format_timescales(self.value)
+        elif (self.type in [GT.Num, GT.BW, GT.SW, GT.Percent]):
+            value_str = str(float(self.value))
         elif self.type == GT.Flag:
             if self.value == True:
                 value_str = 'y'
@@ -73,6 +74,14 @@ class Genotype:
         else:
             return self.genes[name].value
 
+    def set_value(self, name, value):
+        gene = self.get_gene(name)
+        if gene is None:
+            raise Exception(f"Unknown robot gene '{name}'")
+
+        gene.value = value
+        gene.enabled = True
+
     def to_string(self, full=False):
         str = ''
         for name in self.genes:
@@ -126,13 +135,14 @@ class Genotype:
                 if len(pieces) != 2:
                     raise Exception(f"Invalid genetic value '{value}'")
                 else:
-                    value = parse_timescale(pieces[1])
+                    value = parse_timescales(pieces[1])
 
+            # Percentages are held as written, in percent, so a genome reads back as it was written
             elif gene.type == GT.Percent:
                 if len(pieces) != 2:
                     raise Exception(f"Invalid genetic percentage '{value}'")
                 else:
-                    value = round(float(pieces[1]) * 100, 2)
+                    value = float(pieces[1])
 
             else:
                 raise Exception(f"Unknown gene type '{gene.type}'")
@@ -148,9 +158,10 @@ class Genotype:
 all_genes = [
 
     # General
-    Gene('TS', 'Timescale', GT.Timescale, '1m'),
-    Gene('BT', 'Buy signal threshold', GT.Num, 1),
-    Gene('ST', 'Sell signal threshold', GT.Num, 1),
+    # Bar resolutions the bot follows, e.g. TS=1m+1h
+    Gene('TS', 'Timescale', GT.Timescale, (TimeScale.MINUTE,)),
+    Gene('BT', 'Buy signal threshold', GT.Num, 1, (0, 5, 1)),
+    Gene('ST', 'Sell signal threshold', GT.Num, 1, (0, 5, 1)),
     Gene('PLI', 'Profit locking interval %',
          GT.Percent, 0.1),  # tenth-of-percent
     # one half of one-tenth percent
@@ -161,14 +172,14 @@ all_genes = [
     Gene('BBUC', 'Use close instead of low/high', GT.Flag, False),
     Gene('BBBBO', 'Buy breakouts only. Rate non-breakouts 0', GT.Flag, False),
     Gene('BBSBO', 'Sell breakouts only. Rate non-breakouts 0', GT.Flag, False),
-    Gene('BWBBL', 'Buy weight for a low escape', GT.BW, 1.0),
-    Gene('SWBBH', 'Sell weight for a high escape', GT.SW, 1.0),
+    Gene('BWBBL', 'Buy weight for a low escape', GT.BW, 1.0, (0, 2, 0.1)),
+    Gene('SWBBH', 'Sell weight for a high escape', GT.SW, 1.0, (0, 2, 0.1)),
 
     # RSI
-    Gene('RSIL', 'RSI lower threshold', GT.Num, 33.33),
-    Gene('RSIH', 'RSI upper threshold', GT.Num, 66.66),
-    Gene('BWRSI', 'Buy weight for RSI below lower', GT.Num, 1.0),
-    Gene('SWRSI', 'Sell weight for RSI above upper', GT.Num, 1.0),
+    Gene('RSIL', 'RSI lower threshold', GT.Num, 33.33, (5, 50, 0.5)),
+    Gene('RSIH', 'RSI upper threshold', GT.Num, 66.66, (50, 95, 0.5)),
+    Gene('BWRSI', 'Buy weight for RSI below lower', GT.Num, 1.0, (0, 2, 0.1)),
+    Gene('SWRSI', 'Sell weight for RSI above upper', GT.Num, 1.0, (0, 2, 0.1)),
 ]
 
 # Examples
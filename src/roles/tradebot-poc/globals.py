@@ -6,6 +6,9 @@ from genetics import *
 yaml = YAML()
 currencies: CurrencyManager = CurrencyManager()
 
+# Set by `sm --quiet`: no banner and no chart rendering
+headless = False
+
 
 def load_currencies(currencies_path) -> None:
     with open(currencies_path) as file:
@@ -3,6 +3,7 @@ import os
 import sys
 from os import path
 import datetime as dt
+from zoneinfo import ZoneInfo
 import json
 import numpy as np
 import pandas as pd
@@ -12,7 +13,6 @@ import plotly.express as px
 import plotly.graph_objects as go
 import multiprocessing
 #import requests_cache
-import threading
 import uuid
 import traceback
 
@@ -24,17 +24,27 @@ from analyzers import *
 from utils import *
 from AnalysisBatch import *
 from Workspace import *
+from JobScheduler import JobScheduler, JOB_DONE
+from storage import SymbolStore
+from storage.SymbolStore import to_epoch_days
 
 
 # Settings
 is_debugging = True
-num_threads = 8
-download_delay = 2
+num_cpu_workers = 0     # 0 uses every core
+num_io_workers = 4
+download_delay = 2      # Minimum seconds between fetches from the data provider
+job_timeout = 60 * 10
+fetch_timeout = 60 * 2
+download_timeout = 30   # Seconds a request to the data provider may take
 setting_moving_average = 10
 
 watchlist = ['SPY', 'PLTR', 'GME', 'AMC']#, 'SPY', 'GME', 'AMC', 'GOOG']
 watchlist = ['GME']
 pull_from_date = dt.datetime(2010, 1, 1).date()
+pull_refresh_rows = 5   # Stored days pulled again on each update, as providers revise them
+market_timezone = ZoneInfo('America/New_York')
+market_close = dt.time(16, 0)
 
 num_days_lookback = 260 + setting_moving_average
 num_days_lookahead = 30
@@ -43,9 +53,6 @@ end = dt.date.today()
 start = (end - dt.timedelta(days=num_days_lookback))
 
 
-job_map = {}
-symbols_updating = {}
-
 batch = None
 workspace = None
 
@@ -78,6 +85,9 @@ def entrypoint():
     ctx['num_days_lookahead'] = num_days_lookahead
     ctx['backtesting'] = True
 
+    # Jobs already occupy every core unless they run inline
+    ctx['forecast_workers'] = 0 if is_debugging else 1
+
     rcParams['figure.figsize'] = 16, 9
 
     run_analysis(ctx)
@@ -100,94 +110,61 @@ def run_analysis(ctx):
             jobs.append(job)
 
 
-    # TODO: Proper batch running, sleeping during full fetch
-    log(f"Have {len(jobs)} job(s) to schedule")
-    running = 0;
-    threads = []
-
+    # NOTE: Jobs run inline when debugging. Debugging worker threads and processes
+    # does not appear to work in VS Code.
+    scheduler = JobScheduler(cpu_workers=num_cpu_workers,
+                             io_workers=num_io_workers,
+                             fetch_rate=1 / download_delay if download_delay > 0 else 1000,
+                             timeout=job_timeout,
+                             fetch_timeout=fetch_timeout,
+                             inline=is_debugging)
 
-    job_id = 0
+    # Symbols are fetched once however many analyzers run over them
     for job in jobs:
-        job_map[job_id] = job
-        
-        # NOTE: We only use threading if we're not debugging.
-        # Debugging with thread does not appear to work in VS Code.
-        # Threads simply keep running through breakpoints.
-        if is_debugging:
-            work(job_id)
-        else:
-            # TODO: IMPORTANT: Batching with N worker threads
-            for job in jobs:
-                log(f"Dispatching worker thread for {job['name']}")
-                thread = threading.Thread(target=work, args=(job_id,), daemon=True)
-                threads.append(thread)
-                thread.start()
-                job_id = job_id + 1
-
+        scheduler.submit(job, fetch_job, work, fetch_key=job['symbol'])
 
-    # Wait for all threads to complete
-    if not is_debugging:
-        for thread in threads:
-            thread.join()
+    completed = scheduler.run()
+    for job_result in completed:
+        if job_result.status == JOB_DONE:
+            job_result.job['result'] = job_result.result
 
     #
     # FINISHED!
     #
     log(f"*** FINISHED! ***", 'fin')
+    return completed
 
 
-# Have to pass simple args here via "pickle" encoding when passing to processes and threads,
-# so we just use map lookup instead
-def work(job_no):
-    job_name = 'unknown'
-    try:
-        job = job_map[job_no]
-        ctx = job['ctx']
-        job_name = job['name']
-        tag = job_name
-        log(f"Start job #{job_no}", tag)
-
-        symbol = job['symbol']
-        analyzer = create_analyzer(job['analyzer'])
-
-        symbol_path = path.join(os.getcwd(), 'data', 'symbols', symbol)
-
-        #
-        # TODO: Thread-safe this... we may already be updating the symbol. Use a map.
-        #
-        update_symbol(symbol, job_name)
-
-        if not is_debugging and download_delay > 0:
-            sleep(download_delay)
-
-        log(f"Running analysis on stonk {symbol}...", tag)
+# Brings a job's symbol up to date. Runs on the scheduler's rate-limited I/O pool.
+def fetch_job(job):
+    update_symbol(job['symbol'], job['name'])
 
-        data = open_symbol(symbol)
 
-        data = data[ctx['num_days_lookback'] * -1:]
-        data.reset_index(inplace=True)
+# Runs a job's analyzer. Runs in a worker process; the job's result is returned to the scheduler.
+def work(job):
+    job_name = job['name']
+    ctx = job['ctx']
+    tag = job_name
+    log(f"Start job {job_name}", tag)
 
-        start = dt.datetime.now()
-        should_run = analyzer.setup(ctx, pull_from_date)
-        if should_run is not False:
-            log(f"Analyzer {analyzer.name} opts out of job {job_name}", tag)
-            analyzer.run(ctx, job, data)
+    symbol = job['symbol']
+    analyzer = create_analyzer(job['analyzer'])
 
-        end = dt.datetime.now()
-        elapsed = 0; # TODO timedelta(end - start)
+    log(f"Running analysis on stonk {symbol}...", tag)
 
-        log(f"Done running job {job_name} / {analyzer.name} / {symbol} in {elapsed}s", tag)
+    data = open_symbol(symbol, last=ctx['num_days_lookback'])
+    data.reset_index(inplace=True)
 
-        result = job['result']
+    start = dt.datetime.now()
+    should_run = analyzer.setup(ctx, pull_from_date)
+    if should_run is not False:
+        log(f"Analyzer {analyzer.name} opts out of job {job_name}", tag)
+        analyzer.run(ctx, job, data)
 
-        # TODO: Add to thread safe queue
-        #log(f"{result}", 'result')
+    elapsed = (dt.datetime.now() - start).total_seconds()
+    log(f"Done running job {job_name} / {analyzer.name} / {symbol} in {elapsed}s", tag)
 
-    except Exception as e:
-        log(f"Error running job {job_no} ({job_name}): {e}")
-        log(f"{print(traceback.format_exc())}")
-
-        # TODO: Last error in manifest?
+    return job['result']
 
 
 # Updates a particular symbol, pulling its history to date if the symbol is a new symbol.
@@ -201,7 +178,10 @@ def update_symbol(symbol, job_name, exchange = "default"):
         os.mkdir(symbol_path)
         should_update = True
 
-    if not path.exists(path.join(symbol_path, 'ticker.csv')):
+    store = SymbolStore(symbol, symbol_path)
+    convert_symbol_csv(store, symbol, symbol_path)
+
+    if not store.exists():
         should_update = True
 
     else:
@@ -220,81 +200,140 @@ def update_symbol(symbol, job_name, exchange = "default"):
             should_update = True
             pass
 
-        today = dt.date.today()
-
         if manifest['lastFetched'] is None:
             should_update = True
             last_update = pull_from_date
         else:
             last_update = dt.datetime.strptime(manifest['lastFetched'], '%Y-%m-%d').date()
-            should_update = today > last_update
+            should_update = get_last_session() > last_update
             
         log(f"Last update of {symbol} was {last_update}. Updating? {should_update}", 'fetch')
 
     if (should_update):
-        pull_symbol(symbol, symbol_path, last_update)
+        last_update = get_last_session()
+        pull_symbol(symbol, symbol_path, end=last_update)
 
         # Update manifest
-        # TODO: Handle case when last_update is before market close by setting it to yesterday
-        last_update = dt.date.today()
+        manifest['symbol'] = symbol
+        manifest['exchange'] = exchange
         manifest['lastFetched'] = last_update
 
-        if (should_update):
-            with open(path.join(symbol_path, "manifest.json"), 'w') as manifest_file:
-                content = json.dumps(manifest, indent=4, sort_keys=True, default=serializer)
-                manifest_file.write(content)
+        manifest_path = path.join(symbol_path, "manifest.json")
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            content = json.dumps(manifest, indent=4, sort_keys=True, default=serializer)
+            manifest_file.write(content)
+
+        os.replace(manifest_path + '.tmp', manifest_path)
+
 
+# Symbols pulled before the store existed only have a CSV. Converts it once, in the fetch stage:
+# analysis workers only ever read the store, since several of them may open a symbol at once.
+def convert_symbol_csv(store, symbol, symbol_path):
+    csv_path = path.join(symbol_path, 'ticker.csv')
+    if store.exists() or not path.exists(csv_path):
+        return
 
+    log(f"Building store for {symbol} from ticker.csv...", 'fetch')
+    store.append(pd.read_csv(csv_path))
 
-# Pull historical information for a given symbol, back to some predefined start date.
-def pull_symbol(symbol, symbol_path, start = pull_from_date, end = dt.date.today(), append = False):
 
-    # Create a new manifest and CSV history # TODO: Move
-    m = {}
-    m = { 'symbol': symbol, 'exchange': 'default', 'lastFetched': end }
-    with open(path.join(symbol_path, 'manifest.json'), 'w') as manifest_file:
-        content = json.dumps(m, indent=4, sort_keys=True, default=serializer)
-        manifest_file.write(content)
+# Derived moving average columns and the column each is computed from
+# TODO: Why is Adjusted Close special? Should other columns be adjusted?
+moving_average_columns = [
+    ('MovAvgClose', 'Adj Close'),
+    ('MovAvgOpen', 'Open'),
+    ('MovAvgLow', 'Low'),
+    ('MovAvgHigh', 'High'),
+    ('MovAvgVolume', 'Volume'),
+]
 
+log_digits = 6
+
+
+# Adds the derived columns to newly pulled rows. `prior` holds the source columns of the rows
+# immediately before them (at least one moving average window), so the windows that straddle
+# the boundary match a computation over the full history.
+def enrich_symbol_data(data, prior = None):
+    sources = [source for name, source in moving_average_columns]
+    num_new = len(data.index)
+
+    combined = { source: data[source].to_numpy(dtype=np.float64) for source in sources }
+    if prior is not None:
+        combined = { source: np.concatenate([np.asarray(prior[source], dtype=np.float64), values]) for source, values in combined.items() }
+
+    # TODO: Map the moving average window to a batch parameter #IMPORTANT
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, source in moving_average_columns:
+            moving_average = pd.Series(combined[source]).rolling(setting_moving_average).mean().to_numpy()[-num_new:]
+            data[name] = moving_average
+            data['Log' + name] = np.round(np.log(moving_average), log_digits)
+
+        data['LogReturns'] = np.diff(np.log(combined['Adj Close']), prepend=np.nan)[-num_new:]
+
+    return data
+
+
+# Gets the date of the last session that has closed. The current day's bar is partial until the
+# close. Market holidays need no handling, the provider has no rows for them.
+def get_last_session(now = None):
+    if now is None:
+        now = dt.datetime.now(market_timezone)
+
+    day = now.date()
+    if now.time() < market_close:
+        day -= dt.timedelta(days=1)
+
+    while day.weekday() >= 5:
+        day -= dt.timedelta(days=1)
+
+    return day
+
+
+# Pulls the days missing from a symbol's store up to the last closed session, back to some
+# predefined start date for a new symbol, and appends them. The last few stored days are pulled
+# again and replaced, as providers revise recent rows (e.g. adjusted closes after a dividend).
+# Derived columns are only computed for the pulled rows.
+def pull_symbol(symbol, symbol_path, start = pull_from_date, end = None):
+    if end is None:
+        end = get_last_session()
+
+    store = SymbolStore(symbol, symbol_path)
+    last_date = store.get_last_date()
+    if last_date is not None:
+        start = np.datetime64(int(store.get_dates()[-min(pull_refresh_rows, len(store))]), 'D').astype(dt.date)
+
+    if start > end:
+        log(f"{symbol} is up to date")
+        return 0
 
     # TODO: See available data in yFinance: https://pypi.org/project/yfinance/
     # TODO: Consider adding this stuff to manifest
     #session = requests_cache.CachedSession('yfinance.cache')
     #session.headers['User-agent'] = 'mhi-tradebot/1.0'
 
-    yf.Ticker(symbol)
-    data = yf.download(symbol, period=f"{(end - start).days}d")#, session=session)
+    # The end date is exclusive
+    data = yf.download(symbol, start=start, end=end + dt.timedelta(days=1), auto_adjust=False, timeout=download_timeout)#, session=session)
+
+    if len(data.index) == 0:
+        log(f"No rows for {symbol} since {start}")
+        return 0
 
     # Enrich the data
+    data = data.copy()
     data['symbol'] = symbol
+    dates = to_epoch_days(data.index)
 
-    # TODO: Map the moving average window to a batch parameter #IMPORTANT
-    # TODO: Why is Adjusted Close special? Should other columns be adjusted?
-    data['MovAvgClose'] = data['Adj Close'].rolling(setting_moving_average).mean().dropna()
-    data['MovAvgOpen'] = data['Open'].rolling(setting_moving_average).mean().dropna()
-    data['MovAvgLow'] = data['Low'].rolling(setting_moving_average).mean().dropna()
-    data['MovAvgHigh'] = data['High'].rolling(setting_moving_average).mean().dropna()
-    data['MovAvgVolume'] = data['Volume'].rolling(setting_moving_average).mean().dropna()
+    prior = None
+    if last_date is not None:
+        prior_end = np.datetime64(int(dates[0]) - 1, 'D')
+        prior, _ = store.read(end=prior_end, last=setting_moving_average, columns=[source for name, source in moving_average_columns])
 
-    #data['LogReturns'] = data['Adj Close'].apply(np.log).diff().dropna()
-    #data['LogMovAvg'] = data['MovAvg'].apply(np.log).apply(lambda x: round(x, 2))
-    digits = 6
-    data['LogMovAvgOpen'] = data['MovAvgOpen'].apply(np.log).apply(lambda x: round(x, digits))
-    data['LogMovAvgClose'] = data['MovAvgClose'].apply(np.log).apply(lambda x: round(x, digits))
-    data['LogMovAvgLow'] = data['MovAvgLow'].apply(np.log).apply(lambda x: round(x, digits))
-    data['LogMovAvgHigh'] = data['MovAvgHigh'].apply(np.log).apply(lambda x: round(x, digits))
-    data['LogMovAvgVolume'] = data['MovAvgVolume'].apply(np.log).apply(lambda x: round(x, digits))
+    data = enrich_symbol_data(data, prior)
 
-    data['LogReturns'] = data['Adj Close'].apply(np.log).diff().dropna()
-
-    # Re-order so symbol is first column
-    #cols = reversed(data.columns.tolist())
-    #cols = cols[-1:] + cols[:-1]
-    #data = data[cols]
-
-    log(f"Pulled {len(data.index)} rows for {symbol}")
-
-    data.to_csv(path.join(symbol_path, 'ticker.csv'))
+    num_pulled = store.append(data, replace=True)
+    num_new = num_pulled if last_date is None else int(np.count_nonzero(dates > last_date))
+    log(f"Pulled {num_pulled} rows for {symbol}, {num_new} new")
+    return num_new
 
 
 # Comment
@@ -303,9 +342,15 @@ def run_full_analysis():
     print ("Running full analysis on all watchlist symbols")
 
 
-# "Opens" a symbol and returns its history
-def open_symbol(stonk, exch = "NYSE"):
-    return pd.read_csv(path.join(os.getcwd(), 'data', 'symbols', stonk, 'ticker.csv'))
+# "Opens" a symbol and returns its history between `start` and `end` (inclusive), or its `last` N days.
+# The index holds each row's position in the full history. Read-only; update_symbol builds the store.
+def open_symbol(stonk, exch = "NYSE", start = None, end = None, last = None):
+    symbol_path = path.join(os.getcwd(), 'data', 'symbols', stonk)
+    store = SymbolStore(stonk, symbol_path)
+    if not store.exists():
+        raise Exception(f"No store for {stonk} at {symbol_path}. Fetch it first (see update_symbol).")
+
+    return store.to_frame(start, end, last)
 
 
 # Runs a report for a particular symbol
@@ -364,4 +409,6 @@ def deserialize(pairs, format='%Y-%m-%d'):
             d[k] = v
     return d
 
-entrypoint()
+# Analysis processes import this module, so only the main process runs it
+if __name__ == '__main__':
+    entrypoint()
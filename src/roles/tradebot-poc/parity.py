@@ -0,0 +1,170 @@
+import os
+import asyncio
+import tempfile
+import numpy as np
+import globals
+from utils import *
+from genetics import Genotype
+from bots.TradeBot import TradeBot
+from bots.Signals import SIGNAL_RSI_PERIOD
+from bots.ReplayEngine import ReplayEngine
+from bots.VectorBacktest import VectorBacktest
+from bots.KlineHistory import HISTORY_INTERVAL_MS, get_kline_columns
+from PersistenceWorker import get_persistence_worker
+
+
+#
+# Parity check between the backtesters and the bot's tick path.
+#
+# A synthetic history is generated from a fixed seed and played back through a real TradeBot one
+# closed kline at a time via handle_symbol_tick, with orders placed against a stand-in exchange
+# that accepts test orders. The bot's trades and total profit must match both ReplayEngine and
+# VectorBacktest over the same closes: all three are meant to give the same interval-granularity
+# results of the live rules.
+#
+# The bot is run in a scratch directory, so its state and journal don't touch output/.
+#
+
+PARITY_SYMBOL = 'BTC_BUSD'
+
+# The bot runs in on the closes the vectorized RSI can't be rated on yet, so neither side can
+# trade during them
+PARITY_RUNIN = SIGNAL_RSI_PERIOD
+
+# The bot rounds prices and quantities to the symbol's filters. Synthetic prices are on the tick
+# grid; quantities are rounded down to the lot step, so they are compared with this tolerance.
+PARITY_TICK_SIZE = '0.01'
+PARITY_STEP_SIZE = '0.00000001'
+PARITY_REL_TOL = 1e-6
+
+
+#
+# Accepts test orders, like the exchange does for valid ones. Parity runs never trade live.
+#
+class ParityClient:
+    async def create_test_order(self, **params):
+        return {}
+
+
+    async def create_order(self, **params):
+        raise Exception("Parity runs never place live orders")
+
+
+# Noisy cycles around a fixed price, so RSI swings through both thresholds and exits clear the
+# target yield. Returns klines in the REST layout.
+def make_synthetic_klines(num_intervals, seed, start_time):
+    rng = np.random.default_rng(seed)
+    cycles = 4 * np.sin(2 * np.pi * np.arange(num_intervals) / 40)
+    close = np.round(100 + cycles + rng.normal(0, 0.5, num_intervals), 2)
+
+    klines = []
+    prev_close = close[0]
+    for i, price in enumerate(close.tolist()):
+        open_time = start_time + i * HISTORY_INTERVAL_MS
+        high = max(prev_close, price) + 0.05
+        low = min(prev_close, price) - 0.05
+        klines.append([open_time, f"{prev_close:.2f}", f"{high:.2f}", f"{low:.2f}", f"{price:.2f}", '10.0',
+                       open_time + HISTORY_INTERVAL_MS - 1, f"{10 * price:.2f}", 100, '5.0', f"{5 * price:.2f}"])
+        prev_close = price
+
+    return klines
+
+
+# Gets a closed kline as the payload of a kline stream event
+def get_stream_payload(api_symbol, kline):
+    return {
+        'e': 'kline', 'E': kline[6], 's': api_symbol,
+        't': kline[0], 'T': kline[6], 'o': kline[1], 'h': kline[2], 'l': kline[3], 'c': kline[4],
+        'v': kline[5], 'q': kline[7], 'n': kline[8], 'V': kline[9], 'Q': kline[10], 'x': True,
+    }
+
+
+# Plays the klines back through a TradeBot, one closed interval per tick.
+# Returns the bot's trades as (interval index, type, price, quantity), its total profit and the
+# signal params it traded with.
+async def run_tick_path(klines, genome, budget, wager, runin):
+    api_symbol = PARITY_SYMBOL.replace('_', '')
+    bot = TradeBot(None, PARITY_SYMBOL, [], 'parity', 'parity', genome)
+    bot.is_capturing = False
+    bot.is_playback = True
+    bot.symbol_info = { 'filters': [
+        { 'filterType': 'PRICE_FILTER', 'tickSize': PARITY_TICK_SIZE },
+        { 'filterType': 'LOT_SIZE', 'stepSize': PARITY_STEP_SIZE },
+    ]}
+
+    await bot.initialize(ParityClient(), get_kline_columns(klines[:runin]))
+    bot.state.budget = budget
+    bot.state.default_trade_pct = wager
+
+    trades = []
+    for ix in range(runin, len(klines)):
+        num_trades = len(bot.state.trades)
+        await bot.handle_symbol_tick('kline', klines[ix][6], api_symbol, get_stream_payload(api_symbol, klines[ix]))
+
+        for trade in list(bot.state.trades)[num_trades:]:
+            trades.append((ix, trade.type, trade.price, trade.quantity))
+
+    profit = bot.state.total_profit
+    bot.disconnect()
+    return trades, profit, bot.signal_params
+
+
+# Compares the tick path's trades and profit to a backtester's. Returns the mismatches.
+def compare_results(name, trades, profit, result):
+    mismatches = []
+    expected = [(ix, trade_type, price, quantity) for ix, trade_time, trade_type, price, quantity in result.trades]
+
+    if len(trades) != len(expected):
+        mismatches.append(f"{len(trades)} trades on the tick path vs {len(expected)} in the {name}")
+
+    for a, b in zip(trades, expected):
+        if a[0] != b[0] or a[1] != b[1] or not np.isclose(a[2], b[2], rtol=PARITY_REL_TOL) or not np.isclose(a[3], b[3], rtol=PARITY_REL_TOL):
+            mismatches.append(f"Tick path trade {a} vs {name} trade {b}")
+            break
+
+    if not np.isclose(profit, result.total_profit, rtol=PARITY_REL_TOL, atol=PARITY_REL_TOL):
+        mismatches.append(f"Total profit {profit} on the tick path vs {result.total_profit} in the {name}")
+
+    return mismatches
+
+
+def run_parity_command(args):
+    num_intervals = int(args['intervals'])
+    seed = int(args['seed'])
+    genome = args['genome']
+    budget = float(args['budget_initial'])
+    wager = float(args['wager_initial'])
+
+    # No charts from the bot's run-in
+    globals.headless = True
+
+    start_time = 1600000000000 - 1600000000000 % HISTORY_INTERVAL_MS
+    klines = make_synthetic_klines(num_intervals, seed, start_time)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        os.makedirs('output')
+
+        try:
+            loop = asyncio.new_event_loop()
+            trades, profit, params = loop.run_until_complete(run_tick_path(klines, genome, budget, wager, PARITY_RUNIN))
+            loop.close()
+            get_persistence_worker().flush()
+
+        finally:
+            os.chdir(cwd)
+
+    open_time = np.asarray([kl[0] for kl in klines], dtype=np.int64)
+    close = np.asarray([float(kl[4]) for kl in klines], dtype=np.float64)
+    replayed = ReplayEngine(params, budget, wager).run_intervals(open_time, close)
+    vectorized = VectorBacktest(params, budget, wager).run(open_time, close)
+
+    mismatches = compare_results('replay engine', trades, profit, replayed) + compare_results('vectorized backtest', trades, profit, vectorized)
+    if len(mismatches) > 0:
+        raise Exception("Backtests do not match the tick path:\n" + '\n'.join(mismatches))
+
+    if len(trades) == 0:
+        raise Exception(f"No trades over {num_intervals} intervals (seed {seed}); parity is vacuous. Try another seed or genome.")
+
+    log(f"Replay engine and vectorized backtest match the tick path over {num_intervals} intervals: {len(trades)} trades, profit {profit:.6f}", 'parity')
@@ -1,19 +1,23 @@
 import click
-
-import AnalysisBatch
-import DefaultParamBlock
-import Workspace
+import globals
 import version
 
-from art import *
-from trade import run_trade_command
 from globals import *
 from utils import *
 
 
+# Commands import their modules when they run, so e.g. a sweep never loads the exchange client
+# and `sm --help` loads neither. See bench.py for the startup budget.
 @click.group()
-def cli():
-    return
+@click.option('--quiet', is_flag=True, default=False, help='Headless: no banner and no charts')
+def cli(quiet):
+    globals.headless = quiet
+    if quiet:
+        return
+
+    from art import tprint
+    tprint(f'STONKMINER')
+    print(f"v{version.STONKMINER_VERSION_SEMVER}-{version.STONKMINER_VERSION_SOURCE}\n\n")
 
 
 @click.command()
@@ -32,6 +36,8 @@ def cli():
 @click.option('--wager-initial', default=0.1, help='The percentage of the budget to place on each trade')
 @click.option('--yield-target', default=0.01, help='The relative percent of last interval close to consider a trade profitable')
 @click.option('--genome', default='', help='The bot genome to run/test/trade with')
+@click.option('--vectorized', is_flag=True, default=False, help='Backtest over closed intervals only with the vectorized evaluator, for fast screening')
+@click.option('--parity', is_flag=True, default=False, help='Verify that the vectorized evaluator matches the replay engine for the backtest')
 @click.pass_context
 def bot(ctx, dev,
     fwdtest,
@@ -47,15 +53,97 @@ def bot(ctx, dev,
     budget_initial,
     wager_initial,
     yield_target,
-    genome):
+    genome,
+    vectorized,
+    parity):
 
+    from trade import run_trade_command
     run_trade_command(ctx.params)
 
 
+@click.command()
+@click.option('--backtest', required=True, help='The captured backtest to sweep over. See README for examples.')
+@click.option('--grid', required=True, help='Genes to sweep, ex: "RSIL=20:40:5|RSIH=60,70,80|BBSBO=y,n"')
+@click.option('--genome', default='', help='Base genome for genes that are not part of the grid')
+@click.option('--budget-initial', default=1000, help='Budget in the quote currency for every backtest')
+@click.option('--wager-initial', default=0.1, help='The percentage of the budget to place on each trade')
+@click.option('--yield-target', default=0.01, help='The relative percent of last interval close to consider a trade profitable')
+@click.option('--ticks', is_flag=True, default=False, help='Replay captured ticks instead of evaluating closed intervals only')
+@click.option('--workers', default=0, help='Number of worker processes. Defaults to the number of cores.')
+@click.option('--out', default='', help='Results file. Defaults to output/sweep-<backtest>-<time>.csv')
+@click.pass_context
+def sweep(ctx, backtest, grid, genome, budget_initial, wager_initial, yield_target, ticks, workers, out):
+    from sweep import run_sweep_command
+    run_sweep_command(ctx.params)
+
+
+@click.command()
+@click.option('--backtest', default='', help='The captured backtest to evolve against. See README for examples.')
+@click.option('--genome', default='', help='Base genome. Seeds the first generation and holds the genes that are not evolved.')
+@click.option('--genes', default='', help='Comma-separated genes to evolve. Defaults to the genes the trading rules read.')
+@click.option('--population', default=40, help='Individuals per generation')
+@click.option('--generations', default=20, help='Total number of generations to run, including any resumed ones')
+@click.option('--elite', default=2, help='Best individuals carried over unchanged to the next generation')
+@click.option('--tournament', default=3, help='Tournament size for parent selection')
+@click.option('--crossover-rate', default=0.7, help='Probability that a child is bred from two parents')
+@click.option('--mutation-rate', default=0.2, help='Probability that each gene of a child mutates')
+@click.option('--seed', default=None, type=int, help='Random seed, for reproducible runs')
+@click.option('--budget-initial', default=1000, help='Budget in the quote currency for every backtest')
+@click.option('--wager-initial', default=0.1, help='The percentage of the budget to place on each trade')
+@click.option('--yield-target', default=0.01, help='The relative percent of last interval close to consider a trade profitable')
+@click.option('--ticks', is_flag=True, default=False, help='Replay captured ticks instead of evaluating closed intervals only')
+@click.option('--workers', default=0, help='Number of worker processes. Defaults to the number of cores.')
+@click.option('--checkpoint', default='', help='Checkpoint file. Defaults to output/evolve-<backtest>-<time>.yaml')
+@click.option('--resume', default='', help='Resume from a checkpoint. Backtest and trade settings are taken from the checkpoint.')
+@click.pass_context
+def evolve(ctx, backtest, genome, genes, population, generations, elite, tournament, crossover_rate, mutation_rate, seed,
+           budget_initial, wager_initial, yield_target, ticks, workers, checkpoint, resume):
+    from evolve import run_evolve_command
+    run_evolve_command(ctx.params)
+
+
+@click.command()
+@click.option('--runs', default=5, help='Cold starts to measure per target')
+@click.option('--budget-scale', default=1.0, help='Scales every budget, e.g. for slow machines')
+@click.pass_context
+def bench(ctx, runs, budget_scale):
+    from bench import run_bench_command
+    run_bench_command(ctx.params)
+
+
+@click.command()
+@click.option('--intervals', default=2000, help='Synthetic intervals to run through both backtest paths')
+@click.option('--seed', default=7, help='Seed of the synthetic history')
+@click.option('--genome', default='', help='The bot genome to check')
+@click.option('--budget-initial', default=1000, help='Budget in the quote currency')
+@click.option('--wager-initial', default=0.1, help='The percentage of the budget to place on each trade')
+@click.pass_context
+def parity(ctx, intervals, seed, genome, budget_initial, wager_initial):
+    from parity import run_parity_command
+    run_parity_command(ctx.params)
+
+
+@click.command()
+@click.option('--fleet', required=True, help='Fleet file listing the bots to run, one per symbol and genome. See fleet.py.')
+@click.option('--LIVE', is_flag=True, default=False, help='Perform actual live trading for every bot in the fleet')
+@click.option('--capture', is_flag=True, default=False, help='Capture ticks and historical data for replay')
+@click.option('--budget-initial', default=0, help='Default initial budget for new bots, in the quote currency')
+@click.option('--wager-initial', default=0.1, help='Default percentage of the budget to place on each trade')
+@click.option('--yield-target', default=0.01, help='Default relative percent of last interval close to consider a trade profitable')
+@click.option('--weight-limit', default=1200, help='REST request weight per minute shared by the whole fleet')
+@click.pass_context
+def fleet(ctx, fleet, live, capture, budget_initial, wager_initial, yield_target, weight_limit):
+    from fleet import run_fleet_command
+    run_fleet_command(ctx.params)
+
+
 cli.add_command(bot)
+cli.add_command(sweep)
+cli.add_command(evolve)
+cli.add_command(fleet)
+cli.add_command(bench)
+cli.add_command(parity)
 
-tprint(f'STONKMINER')
-print(f"v{version.STONKMINER_VERSION_SEMVER}-{version.STONKMINER_VERSION_SOURCE}\n\n")
 if __name__ == '__main__':
     currencies_path = "./data/currencies.yml"
     log(f"Loading currencies from {currencies_path}...", 'tool')
@@ -0,0 +1,266 @@
+import os
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+from utils import *
+
+
+#
+# Append-only, chunked binary columnar file.
+#
+# Layout:
+#   header   FILE_MAGIC | u32 length | JSON schema (columns, dtypes, codec), padded to 8 bytes
+#   chunk    CHUNK_MAGIC | u32 rows | u64 payload length | u32 CRC-32 of payload | u32 reserved
+#            payload: per column, u64 block length followed by the (optionally compressed) block,
+#            padded to 8 bytes
+#   ...
+#   footer   u64 end of the last chunk | u64 number of chunks | FOOTER_MAGIC
+#
+# An append overwrites the fixed-size footer with the new chunk and writes a new footer after it,
+# so the cost of an append is proportional to the rows appended rather than the size of the file.
+# The chunk index is not stored: it is read off the chunk headers when the file is opened, and
+# must end where the footer says. If the footer is missing or damaged (e.g. a capture was killed
+# mid-write), the chunks are verified against their checksums instead and the file is truncated
+# after the last intact one.
+#
+# Uncompressed files are read through a memory map without decoding.
+#
+
+COLUMNAR_EXT = '.smcol'
+
+FILE_MAGIC = b'SMCOL\x00\x01\x00'
+FOOTER_MAGIC = b'SMCOLIX1'
+CHUNK_MAGIC = b'CHNK'
+
+CODEC_NONE = 'none'
+CODEC_ZLIB = 'zlib'
+codecs = [CODEC_NONE, CODEC_ZLIB]
+
+chunk_header = struct.Struct('<4sIQII')
+block_header = struct.Struct('<Q')
+footer = struct.Struct('<QQ8s')
+
+
+def _padding(size):
+    return (8 - size % 8) % 8
+
+
+class ColumnarFile:
+    # Opens `file_path`. A new file is created when it does not exist, which requires `schema`,
+    # a list of (column name, dtype) pairs.
+    def __init__(self, file_path, schema = None, codec = CODEC_NONE, compression_level = 6):
+        self.path = file_path
+        self.compression_level = compression_level
+        self.chunks = []
+        self.num_rows = 0
+
+        if os.path.exists(file_path):
+            self.read_header()
+            self.read_index()
+        else:
+            if schema is None:
+                raise Exception(f"Columnar file '{file_path}' does not exist and no schema was given")
+
+            if codec not in codecs:
+                raise Exception(f"Unknown codec '{codec}'")
+
+            self.schema = [(name, np.dtype(dtype)) for name, dtype in schema]
+            self.codec = codec
+            self.write_header()
+
+        self.columns = [name for name, dtype in self.schema]
+        self.dtypes = dict(self.schema)
+
+
+    def __len__(self):
+        return self.num_rows
+
+
+    def write_header(self):
+        header = json.dumps({
+            'columns': [[name, dtype.str] for name, dtype in self.schema],
+            'codec': self.codec,
+        }).encode('utf-8')
+
+        with open(self.path, 'wb') as file:
+            file.write(FILE_MAGIC)
+            file.write(struct.pack('<I', len(header)))
+            file.write(header)
+            file.write(b'\x00' * _padding(len(FILE_MAGIC) + 4 + len(header)))
+            self.data_start = file.tell()
+            self.data_end = self.data_start
+            self.write_footer(file)
+
+
+    def read_header(self):
+        with open(self.path, 'rb') as file:
+            magic = file.read(len(FILE_MAGIC))
+            if magic != FILE_MAGIC:
+                raise Exception(f"'{self.path}' is not a columnar file")
+
+            size = struct.unpack('<I', file.read(4))[0]
+            header = json.loads(file.read(size).decode('utf-8'))
+
+        self.schema = [(name, np.dtype(dtype)) for name, dtype in header['columns']]
+        self.codec = header['codec']
+        self.data_start = len(FILE_MAGIC) + 4 + size + _padding(len(FILE_MAGIC) + 4 + size)
+
+
+    # Loads the chunk index from the chunk headers up to the footer, falling back to a full scan
+    # if the footer is unusable
+    def read_index(self):
+        file_size = os.path.getsize(self.path)
+
+        with open(self.path, 'rb') as file:
+            try:
+                if file_size < self.data_start + footer.size:
+                    raise Exception(f"Missing footer")
+
+                file.seek(file_size - footer.size)
+                data_end, num_chunks, magic = footer.unpack(file.read(footer.size))
+                if magic != FOOTER_MAGIC or data_end != file_size - footer.size:
+                    raise Exception(f"Missing footer")
+
+                self.chunks = self.walk(file, data_end)
+                if len(self.chunks) != num_chunks:
+                    raise Exception(f"Footer lists {num_chunks} chunks, found {len(self.chunks)}")
+
+                self.data_end = data_end
+
+            except Exception as e:
+                log(f"Columnar file '{self.path}' has no valid index ({e}). Recovering chunks...", 'storage')
+                self.recover(file, file_size)
+
+        self.num_rows = sum([rows for offset, rows in self.chunks])
+
+
+    # Gets the (offset, rows) of the chunks between the header and `data_end` from their headers
+    def walk(self, file, data_end):
+        chunks = []
+        offset = self.data_start
+
+        if data_end > offset:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                while offset + chunk_header.size <= data_end:
+                    magic, rows, payload_size, crc, reserved = chunk_header.unpack_from(buffer, offset)
+                    if magic != CHUNK_MAGIC:
+                        break
+
+                    chunks.append((offset, rows))
+                    offset += chunk_header.size + payload_size
+
+        if offset != data_end:
+            raise Exception(f"Chunks end at {offset}, not {data_end}")
+
+        return chunks
+
+
+    # Rebuilds the index by walking the chunks. Stops at the first truncated or corrupt chunk.
+    def recover(self, file, file_size):
+        self.chunks = []
+        offset = self.data_start
+
+        while offset + chunk_header.size <= file_size:
+            file.seek(offset)
+            magic, rows, payload_size, crc, reserved = chunk_header.unpack(file.read(chunk_header.size))
+            if magic != CHUNK_MAGIC or offset + chunk_header.size + payload_size > file_size:
+                break
+
+            if zlib.crc32(file.read(payload_size)) != crc:
+                break
+
+            self.chunks.append((offset, rows))
+            offset += chunk_header.size + payload_size
+
+        self.data_end = offset
+        log(f"Recovered {len(self.chunks)} chunks from '{self.path}'", 'storage')
+
+
+    def write_footer(self, file):
+        file.write(footer.pack(self.data_end, len(self.chunks), FOOTER_MAGIC))
+        file.truncate()
+
+
+    # Appends rows as a new chunk. `data` maps every column name to an array-like of equal length.
+    def append(self, data):
+        rows = None
+        blocks = []
+
+        for name, dtype in self.schema:
+            if name not in data:
+                raise Exception(f"Missing column '{name}' appending to '{self.path}'")
+
+            values = np.ascontiguousarray(data[name], dtype=dtype)
+            if rows is None:
+                rows = len(values)
+            elif len(values) != rows:
+                raise Exception(f"Column '{name}' has {len(values)} rows, expected {rows}")
+
+            block = values.tobytes()
+            if self.codec == CODEC_ZLIB:
+                block = zlib.compress(block, self.compression_level)
+
+            blocks.append(block_header.pack(len(block)))
+            blocks.append(block)
+            blocks.append(b'\x00' * _padding(len(block)))
+
+        if not rows:
+            return 0
+
+        payload = b''.join(blocks)
+        offset = self.data_end
+
+        with open(self.path, 'r+b') as file:
+            file.seek(offset)
+            file.write(chunk_header.pack(CHUNK_MAGIC, rows, len(payload), zlib.crc32(payload), 0))
+            file.write(payload)
+
+            self.chunks.append((offset, rows))
+            self.data_end = file.tell()
+            self.write_footer(file)
+
+        self.num_rows += rows
+        return rows
+
+
+    # Reads columns (all if `names` is None) as a dict of arrays. Uncompressed single-chunk columns
+    # are zero-copy, read-only views over a memory map of the file.
+    def read(self, names = None):
+        if names is None:
+            names = self.columns
+
+        for name in names:
+            if name not in self.dtypes:
+                raise Exception(f"Unknown column '{name}' in '{self.path}'")
+
+        if self.num_rows == 0:
+            return { name: np.zeros(0, dtype=self.dtypes[name]) for name in names }
+
+        with open(self.path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        pieces = { name: [] for name in names }
+        for offset, rows in self.chunks:
+            pos = offset + chunk_header.size
+
+            for name, dtype in self.schema:
+                size = block_header.unpack_from(buffer, pos)[0]
+                pos += block_header.size
+
+                if name in pieces:
+                    if self.codec == CODEC_ZLIB:
+                        values = np.frombuffer(zlib.decompress(buffer[pos:pos + size]), dtype=dtype)
+                    else:
+                        values = np.frombuffer(buffer, dtype=dtype, count=rows, offset=pos)
+
+                    pieces[name].append(values)
+
+                pos += size + _padding(size)
+
+        return { name: chunks[0] if len(chunks) == 1 else np.concatenate(chunks) for name, chunks in pieces.items() }
+
+
+    def read_column(self, name):
+        return self.read([name])[name]
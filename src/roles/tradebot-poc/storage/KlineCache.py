@@ -0,0 +1,202 @@
+import os
+import threading
+import time as systime
+import numpy as np
+from os import path
+from utils import *
+from PersistenceWorker import get_persistence_worker
+from .ColumnarFile import ColumnarFile, COLUMNAR_EXT
+
+
+KLINE_CACHE_DIR = path.join('output', 'klines')
+
+# Live bars are buffered and written this many at a time, to keep chunks (and the index) small
+KLINE_CACHE_FLUSH_ROWS = 60
+
+# Most klines the exchange returns per request
+KLINE_CACHE_PAGE_SIZE = 1000
+
+# Columns of REST klines, in order. Times are Unix epoch millis.
+kline_cache_dtypes = {
+    'open-time': np.int64,
+    'open': np.float64,
+    'high': np.float64,
+    'low': np.float64,
+    'close': np.float64,
+    'volume': np.float64,
+    'close-time': np.int64,
+    'quote-asset-volume': np.float64,
+    'num-trades': np.int64,
+    'taker-buy-base-volume': np.float64,
+    'taker-buy-quote-volume': np.float64,
+}
+
+
+#
+# Persistent cache of closed klines for one symbol and interval.
+#
+# Klines are kept in an append-only ColumnarFile (`output/klines/<SYMBOL>-<interval>.smcol`) in
+# strictly increasing open time, so a time range is found with a binary search over the open
+# times and read through a memory map. Only closed bars are stored: the bar in progress at the
+# end of a REST response is dropped.
+#
+# On startup, `load` fetches just the klines after the last cached one and returns the requested
+# range as columns, so a restart costs one small REST request instead of the whole run-in. While running,
+# bots add each closed bar from the stream (and any backfilled ones); they are written in
+# batches of KLINE_CACHE_FLUSH_ROWS on the persistence worker. Bars that were still buffered at
+# exit are simply fetched again on the next start.
+#
+# Use get_kline_cache() so every bot trading a symbol shares one instance.
+#
+class KlineCache:
+    def __init__(self, api_symbol, interval = '1m', cache_dir = KLINE_CACHE_DIR, persistence = None):
+        self.api_symbol = api_symbol
+        self.interval = interval
+        self.interval_ms = timescale_millis[parse_timescale(interval)]
+        self.persistence = persistence
+        self.lock = threading.Lock()
+        self.pending = []
+
+        if not path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.path = path.join(cache_dir, f"{api_symbol}-{interval}{COLUMNAR_EXT}")
+        self.file = ColumnarFile(self.path, list(kline_cache_dtypes.items()))
+
+        open_times = self.file.read_column('open-time')
+        self.first_open_time = int(open_times[0]) if len(open_times) > 0 else None
+        self.last_open_time = int(open_times[-1]) if len(open_times) > 0 else None
+
+
+    def __len__(self):
+        return len(self.file)
+
+
+    # Adds a closed kline (REST layout). Written once enough have been buffered.
+    def add(self, kline):
+        self.pending.append(kline)
+        if len(self.pending) >= KLINE_CACHE_FLUSH_ROWS:
+            self.flush()
+
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        klines = self.pending
+        self.pending = []
+
+        if self.persistence is not None:
+            self.persistence.submit(self.write, klines)
+        else:
+            self.write(klines)
+
+
+    # Appends klines that are newer than the last cached one. Returns the number written.
+    def write(self, klines):
+        with self.lock:
+            last_open_time = self.last_open_time if self.last_open_time is not None else -1
+            rows = []
+            for kl in klines:
+                open_time = to_millis(kl[0])
+                if open_time > last_open_time:
+                    rows.append(kl)
+                    last_open_time = open_time
+
+            if len(rows) == 0:
+                return 0
+
+            data = {}
+            for ix, (name, dtype) in enumerate(kline_cache_dtypes.items()):
+                values = [row[ix] for row in rows]
+                if name in ['open-time', 'close-time']:
+                    values = [to_millis(value) for value in values]
+                elif dtype == np.int64:
+                    values = [int(float(value)) for value in values]
+
+                data[name] = np.asarray(values, dtype=np.float64 if dtype == np.float64 else np.int64)
+
+            self.file.append(data)
+            if self.first_open_time is None:
+                self.first_open_time = int(data['open-time'][0])
+
+            self.last_open_time = last_open_time
+            return len(rows)
+
+
+    # Reads the cached klines opening at or after `start` (millis) as columns
+    def read(self, start = None):
+        with self.lock:
+            data = self.file.read()
+
+        if start is None:
+            return data
+
+        ix = int(np.searchsorted(data['open-time'], start, side='left'))
+        return { name: values[ix:] for name, values in data.items() }
+
+
+    # Reads the cached klines opening at or after `start` as rows in the REST layout
+    def get_klines(self, start = None):
+        data = self.read(start)
+        columns = [data[name].tolist() for name in kline_cache_dtypes]
+        return [list(row) for row in zip(*columns)]
+
+
+    # Fetches whatever is missing between `start` (millis) and now, then returns the klines from
+    # `start` on as columns, read straight from the memory-mapped file (see TradeBot.intake_kline_columns)
+    async def load(self, client, start):
+        start = start - start % self.interval_ms
+        now = int(systime.time() * 1000)
+
+        self.flush()
+        if self.persistence is not None:
+            await self.persistence.flush_async()
+
+        # The cache is kept contiguous, so it is started over if it doesn't reach back to `start`
+        # or has gone stale since
+        fetch_start = start
+        if self.last_open_time is not None:
+            if self.first_open_time <= start and self.last_open_time + self.interval_ms >= start:
+                fetch_start = self.last_open_time + self.interval_ms
+            else:
+                self.reset()
+
+        num_fetched = 0
+        while fetch_start + self.interval_ms <= now:
+            klines = await client.get_klines(symbol=self.api_symbol, interval=self.interval, startTime=fetch_start, limit=KLINE_CACHE_PAGE_SIZE)
+            closed = [kl for kl in klines if int(kl[6]) < now]
+            if len(closed) == 0:
+                break
+
+            num_fetched += self.write(closed)
+            fetch_start = int(closed[-1][0]) + self.interval_ms
+
+            if len(klines) < KLINE_CACHE_PAGE_SIZE:
+                break
+
+        columns = self.read(start)
+        log(f"Loaded {len(columns['open-time'])} {self.interval} kline(s) for {self.api_symbol}, {num_fetched} of them fetched", 'storage')
+        return columns
+
+
+    def reset(self):
+        with self.lock:
+            os.remove(self.path)
+            self.file = ColumnarFile(self.path, list(kline_cache_dtypes.items()))
+            self.first_open_time = None
+            self.last_open_time = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# Gets the process-wide cache for a symbol and interval, opening it on first use
+def get_kline_cache(api_symbol, interval = '1m'):
+    key = (api_symbol, interval)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = KlineCache(api_symbol, interval, persistence=get_persistence_worker())
+
+        return _caches[key]
@@ -0,0 +1,192 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from os import path
+from utils import *
+
+
+#
+# Per-symbol store of daily history as fixed-width numeric columns.
+#
+# Each column is a flat little-endian file of float64s, plus an int64 column of days since the
+# Unix epoch that acts as the date index. Readers memory-map the columns and slice date ranges
+# with a binary search, so opening a symbol costs nothing proportional to its history and
+# concurrent readers share the page cache rather than each holding a parsed copy.
+#
+# The manifest's row count is the commit point: appends write the column files first and then
+# replace the manifest, so rows past the committed count (from an interrupted append) are never
+# read and are truncated by the next append. Rows being replaced are uncommitted before they are
+# rewritten.
+#
+
+STORE_DIR = 'store'
+STORE_MANIFEST = 'store.json'
+STORE_DATE_COLUMN = 'Date'
+STORE_DATE_FORMAT = '%Y-%m-%d'
+
+date_dtype = np.dtype('<i8')
+value_dtype = np.dtype('<f8')
+
+
+# Converts dates (strings, datetimes or datetime64s) to days since the Unix epoch
+def to_epoch_days(dates):
+    return pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+
+
+class SymbolStore:
+    def __init__(self, symbol, symbol_path):
+        self.symbol = symbol
+        self.path = path.join(symbol_path, STORE_DIR)
+        self.columns = []
+        self.num_rows = 0
+        self.load_manifest()
+
+
+    def __len__(self):
+        return self.num_rows
+
+
+    def exists(self):
+        return path.exists(path.join(self.path, STORE_MANIFEST))
+
+
+    def load_manifest(self):
+        if not self.exists():
+            return
+
+        with open(path.join(self.path, STORE_MANIFEST)) as file:
+            manifest = json.load(file)
+
+        self.columns = manifest['columns']
+        self.num_rows = int(manifest['rows'])
+
+
+    def save_manifest(self):
+        manifest_path = path.join(self.path, STORE_MANIFEST)
+        temp_path = manifest_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({ 'symbol': self.symbol, 'columns': self.columns, 'rows': self.num_rows }, file, indent=4)
+
+        os.replace(temp_path, manifest_path)
+
+
+    def get_column_path(self, ix):
+        return path.join(self.path, f"{ix}.bin")
+
+
+    def get_date_path(self):
+        return path.join(self.path, 'date.bin')
+
+
+    def open_column(self, file_path, dtype):
+        if self.num_rows == 0:
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(file_path, dtype=dtype, mode='r', shape=(self.num_rows,))
+
+
+    # Gets the date index as days since the Unix epoch
+    def get_dates(self):
+        return self.open_column(self.get_date_path(), date_dtype)
+
+
+    # Gets the last stored date as days since the Unix epoch, or None if the store is empty
+    def get_last_date(self):
+        if self.num_rows == 0:
+            return None
+
+        return int(self.get_dates()[-1])
+
+
+    # Appends the rows of `data` that are newer than the last stored date. With `replace`, the stored
+    # rows from the first date in `data` on are replaced by its rows instead. Dates are taken from
+    # the 'Date' column if present, otherwise from the index. Returns the number of rows written.
+    def append(self, data: pd.DataFrame, replace = False):
+        if STORE_DATE_COLUMN in data.columns:
+            dates = to_epoch_days(data[STORE_DATE_COLUMN])
+        else:
+            dates = to_epoch_days(data.index)
+
+        if replace and self.num_rows > 0 and len(dates) > 0:
+            keep = int(np.searchsorted(self.get_dates(), dates[0], side='left'))
+
+            # Uncommit the replaced rows first. If the append is interrupted they are missing rather
+            # than mixed with the new ones, and the next pull fetches them again.
+            if keep < self.num_rows:
+                self.num_rows = keep
+                self.save_manifest()
+
+        numeric = data.select_dtypes(include=[np.number])
+        if len(self.columns) == 0:
+            self.columns = [name for name in numeric.columns if name != STORE_DATE_COLUMN]
+
+        last_date = self.get_last_date()
+        new = np.ones(len(dates), dtype=bool) if last_date is None else dates > last_date
+        if not np.any(new):
+            return 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+        files = [(self.get_date_path(), dates[new].astype(date_dtype))]
+        for ix, name in enumerate(self.columns):
+            if name in numeric.columns:
+                values = numeric[name].to_numpy(dtype=value_dtype)[new]
+            else:
+                values = np.full(np.count_nonzero(new), np.nan, dtype=value_dtype)
+
+            files.append((self.get_column_path(ix), values))
+
+        # Drop anything past the committed rows before appending, then commit the new row count
+        for file_path, values in files:
+            with open(file_path, 'ab') as file:
+                file.truncate(self.num_rows * values.dtype.itemsize)
+                file.write(values.tobytes())
+
+        num_new = int(np.count_nonzero(new))
+        self.num_rows += num_new
+        self.save_manifest()
+        return num_new
+
+
+    # Gets the [begin, end) row range for dates in [start, end]. Either bound may be None.
+    def get_range(self, start = None, end = None):
+        dates = self.get_dates()
+        begin = 0 if start is None else int(np.searchsorted(dates, to_epoch_days([start])[0], side='left'))
+        stop = len(dates) if end is None else int(np.searchsorted(dates, to_epoch_days([end])[0], side='right'))
+        return begin, stop
+
+
+    # Reads a date range, or the `last` N rows, as read-only memory-mapped column slices keyed by
+    # name. Dates are days since the Unix epoch. Also returns the row number of the first row.
+    def read(self, start = None, end = None, last = None, columns = None):
+        begin, stop = self.get_range(start, end)
+        if last is not None:
+            begin = max(begin, stop - last)
+
+        if columns is None:
+            columns = self.columns
+
+        data = { STORE_DATE_COLUMN: self.get_dates()[begin:stop] }
+        for name in columns:
+            if name not in self.columns:
+                raise Exception(f"Unknown column '{name}' in store for {self.symbol}")
+
+            data[name] = self.open_column(self.get_column_path(self.columns.index(name)), value_dtype)[begin:stop]
+
+        return data, begin
+
+
+    # Reads a date range, or the `last` N rows, as a DataFrame in the layout of ticker.csv.
+    # The index holds the row numbers within the full history.
+    def to_frame(self, start = None, end = None, last = None, columns = None):
+        data, begin = self.read(start, end, last, columns)
+
+        frame = { STORE_DATE_COLUMN: pd.to_datetime(np.asarray(data[STORE_DATE_COLUMN]).astype('datetime64[D]')).strftime(STORE_DATE_FORMAT) }
+        for name, values in data.items():
+            if name != STORE_DATE_COLUMN:
+                frame[name] = np.array(values)
+
+        frame = pd.DataFrame(frame, index=pd.RangeIndex(begin, begin + len(frame[STORE_DATE_COLUMN])))
+        frame['symbol'] = self.symbol
+        return frame
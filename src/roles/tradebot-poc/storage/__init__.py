@@ -0,0 +1,3 @@
+from .ColumnarFile import ColumnarFile, COLUMNAR_EXT, CODEC_NONE, CODEC_ZLIB
+from .SymbolStore import SymbolStore
+from .KlineCache import KlineCache, get_kline_cache
@@ -0,0 +1,205 @@
+import os
+import csv
+import itertools
+import multiprocessing
+import datetime as dt
+import numpy as np
+from os import path
+
+from utils import *
+from genetics.Genotype import Genotype, GT, sep_gene, sep_value
+from bots.Signals import SignalParams
+from bots.ReplayEngine import ReplayEngine, load_backtest_data
+from bots.VectorBacktest import VectorBacktest, compute_signal_indicators
+
+
+#
+# Genome sweeps.
+#
+# The backtest dataset (and, for vectorized sweeps, the indicator series, which do not depend on
+# any gene) is loaded once in the parent. Workers are forked afterwards and read it through
+# copy-on-write pages instead of reparsing CSVs per genome.
+#
+
+sweep_result_columns = ['rank', 'genome', 'profit', 'trades', 'drawdown', 'win_rate']
+
+# Shared, read-only state for forked workers. Set before the pool is created.
+_sweep = {}
+
+
+# Expands a grid spec into its values. Each gene is one of:
+#   NAME=a:b:step   inclusive numeric range
+#   NAME=a,b,c      explicit values (including y/n for flags)
+#   NAME=a          a single value
+def parse_grid(grid: str):
+    axes = []
+    genotype = Genotype()
+
+    # Commas separate values here, so only the primary gene separator splits genes
+    for decl in grid.split(sep_gene):
+        decl = decl.strip()
+        if decl == '':
+            continue
+
+        if sep_value not in decl:
+            raise Exception(f"Invalid grid entry '{decl}'. Expected NAME=values")
+
+        name, spec = decl.split(sep_value, 1)
+        gene = genotype.get_gene(name)
+        if gene is None:
+            raise Exception(f"Unknown robot gene '{name}'")
+
+        if ':' in spec:
+            if gene.type == GT.Flag:
+                raise Exception(f"Flag gene '{name}' cannot take a range")
+
+            pieces = [float(x) for x in spec.split(':')]
+            if len(pieces) != 3 or pieces[2] <= 0:
+                raise Exception(f"Invalid range '{spec}' for gene '{name}'. Expected start:end:step")
+
+            start, end, step = pieces
+            count = int(np.floor((end - start) / step + 1e-9)) + 1
+            values = [str(round(start + step * i, 10)) for i in range(count)]
+        else:
+            values = [x.strip() for x in spec.split(',') if x.strip() != '']
+
+        if len(values) == 0:
+            raise Exception(f"No values for gene '{name}'")
+
+        axes.append([f"{name}{sep_value}{value}" for value in values])
+
+    return axes
+
+
+# Gets the genome strings of every combination in the grid, layered over `base_genome`
+def expand_grid(grid: str, base_genome: str = ''):
+    axes = parse_grid(grid)
+    genomes = []
+
+    for combo in itertools.product(*axes):
+        genome = sep_gene.join([x for x in [base_genome] + list(combo) if x != ''])
+
+        # Validate early, in the parent, rather than in every worker
+        Genotype(genome)
+        genomes.append(genome)
+
+    return genomes
+
+
+def _init_sweep(data, indicators, budget, wager, yield_target, use_ticks):
+    _sweep['data'] = data
+    _sweep['indicators'] = indicators
+    _sweep['budget'] = budget
+    _sweep['wager'] = wager
+    _sweep['yield_target'] = yield_target
+    _sweep['ticks'] = use_ticks
+
+
+# Backtests a single genome against the shared dataset. Runs in a worker.
+def evaluate_genome(genome: str):
+    data = _sweep['data']
+    params = SignalParams.from_genotype(Genotype(genome), _sweep['yield_target'])
+
+    if _sweep['ticks']:
+        result = ReplayEngine(params, _sweep['budget'], _sweep['wager']).run(data)
+        prices = data.tick_price
+    else:
+        backtest = VectorBacktest(params, _sweep['budget'], _sweep['wager'])
+        result = backtest.run(data.history_open_time, data.history_close, _sweep['indicators'])
+        prices = data.history_close
+
+    profits = result.get_realized_profits()
+    win_rate = float(np.mean(profits > 0)) if len(profits) > 0 else 0.0
+
+    return {
+        'genome': genome,
+        'profit': result.total_profit,
+        'trades': len(result.trades),
+        'drawdown': result.get_max_drawdown(prices),
+        'win_rate': win_rate,
+    }
+
+
+# Creates a worker pool with the dataset shared by every worker. Indicators are computed once
+# up front for vectorized (closed interval) evaluation.
+def create_sweep_pool(data, budget, wager, yield_target, use_ticks = False, workers = 0):
+    indicators = None if use_ticks else compute_signal_indicators(data.history_close)
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    # Fork so workers inherit the dataset without pickling it
+    try:
+        mp = multiprocessing.get_context('fork')
+    except ValueError:
+        mp = multiprocessing.get_context()
+        log(f"Fork is unavailable. The dataset will be copied to each worker", 'sweep')
+
+    return mp.Pool(workers, initializer=_init_sweep, initargs=(data, indicators, budget, wager, yield_target, use_ticks))
+
+
+# Runs a backtest for every genome, streaming results to `results_path` as they complete.
+# Returns the results ranked by profit.
+def run_sweep(data, genomes, budget, wager, yield_target, results_path, use_ticks = False, workers = 0):
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    results = []
+    perf_start = dt.datetime.now()
+
+    os.makedirs(path.dirname(path.abspath(results_path)), exist_ok=True)
+    with open(results_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=sweep_result_columns[1:])
+        writer.writeheader()
+
+        with create_sweep_pool(data, budget, wager, yield_target, use_ticks, workers) as pool:
+            chunksize = max(1, len(genomes) // (workers * 16))
+            for result in pool.imap_unordered(evaluate_genome, genomes, chunksize=chunksize):
+                results.append(result)
+                writer.writerow(result)
+                file.flush()
+
+    elapsed = (dt.datetime.now() - perf_start).total_seconds()
+    log(f"Evaluated {len(results)} genomes in {elapsed:.2f}s using {workers} worker(s)", 'sweep')
+
+    results.sort(key=lambda r: (-r['profit'], r['drawdown']))
+    for rank, result in enumerate(results):
+        result['rank'] = rank + 1
+
+    return results
+
+
+def write_ranked_results(results, ranked_path):
+    with open(ranked_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=sweep_result_columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def run_sweep_command(args):
+    backtest = args['backtest']
+    genomes = expand_grid(args['grid'], args['genome'])
+    log(f"Sweeping {len(genomes)} genome(s) over backtest '{backtest}'", 'sweep')
+
+    data = load_backtest_data(backtest)
+
+    out = args['out']
+    if out == '':
+        stamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = path.join(os.getcwd(), 'output', f"sweep-{backtest}-{stamp}.csv")
+
+    results = run_sweep(data, genomes,
+                        float(args['budget_initial']),
+                        float(args['wager_initial']),
+                        float(args['yield_target']),
+                        out,
+                        use_ticks=args['ticks'],
+                        workers=int(args['workers']))
+
+    ranked_path = out[:-4] + '-ranked.csv' if out.endswith('.csv') else out + '-ranked'
+    write_ranked_results(results, ranked_path)
+
+    for result in results[:10]:
+        log(f"#{result['rank']} {result['genome']} | P: {result['profit']:.8f} | T: {result['trades']} | DD: {result['drawdown']:.8f}", 'sweep')
+
+    log(f"Ranked results written to {ranked_path}", 'sweep')
@@ -6,14 +6,9 @@ import datetime as dt
 import json
 import numpy as np
 import pandas as pd
-import yfinance as yf
-import plotly.express as px
-import plotly.graph_objects as go
-import multiprocessing
 import threading
 import uuid
 import traceback
-from rich import inspect
 
 
 import asyncio
@@ -26,11 +21,17 @@ from genetics import Genotype
 from bots import BotState
 from utils import *
 from bots import *
+from bots.ReplayEngine import ReplayEngine, load_backtest_data
+from bots.VectorBacktest import VectorBacktest, verify_parity
+from bots.Signals import SignalParams
 from Workspace import *
+from TickQueue import TickQueue
+from storage import get_kline_cache
 
 from binance.client import Client
 from binance import AsyncClient, BinanceSocketManager
 from binance import *
+from binance.helpers import date_to_milliseconds
 import binance
 
 
@@ -52,12 +53,35 @@ api_secret = os.environ.get('SM_BINANCE_SECRET')
 
 
 #
-# Kline receiver
+# User data receiver. Reports on the bot's orders are queued with its ticks, so they are handled
+# in order with them; other account events are dropped.
+#
+async def user_listener(bm, ticks):
+    async with bm.user_socket() as stream:
+        while True:
+            msg = await stream.recv()
+            if msg is None or msg.get('e') != 'executionReport':
+                continue
+
+            await ticks.put(msg['e'], msg['E'], msg['s'], msg)
+
+
+#
+# Kline receiver. The socket is read independently of the bot through a TickQueue, so a slow tick
+# (indicators, state saves, REST calls) does not stall the socket; stale ticks are coalesced
+# instead. When trading live, order updates arrive over the user data stream alongside.
 #
 async def kline_listener(client, workspace, robot, params, symbol):
     bm = BinanceSocketManager(client)
+    ticks = TickQueue(tag=robot.tag)
     res_count = 0
 
+    async def handle_tick(event_name, event_time, event_symbol, payload):
+        if event_name == 'kline':
+            await robot.handle_symbol_tick(event_name, event_time, symbol, payload)
+        elif event_name == 'executionReport':
+            await robot.handle_exec_report(event_time, payload)
+
     async def handle_socket_message(msg):
         if msg is None:
             return
@@ -66,15 +90,18 @@ async def kline_listener(client, workspace, robot, params, symbol):
         event_time = msg['E']
         event_symbol = msg['s']
 
+        if event_name != 'kline':
+            await ticks.put(event_name, event_time, event_symbol, msg)
+            return
+
         payload = msg['k']
         payload['e'] = event_name
         payload['E'] = event_time
         payload['s'] = event_symbol
+        await ticks.put(event_name, event_time, event_symbol, payload)
 
-        if event_name == 'kline':
-            await robot.handle_symbol_tick(event_name, event_time, symbol, payload)
-        elif event_name == 'executionReport':
-            await robot.handle_exec_report(event_time, msg)
+    consumer = asyncio.create_task(ticks.consume(handle_tick))
+    users = asyncio.create_task(user_listener(bm, ticks)) if robot.is_live_trading else None
 
     try:
         #streams = ['BNBBTC@miniTicker', 'BNBBTC@bookTicker']
@@ -85,6 +112,16 @@ async def kline_listener(client, workspace, robot, params, symbol):
         async with bm.kline_socket(symbol=symbol) as stream:
             while True:
                 msg = await stream.recv()
+
+                # Surface errors from tick handling here, where the listener is supervised
+                if consumer.done():
+                    consumer.result()
+                    raise Exception("Tick consumer stopped")
+
+                if users is not None and users.done():
+                    users.result()
+                    raise Exception("User data listener stopped")
+
                 await handle_socket_message(msg)
 
     except Exception as e:
@@ -96,6 +133,13 @@ async def kline_listener(client, workspace, robot, params, symbol):
         raise
         return
 
+    finally:
+        consumer.cancel()
+        if users is not None:
+            users.cancel()
+
+        ticks.log_stats()
+
 #
 
 
@@ -250,7 +294,7 @@ async def main(args):
 
             try:
                 if mode_backtest is True:
-                    complete = await run_backtest(client, workspace, robot, params, symbol, backtest)
+                    complete = await run_backtest(client, workspace, robot, params, symbol, backtest, args['vectorized'], args['parity'])
 
                     # Break out
                     if complete:
@@ -320,45 +364,41 @@ def init_new_bot(name, path, args, symbol, genome):
     return state
 
 
-# Runs training for a particular time interval
-async def run_backtest(client, workspace, bot, params, symbol, backtest_name):
-    try:
-        bt_history_path = path.join(
-            os.getcwd(), 'data', 'training-data', backtest_name + "-history.csv")
-        bt_ticks_path = path.join(
-            os.getcwd(), 'data', 'training-data', backtest_name + '-ticks.csv')
-        data = pd.read_csv(bt_history_path)
-        ticks = pd.read_csv(bt_ticks_path)
+# Runs training for a particular time interval.
+# Captured ticks are replayed through the fast-path replay engine rather than handle_symbol_tick.
+# With `vectorized`, only the closed intervals of the history are evaluated, in one vectorized pass.
+async def run_backtest(client, workspace, bot, params, symbol, backtest_name, vectorized = False, parity = False):
+    data = load_backtest_data(backtest_name)
 
-    except Exception as e:
-        log(f"Could not run backtest '{backtest_name}'. Verify that both paths exists and are valid backtesting materials: {bt_history_path}, {bt_ticks_path}")
-        raise
-
-    data.drop(data.columns[data.columns.str.contains(
-        'unnamed', case=False)], axis=1, inplace=True)
+    bot.is_playback = True
+    if bot.state is None:
+        bot.state = BotState.BotState(bot.name, symbol, bot.genetics)
 
-    data = data.values.tolist()
-    ticks = ticks.to_dict('records')
+    if parity:
+        state = bot.state
+        matches, _, _ = verify_parity(SignalParams.from_state(state), state.budget, state.default_trade_pct, data.history_open_time, data.history_close)
+        if not matches:
+            raise Exception(f"Vectorized backtest does not match the replay engine for '{backtest_name}'")
 
-    # TODO: Harmonize with params
-    rolling_avg_window = 100
+        log(f"Vectorized backtest matches the replay engine over {len(data.history_close)} intervals", 'parity')
 
-    # TODO: Need to fix up time handling here
-    first_tick = load_time(ticks[0]['t'])
+    if vectorized:
+        log(f"Evaluating {len(data.history_close)} intervals with the vectorized backtester...")
+        result = VectorBacktest.from_state(bot.state).run(data.history_open_time, data.history_close)
+    else:
+        log(f"Replaying {len(data.tick_price)} ticks after {data.get_runin_end()} intervals of run-in...")
+        engine = ReplayEngine.from_state(bot.state)
+        result = engine.run(data)
 
-    # Initialize and run-in the bot, but only up to the point that ticks started
-    bot.is_playback = True
+    bot.state.trades.extend(result.to_ledger(symbol))
 
-    await bot.initialize(client, data, first_tick)
+    bot.state.total_profit += result.total_profit
+    bot.fsm_state = result.fsm_state
 
-    log(f"Bot is initialized in playback mode. Running through history and ticks...")
-    for tick in ticks:
-        event_time = load_time(tick['t'])
-        bot.playback_curr_time = event_time
-        await bot.handle_symbol_tick('kline', event_time, symbol, tick)
+    log(f"Replayed {result.num_ticks} ticks in {result.elapsed:.3f}s ({result.get_ticks_per_sec():.0f} ticks/sec)")
 
     # DEV ONLY
-    bot.save_state()
+    bot.save_state(snapshot=True)
     return True
 
 
@@ -367,7 +407,7 @@ async def run_bot(client, workspace, bot, params, symbol, forwardtest):
     source, target = globals.currencies.parse_pair(symbol)
     api_symbol = source.symbol + target.symbol
     # "1 day ago PST") # TODO: Test time handling here
-    data = await client.get_historical_klines(api_symbol, Client.KLINE_INTERVAL_1MINUTE, "10 hours ago PST")
+    data = await get_kline_cache(api_symbol).load(client, date_to_milliseconds("10 hours ago PST"))
     await bot.initialize(client, data)
 
     log(f"Beginning {env} trading on {symbol}. API URL: {client.API_URL}")
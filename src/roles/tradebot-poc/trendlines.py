@@ -0,0 +1,153 @@
+import numpy as np
+from utils import *
+
+
+#
+# Trendline detection over extrema.
+#
+# For each extremum, the slopes to every later extremum are sorted, so points that lie on a common
+# line through it become neighbours. Walking the sorted slopes while keeping running sums for an
+# O(1) least-squares fit finds every line of three or more points within tolerance in
+# O(n^2 log n) for n extrema, instead of fitting every triple.
+#
+# The tolerance follows the usual formulation: scale = (max - min) / len(h) and a point set is a
+# trendline if the standard error of its fit is at most scale * errpct.
+#
+
+DEFAULT_TRENDLINE_ERRPCT = 0.005
+
+
+def get_trendline_tolerance(h, errpct = DEFAULT_TRENDLINE_ERRPCT):
+    h = np.asarray(h, dtype=np.float64)
+    if len(h) == 0:
+        return 0.0
+
+    return (np.nanmax(h) - np.nanmin(h)) / len(h) * errpct
+
+
+#
+# Running least-squares line fit
+#
+class LineFit:
+    def __init__(self):
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+
+
+    def add(self, x, y):
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+        self.syy += y * y
+
+
+    # Gets (slope, intercept, standard error)
+    def get_fit(self):
+        n = self.n
+        vxx = self.sxx - self.sx * self.sx / n
+        vxy = self.sxy - self.sx * self.sy / n
+        vyy = self.syy - self.sy * self.sy / n
+
+        slope = vxy / vxx if vxx != 0 else 0.0
+        intercept = (self.sy - slope * self.sx) / n
+        ssr = max(0.0, vyy - slope * vxy)
+        error = np.sqrt(ssr / (n - 2)) if n > 2 else 0.0
+        return slope, intercept, error
+
+
+def _restart(x, y, pts):
+    fit = LineFit()
+    for p in pts:
+        fit.add(x[p], y[p])
+
+    return fit
+
+
+# Walks the points in `order` (sorted by slope from `anchor`), growing a line through the anchor
+# while its fit stays within tolerance. Returns the lines of three or more points found, as
+# (point positions, (slope, intercept, standard error)).
+def find_anchored_trendlines(xf, yl, anchor, order, tolerance):
+    found_lines = []
+    pts = [anchor]
+    fit = _restart(xf, yl, pts)
+    found = None
+
+    for j in order:
+        pts.append(j)
+        fit.add(xf[j], yl[j])
+        if len(pts) < 3:
+            continue
+
+        slope, intercept, error = fit.get_fit()
+        if error <= tolerance:
+            found = (pts.copy(), (slope, intercept, error))
+        else:
+            if found is not None:
+                found_lines.append(found)
+                found = None
+
+            # Restart the search from the anchor and this point
+            pts = [anchor, j]
+            fit = _restart(xf, yl, pts)
+
+    if found is not None:
+        found_lines.append(found)
+
+    return found_lines
+
+
+# Finds trendlines through the points of `h` at `idxs` (typically the minima or maxima).
+# Returns a list of (sorted point indices, (slope, intercept, standard error)).
+def find_trendlines(h, idxs, errpct = DEFAULT_TRENDLINE_ERRPCT, tolerance = None):
+    h = np.asarray(h, dtype=np.float64)
+    x = np.asarray(idxs, dtype=np.int64)
+    y = h[x] if len(x) > 0 else np.zeros(0)
+
+    if tolerance is None:
+        tolerance = get_trendline_tolerance(h, errpct)
+
+    trends = []
+    xf = x.astype(np.float64).tolist()
+    yl = y.tolist()
+
+    # Points of the lines found so far, by the points on them. A later anchor on a line finds the
+    # rest of it again, which is skipped.
+    lines_by_point = {}
+
+    for i in range(len(x) - 2):
+        slopes = (y[i + 1:] - y[i]) / (x[i + 1:] - x[i])
+        order = (np.argsort(slopes, kind='stable') + i + 1).tolist()
+
+        for pts, fit in find_anchored_trendlines(xf, yl, i, order, tolerance):
+            line = frozenset(pts)
+            if any([line <= other for other in lines_by_point.get(i, [])]):
+                continue
+
+            for p in line:
+                lines_by_point.setdefault(p, []).append(line)
+
+            trends.append(([int(x[p]) for p in sorted(line)], fit))
+
+    return trends
+
+
+# Finds extrema and trendlines for each row of a 2-D array of series at once.
+# Returns (minima indices, maxima indices, support trendlines, resistance trendlines) per row.
+def find_support_resistance(H, errpct = DEFAULT_TRENDLINE_ERRPCT):
+    H = np.atleast_2d(np.asarray(H, dtype=np.float64))
+    mom, momacc = get_momentum(H)
+    minima = get_extrema_mask(H, mom, momacc, True)
+    maxima = get_extrema_mask(H, mom, momacc, False)
+
+    results = []
+    for row in range(H.shape[0]):
+        minimaIdxs = np.flatnonzero(minima[row])
+        maximaIdxs = np.flatnonzero(maxima[row])
+        results.append((minimaIdxs.tolist(),
+                        maximaIdxs.tolist(),
+                        find_trendlines(H[row], minimaIdxs, errpct),
+                        find_trendlines(H[row], maximaIdxs, errpct)))
+
+    return results
@@ -14,10 +14,21 @@ BINANCE_FEE_BASE = 0
 
 class TimeScale(Enum):
     MINUTE = '1m'
+    FIVE_MINUTES = '5m'
+    FIFTEEN_MINUTES = '15m'
     ONE_HOUR = '1h'
     ONE_DAY = '1d'
 
 
+timescale_millis = {
+    TimeScale.MINUTE: 60 * 1000,
+    TimeScale.FIVE_MINUTES: 5 * 60 * 1000,
+    TimeScale.FIFTEEN_MINUTES: 15 * 60 * 1000,
+    TimeScale.ONE_HOUR: 60 * 60 * 1000,
+    TimeScale.ONE_DAY: 24 * 60 * 60 * 1000,
+}
+
+
 # Logging
 def log(str, tag=''):
     ts = dt.datetime.now()
@@ -40,11 +51,9 @@ def format_time(time):
 # Load time from either a number (Unix timestamp) or string (formatted DT)
 def load_time(thinger):
 
+    # Both "%Y-%m-%d %H:%M:%S" and "%Y-%m-%d %H:%M:%S.%f", several times faster than strptime
     if isinstance(thinger, str):
-        if len(thinger) == 19:
-            return dt.datetime.strptime(thinger, "%Y-%m-%d %H:%M:%S")
-        else:
-            return dt.datetime.strptime(thinger, "%Y-%m-%d %H:%M:%S.%f")
+        return dt.datetime.fromisoformat(thinger)
     elif isinstance(thinger, pd.Timestamp):
         return thinger.to_pydatetime()
     elif isinstance(thinger, dt.datetime):
@@ -55,24 +64,59 @@ def load_time(thinger):
         return dt.datetime.fromtimestamp(thinger / 1000)
 
 
+# Converts anything load_time() understands into Unix epoch millis
+def to_millis(thinger):
+    if isinstance(thinger, (int, np.integer)):
+        return int(thinger)
+
+    return int(load_time(thinger).timestamp() * 1000)
+
+
 def millis_between(then, now):
     return int((now - then).total_seconds() * 1000)
 
 
+# Gets the first and second derivatives of a series (or of each row of a 2-D array of series).
+# Same second-order stencils as FinDiff(0, 1, 1) and FinDiff(0, 1, 2), one-sided at the ends.
+def get_momentum(h):
+    h = np.asarray(h, dtype=np.float64)
+    mom = np.gradient(h, axis=-1, edge_order=2)
+
+    momacc = np.empty_like(h)
+    momacc[..., 1:-1] = h[..., :-2] - 2 * h[..., 1:-1] + h[..., 2:]
+    momacc[..., 0] = 2 * h[..., 0] - 5 * h[..., 1] + 4 * h[..., 2] - h[..., 3]
+    momacc[..., -1] = 2 * h[..., -1] - 5 * h[..., -2] + 4 * h[..., -3] - h[..., -4]
+    return mom, momacc
+
+
+# Gets a mask of the local minima (or maxima) of a series, or of each row of a 2-D array of series.
+# A point is an extremum if its momentum is zero or changes sign towards a neighbour on the right
+# side of it, and the acceleration agrees.
+def get_extrema_mask(h, mom, momacc, isMin=False):
+    h = np.asarray(h, dtype=np.float64)
+    mom = np.asarray(mom, dtype=np.float64)
+    momacc = np.asarray(momacc, dtype=np.float64)
+
+    mask = momacc > 0 if isMin else momacc < 0
+
+    # Check next day
+    next_turn = np.zeros(mom.shape, dtype=bool)
+    curr, nxt = mom[..., :-1], mom[..., 1:]
+    next_turn[..., :-1] = (((curr > 0) & (nxt < 0) & (h[..., :-1] >= h[..., 1:])) |
+                           ((curr < 0) & (nxt > 0) & (h[..., :-1] <= h[..., 1:])))
+
+    # Check prior day
+    prior_turn = np.zeros(mom.shape, dtype=bool)
+    prev, curr = mom[..., :-1], mom[..., 1:]
+    prior_turn[..., 1:] = (((prev > 0) & (curr < 0) & (h[..., :-1] < h[..., 1:])) |
+                           ((prev < 0) & (curr > 0) & (h[..., :-1] > h[..., 1:])))
+
+    return mask & ((mom == 0) | next_turn | prior_turn)
+
+
+# Gets the indices of the local minima (or maxima) of a series
 def get_extrema(h, mom, momacc, isMin=False):
-    return [x for x in range(len(mom))
-            if (momacc[x] > 0 if isMin else momacc[x] < 0) and
-            (mom[x] == 0 or  # slope is 0
-             (x != len(mom) - 1 and  # check next day
-                (mom[x] > 0 and mom[x+1] < 0 and
-                 h[x] >= h[x+1] or
-                 mom[x] < 0 and mom[x+1] > 0 and
-                 h[x] <= h[x+1]) or
-                x != 0 and  # check prior day
-                (mom[x-1] > 0 and mom[x] < 0 and
-                 h[x-1] < h[x] or
-                 mom[x-1] < 0 and mom[x] > 0 and
-                 h[x-1] > h[x])))]
+    return np.flatnonzero(get_extrema_mask(h, mom, momacc, isMin)).tolist()
 
 
 def time(desc, fn, tag=''):
@@ -107,3 +151,12 @@ def parse_timescale(val: str) -> TimeScale:
         return val
     except Exception as e:
         raise Exception(f"Unknown timescale '{val}'")
+
+
+# Parses one or more timescales separated by '+', e.g. '1m+1h'
+def parse_timescales(val: str) -> tuple:
+    return tuple([parse_timescale(piece) for piece in val.split('+')])
+
+
+def format_timescales(timescales) -> str:
+    return '+'.join([timescale.value for timescale in timescales])